@@ -1,30 +1,67 @@
 import os
-from flask import Flask, request, abort
-from linebot import LineBotApi, WebhookHandler
+from flask import Flask, request, abort, jsonify, send_file
+from linebot import LineBotApi
 from linebot.exceptions import InvalidSignatureError
 from message_publisher import MessagePublisher
+from webhook_event import WebhookEvent, WebhookParser
+from event_context import EventContext, EventContextStats
 from user_state_manager import UserStateManager
 from features.feature_registry import FeatureRegistry
 from features.menu_feature import MenuFeature
 from features.colorize_feature import ColorizeFeature
 from features.edit_feature import EditFeature
 from features.member_feature import MemberFeature
-from models.database import init_database, create_tables
+from models.database import init_database, create_tables, get_engine
 from services.member_service import MemberService
+from services.event_queue import EventQueue
+from services.event_dispatcher import BatchDispatcher, event_source_key
+from services.sharded_executor import ShardedExecutor
+from services.idempotency_store import IdempotencyStore
+from services.profile_cache import ProfileCache
+from services.line_http_client import LineHttpClient
+from services.push_coalescer import PushCoalescer
+from services.outbox_dispatcher import OutboxDispatcher, outbox_stats
+from services.state_cache import StateCache, PostgresInvalidationChannel
+from services.state_store import create_state_store
+from services.blob_store import BlobStore
+from services.state_reaper import StateReaper
+from services.job_scheduler import JobScheduler
+from services.result_cache import ResultCache, EXTENSION_MIMETYPES
+from services.single_flight import SingleFlight
+from services.image_preprocessor import ImagePreprocessor, PILLOW_AVAILABLE
 
 # 全域變數
 app = Flask(__name__)
 line_bot_api = None
-handler = None
+webhook_parser = None
+profile_cache = None
+push_coalescer = None
 publisher = None
 user_state_manager = None
 feature_registry = None
 member_service = None
+event_queue = None
+event_executor = None
+batch_dispatcher = None
+idempotency_store = None
+outbox_dispatcher = None
+blob_store = None
+state_reaper = None
+job_scheduler = None
+result_cache = None
+single_flight = None
+image_preprocessor = None
+
+# 每個事件的外部呼叫次數統計
+event_context_stats = EventContextStats()
 _initialized = False
 
+# webhook 模式：sync（在請求內直接處理）或 queue（寫入持久化佇列後立即回應）
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "sync").lower()
+
 def init():
     """初始化所有 LINE Bot 相關組件"""
-    global app, line_bot_api, handler, publisher, user_state_manager, feature_registry, member_service, _initialized
+    global app, line_bot_api, webhook_parser, profile_cache, push_coalescer, publisher, user_state_manager, feature_registry, member_service, event_queue, event_executor, batch_dispatcher, idempotency_store, outbox_dispatcher, blob_store, state_reaper, job_scheduler, result_cache, single_flight, image_preprocessor, _initialized
     
     # 如果已經初始化過，直接返回
     if _initialized:
@@ -62,19 +99,41 @@ def init():
     
     # 4. 初始化 LINE Bot API
     print("🤖 初始化 LINE Bot API...")
-    line_bot_api = LineBotApi(os.getenv("CHANNEL_ACCESS_TOKEN"))
-    handler = WebhookHandler(os.getenv("CHANNEL_SECRET"))
+    # 所有 LINE API 呼叫共用 keep-alive 連線池
+    line_bot_api = LineBotApi(os.getenv("CHANNEL_ACCESS_TOKEN"), http_client=LineHttpClient)
+    webhook_parser = WebhookParser(os.getenv("CHANNEL_SECRET"))
+    profile_cache = ProfileCache(line_bot_api)
     print("✅ LINE Bot API 初始化完成")
     
     # 5. 創建統一的訊息發送器
     print("📤 初始化訊息發送器...")
-    publisher = MessagePublisher(line_bot_api)
+    # 同一目標短時間內的多次推送合併成一次 push（PUSH_COALESCE_WINDOW_MS=0 停用）
+    if int(os.getenv("PUSH_COALESCE_WINDOW_MS", "300")) > 0:
+        push_coalescer = PushCoalescer(line_bot_api.push_message)
+    publisher = MessagePublisher(line_bot_api, profile_cache, push_coalescer)
     print("✅ 訊息發送器初始化完成")
     
     # 6. 創建用戶狀態管理器
     print("👤 初始化用戶狀態管理器...")
-    user_state_manager = UserStateManager()
-    print("✅ 用戶狀態管理器初始化完成")
+    # 儲存後端由 STATE_BACKEND 決定：memory（單一程序）/ sqlite（單機多程序）/ database（多節點）
+    state_store = create_state_store()
+    # write-through 快取（USER_STATE_CACHE_TTL_SECONDS=0 停用）只在不會讀到其他 worker 舊狀態時啟用：
+    # USER_STATE_INVALIDATION=postgres 以 LISTEN/NOTIFY 同步失效，或 memory 後端（單一程序）
+    state_cache = None
+    invalidation_channel = None
+    if float(os.getenv("USER_STATE_CACHE_TTL_SECONDS", "30")) > 0:
+        engine = get_engine()
+        if os.getenv("USER_STATE_INVALIDATION", "none") == "postgres" and engine is not None \
+                and engine.dialect.name == "postgresql":
+            invalidation_channel = PostgresInvalidationChannel(engine)
+        if invalidation_channel is not None or state_store.name == "memory":
+            state_cache = StateCache()
+        else:
+            print("ℹ️  沒有跨程序失效通知，停用用戶狀態快取"
+                  "（設定 USER_STATE_INVALIDATION=postgres 或 STATE_BACKEND=memory 以啟用）")
+    user_state_manager = UserStateManager(store=state_store, cache=state_cache, invalidation_channel=invalidation_channel)
+    print(f"✅ 用戶狀態管理器初始化完成 (後端: {user_state_manager.store.name}, "
+          f"快取: {'on' if state_cache else 'off'}, 跨程序失效: {'postgres' if invalidation_channel else 'none'})")
     
     # 7. 創建會員服務（如果資料庫可用）
     if os.getenv("DATABASE_URL"):
@@ -96,8 +155,33 @@ def init():
     # 9. 註冊所有功能
     print("🔧 註冊功能模組...")
     menu_feature = MenuFeature(line_bot_api, publisher, user_state_manager, member_service)
-    colorize_feature = ColorizeFeature(line_bot_api, publisher, user_state_manager, member_service)
-    edit_feature = EditFeature(line_bot_api, publisher, user_state_manager, member_service)
+    # 圖片處理共用同一個有上限的背景工作排程器
+    job_scheduler = JobScheduler()
+    # Replicate 結果快取需要資料庫與對外網址（由 /results 提供快取的輸出圖片）
+    public_base_url = os.getenv("PUBLIC_BASE_URL")
+    if member_service and public_base_url and os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true":
+        result_cache = ResultCache(public_base_url)
+        print(f"✅ Replicate 結果快取已啟用 (命中時收取 {result_cache.charge_percent}% 點數)")
+    # 相同的 Replicate 工作只執行一次；有結果快取時再以 Postgres advisory lock 跨程序合併
+    use_advisory_lock = result_cache is not None and \
+        os.getenv("SINGLE_FLIGHT_ADVISORY_LOCK", "true").lower() == "true"
+    single_flight = SingleFlight(engine=get_engine() if use_advisory_lock else None)
+    if single_flight.engine is not None:
+        print("✅ Replicate 工作跨程序合併已啟用 (Postgres advisory lock)")
+    # 上傳 Replicate 前的圖片前處理（需要 Pillow，在獨立的 process pool 執行）
+    if os.getenv("IMAGE_PREPROCESS_ENABLED", "true").lower() == "true":
+        if PILLOW_AVAILABLE:
+            image_preprocessor = ImagePreprocessor()
+            print(f"✅ 圖片前處理已啟用 (最長邊 {image_preprocessor.max_edge}px, JPEG 品質 {image_preprocessor.quality})")
+        else:
+            print("ℹ️  未安裝 Pillow，跳過圖片前處理（原圖直接上傳）")
+    colorize_feature = ColorizeFeature(line_bot_api, publisher, user_state_manager, member_service,
+                                       job_scheduler=job_scheduler, result_cache=result_cache,
+                                       single_flight=single_flight, image_preprocessor=image_preprocessor)
+    blob_store = BlobStore()
+    edit_feature = EditFeature(line_bot_api, publisher, user_state_manager, member_service,
+                               blob_store=blob_store, job_scheduler=job_scheduler, result_cache=result_cache,
+                               single_flight=single_flight, image_preprocessor=image_preprocessor)
     
     feature_registry.register(menu_feature)
     feature_registry.register(colorize_feature)
@@ -113,6 +197,37 @@ def init():
     for feature in feature_registry.get_all_features():
         print(f"   - {feature.name}")
     
+    # 10. 創建事件去重儲存（多節點部署可設定 IDEMPOTENCY_BACKEND=database）
+    print("♻️  初始化事件去重儲存...")
+    use_database = (os.getenv("IDEMPOTENCY_BACKEND", "memory").lower() == "database"
+                    and bool(os.getenv("DATABASE_URL")))
+    idempotency_store = IdempotencyStore(use_database=use_database)
+    print(f"✅ 事件去重儲存初始化完成 ({'database' if use_database else 'memory'})")
+    
+    # 11. 創建依來源分片的執行器與批次事件分派器
+    print("🔀 初始化批次事件分派器...")
+    event_executor = ShardedExecutor(name="event-shard")
+    batch_dispatcher = BatchDispatcher(_dispatch_in_app_context, event_executor)
+    print(f"✅ 批次事件分派器初始化完成 ({event_executor.shard_count} 個分片)")
+    
+    # 12. 啟動事件佇列（queue 模式，與 webhook 共用同一組分片）
+    if WEBHOOK_MODE == "queue":
+        print("📥 初始化事件佇列...")
+        # 以與分派器相同的鍵排序：同一用戶的事件（包含重試）依寫入順序處理
+        event_queue = EventQueue(key_func=lambda raw: event_source_key(WebhookEvent.from_dict(raw)))
+        event_queue.start(_dispatch_in_app_context, executor=event_executor, decoder=WebhookEvent.from_dict)
+    
+    # 13. 啟動 outbox 推送（inline：在 web 程序內運行；worker：由 Procfile 的 outbox 程序運行，此處不啟動）
+    if member_service and os.getenv("OUTBOX_MODE", "inline") == "inline":
+        print("📮 啟動 outbox 推送...")
+        outbox_dispatcher = OutboxDispatcher(line_bot_api)
+        outbox_dispatcher.start()
+    
+    # 14. 啟動過期用戶狀態的背景清理（USER_STATE_REAPER_INTERVAL=0 表示停用）
+    if float(os.getenv("USER_STATE_REAPER_INTERVAL", "60")) > 0:
+        state_reaper = StateReaper(user_state_manager)
+        state_reaper.start()
+    
     # 標記為已初始化
     _initialized = True
     print("🎉 LINE Bot 初始化完成！")
@@ -154,36 +269,28 @@ def webhook():
             abort(500)
     
     # 檢查關鍵組件是否已正確初始化
-    if handler is None:
-        print("❌ Handler 未初始化")
+    if webhook_parser is None:
+        print("❌ Webhook parser 未初始化")
         abort(500)
     
     signature = request.headers.get("X-Line-Signature")
-    body = request.get_data(as_text=True)
+    body = request.get_data()
     try:
-        # 驗證簽名
-        handler.parser.parse(body, signature)
+        # queue 模式：只驗證簽名並寫入佇列，由背景 worker 處理
+        if event_queue is not None:
+            event_queue.enqueue_many(webhook_parser.parse_raw(body, signature))
+            return "OK"
         
-        # 解析請求內容
-        import json
-        events = json.loads(body).get('events', [])
+        # 驗證簽名並解析請求內容（只解析一次）
+        events = webhook_parser.parse(body, signature)
         
-        for event in events:
-            if event.get('type') == 'follow':
-                # 處理加好友事件
-                result = handle_follow_event(event)
-                if result:  # 如果有 JSON 回應，直接回傳
-                    return result
-            elif event.get('type') == 'message' and event.get('message', {}).get('type') == 'text':
-                # 處理文字訊息
-                result = handle_text_message(event)
-                if result:  # 如果有 JSON 回應，直接回傳
-                    return result
-            elif event.get('type') == 'message' and event.get('message', {}).get('type') == 'image':
-                # 處理圖片訊息
-                result = handle_image_message(event)
-                if result:  # 如果有 JSON 回應，直接回傳
-                    return result
+        # 處理整批事件，合併所有測試模式的 JSON 回應
+        results = batch_dispatcher.dispatch(events)
+        combined = BatchDispatcher.combine_responses(results)
+        if isinstance(combined, dict):
+            return jsonify(combined)
+        if combined:  # 如果有 JSON 回應，直接回傳
+            return combined
         
         return "OK"
     except InvalidSignatureError:
@@ -195,6 +302,105 @@ def webhook():
         traceback.print_exc()
         abort(500)
 
+@app.route("/results/<blob_key>.<extension>", methods=["GET"])
+def cached_result(blob_key, extension):
+    """提供 Replicate 結果快取中的輸出圖片（LINE 以此網址下載圖片）"""
+    if result_cache is None or extension not in EXTENSION_MIMETYPES:
+        abort(404)
+    try:
+        path = result_cache.blob_store.path_for(blob_key)
+    except ValueError:
+        abort(404)
+    if not os.path.exists(path):
+        abort(404)
+    return send_file(path, mimetype=EXTENSION_MIMETYPES[extension], max_age=86400)
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """回傳執行期統計數據（用於調整 worker 數量）"""
+    stats = {"webhook_mode": WEBHOOK_MODE, "event_context": event_context_stats.snapshot()}
+    if line_bot_api is not None and hasattr(line_bot_api.http_client, 'get_stats'):
+        stats["line_http"] = line_bot_api.http_client.get_stats()
+    if push_coalescer is not None:
+        stats["push_coalescer"] = push_coalescer.get_stats()
+    if user_state_manager is not None and user_state_manager.cache is not None:
+        stats["user_state_cache"] = user_state_manager.get_cache_stats()
+    if user_state_manager is not None:
+        stats["user_state_ttl"] = user_state_manager.get_ttl_stats()
+    if state_reaper is not None:
+        stats["state_reaper"] = state_reaper.get_stats()
+    if result_cache is not None:
+        stats["result_cache"] = result_cache.get_stats()
+    if single_flight is not None:
+        stats["single_flight"] = single_flight.get_stats()
+    if image_preprocessor is not None:
+        stats["image_preprocessor"] = image_preprocessor.get_stats()
+    if job_scheduler is not None:
+        stats["image_jobs"] = job_scheduler.get_stats()
+    if feature_registry is not None:
+        stats["feature_registry"] = feature_registry.get_stats()
+    if blob_store is not None:
+        stats["blob_store"] = blob_store.get_stats()
+    if profile_cache is not None:
+        stats["profile_cache"] = profile_cache.get_stats()
+    if outbox_dispatcher is not None:
+        stats["outbox"] = outbox_dispatcher.get_stats()
+    elif member_service is not None and os.getenv("OUTBOX_MODE", "inline") == "worker":
+        try:
+            stats["outbox"] = outbox_stats()
+        except Exception as e:
+            stats["outbox"] = {"error": str(e)}
+    if idempotency_store is not None:
+        stats["idempotency"] = idempotency_store.get_stats()
+    if batch_dispatcher is not None:
+        stats["batch_dispatcher"] = batch_dispatcher.get_stats()
+    if event_queue is not None:
+        stats["event_queue"] = event_queue.get_stats()
+    return jsonify(stats)
+
+def dispatch_event(event):
+    """依事件類型分派給對應的處理函式"""
+    # LINE 重送的事件（相同 webhookEventId）在進入功能處理前略過
+    if idempotency_store is not None and not idempotency_store.check_and_mark(event):
+        return None
+    try:
+        return _handle_event(event)
+    except Exception:
+        # 處理失敗時移除去重記錄，佇列重試（或 LINE 重送）時才不會被當成重複事件略過
+        if idempotency_store is not None:
+            idempotency_store.unmark(event)
+        raise
+
+def _handle_event(event):
+    """處理已通過去重檢查的事件"""
+    # 建立事件上下文，profile / 會員 / 用戶狀態在此事件中只載入一次
+    event.context = EventContext(event, line_bot_api, user_state_manager, member_service, profile_cache)
+    
+    # 加好友 / 封鎖時用戶資料可能已變更，讓 profile 快取失效
+    if event.type in ('follow', 'unfollow') and profile_cache is not None:
+        profile_cache.invalidate(event.user_id)
+    
+    result = None
+    if event.type == 'follow':
+        # 處理加好友事件
+        result = handle_follow_event(event)
+    elif event.type == 'message' and event.message_type == 'text':
+        # 處理文字訊息
+        result = handle_text_message(event)
+    elif event.type == 'message' and event.message_type == 'image':
+        # 處理圖片訊息
+        result = handle_image_message(event)
+    
+    # 回報此事件實際發出的外部呼叫次數
+    event_context_stats.record(event.context)
+    print(f"📊 事件外部呼叫 {event.context.total_external_calls()} 次: {event.context.external_calls}")
+    return result
+
+def _dispatch_in_app_context(event):
+    """在 app context 中處理事件（用於分派器與佇列的 worker 執行緒）"""
+    with app.app_context():
+        return dispatch_event(event)
+
 def handle_text_message(event):
     """處理文字訊息，委託給 FeatureRegistry"""
     try:
@@ -221,7 +427,7 @@ def handle_follow_event(event):
     """處理加好友事件 - 自動建立會員並發送歡迎訊息"""
     try:
         # 取得用戶 ID
-        user_id = event.get('source', {}).get('userId', '')
+        user_id = event.user_id
         if not user_id:
             print("❌ 無法取得用戶 ID")
             return None
@@ -242,9 +448,9 @@ def handle_follow_event(event):
         else:
             print(f"👋 歡迎回來！會員已存在: {user_id}")
         
-        # 透過 LINE API 取得用戶資料
+        # 透過 LINE API 取得用戶資料（經由事件上下文，同一事件只呼叫一次）
         try:
-            profile = line_bot_api.get_profile(user_id)
+            profile = event.context.get_profile()
             display_name = profile.display_name
             picture_url = profile.picture_url
             print(f"👤 用戶資料: {display_name}")
@@ -349,8 +555,9 @@ def _auto_init():
         print(f"⚠️  自動初始化失敗: {str(e)}")
         print("ℹ️  將在第一次請求時重試初始化")
 
-# 執行自動初始化
-_auto_init()
+# 執行自動初始化（圖片前處理以 spawn 啟動的子程序會以 __mp_main__ 重新載入本檔，不需要初始化）
+if __name__ != "__mp_main__":
+    _auto_init()
 
 if __name__ == "__main__":
     main()
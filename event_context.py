@@ -0,0 +1,143 @@
+import threading
+from typing import Optional, Dict, Any
+
+# 尚未載入的標記（None 本身是合法的載入結果，例如用戶沒有狀態）
+_NOT_LOADED = object()
+
+
+class EventContext:
+    """
+    單一事件的請求範圍上下文
+
+    每個事件建立一次，延遲載入並記住該事件需要的用戶資料（LINE profile）、
+    會員資料與用戶狀態，讓各層（FeatureRegistry、功能、MessagePublisher）
+    共用同一份結果，不再各自呼叫 LINE API 或查詢資料庫。
+    """
+
+    def __init__(self, event, line_bot_api, state_manager, member_service=None, profile_cache=None):
+        self.event = event
+        self.user_id = event.user_id
+        self.line_bot_api = line_bot_api
+        self.profile_cache = profile_cache
+        self.state_manager = state_manager
+        self.member_service = member_service
+
+        self._lock = threading.RLock()
+        self._profile = _NOT_LOADED
+        self._profile_error = None
+        self._member = _NOT_LOADED
+        self._user_state = _NOT_LOADED
+
+        # 此事件實際發出的外部呼叫次數
+        self.external_calls = {
+            "get_profile": 0,
+            "member_db": 0,
+            "state_read": 0,
+            "state_write": 0,
+        }
+
+    def _count(self, name: str):
+        with self._lock:
+            self.external_calls[name] += 1
+
+    def get_profile(self):
+        """
+        取得 LINE profile（每個事件最多查詢一次，有 ProfileCache 時優先使用快取）
+
+        Raises:
+            Exception: get_profile 失敗時，重新拋出第一次呼叫時的例外
+        """
+        with self._lock:
+            if self._profile is _NOT_LOADED:
+                try:
+                    if self.profile_cache is not None:
+                        self._profile = self.profile_cache.get_profile(
+                            self.user_id,
+                            on_fetch=lambda: self._count("get_profile")
+                        )
+                    else:
+                        self._count("get_profile")
+                        self._profile = self.line_bot_api.get_profile(self.user_id)
+                except Exception as e:
+                    self._profile = None
+                    self._profile_error = e
+            if self._profile_error is not None:
+                raise self._profile_error
+            return self._profile
+
+    @property
+    def user_name(self) -> str:
+        """用戶顯示名稱（取得失敗時使用預設名稱）"""
+        try:
+            return self.get_profile().display_name
+        except Exception as e:
+            print(f"無法獲取用戶名稱：{str(e)}")
+            return "使用者"
+
+    def get_member(self, display_name: str = None) -> Optional[Dict[str, Any]]:
+        """取得或建立會員資料（每個事件最多查詢一次）"""
+        if not self.member_service:
+            return None
+        with self._lock:
+            if self._member is _NOT_LOADED:
+                self._count("member_db")
+                self._member = self.member_service.get_or_create_member(
+                    self.user_id,
+                    display_name or self.user_name
+                )
+            return self._member
+
+    @property
+    def user_state(self) -> Optional[Dict[str, Any]]:
+        """用戶狀態（每個事件最多查詢一次）"""
+        with self._lock:
+            if self._user_state is _NOT_LOADED:
+                self._count("state_read")
+                self._user_state = self.state_manager.get_state(self.user_id)
+            return self._user_state
+
+    def set_state(self, state: Dict[str, Any]):
+        """寫入用戶狀態並更新本事件的快取"""
+        with self._lock:
+            self._count("state_write")
+            self.state_manager.set_state(self.user_id, state)
+            self._user_state = state
+
+    def clear_state(self):
+        """清除用戶狀態並更新本事件的快取"""
+        with self._lock:
+            self._count("state_write")
+            self.state_manager.clear_state(self.user_id)
+            self._user_state = None
+
+    def total_external_calls(self) -> int:
+        """此事件的外部呼叫總數"""
+        with self._lock:
+            return sum(self.external_calls.values())
+
+
+class EventContextStats:
+    """彙總所有事件的外部呼叫次數"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = 0
+        self._calls = {}
+
+    def record(self, context: EventContext):
+        """記錄一個事件的外部呼叫次數"""
+        with self._lock:
+            self._events += 1
+            for name, count in context.external_calls.items():
+                self._calls[name] = self._calls.get(name, 0) + count
+
+    def snapshot(self) -> dict:
+        """取得平均每個事件的外部呼叫次數"""
+        with self._lock:
+            return {
+                "events": self._events,
+                "total_calls": dict(self._calls),
+                "avg_calls_per_event": {
+                    name: round(count / self._events, 3) for name, count in self._calls.items()
+                } if self._events else {},
+            }
@@ -1,17 +1,78 @@
+import io
+import os
+import hashlib
+import tempfile
+import threading
+import replicate
 from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from contextlib import contextmanager
 from linebot import LineBotApi
+from linebot.models import TextSendMessage
 from message_publisher import MessagePublisher
 from user_state_manager import UserStateManager
+from webhook_event import WebhookEvent
+from services.result_cache import ResultCache, CONTENT_TYPES
+
+# 從 LINE 下載圖片時每次讀取的大小，與暫存檔超過多少改寫到磁碟
+IMAGE_DOWNLOAD_CHUNK_SIZE = int(os.getenv("IMAGE_DOWNLOAD_CHUNK_SIZE", str(256 * 1024)))
+IMAGE_SPOOL_MAX_BYTES = int(os.getenv("IMAGE_SPOOL_MAX_BYTES", str(1024 * 1024)))
+
+# 圖片檔頭 → Content-Type
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+)
+
+
+def guess_image_type(image_file) -> str:
+    """依檔頭判斷圖片格式（無法判斷時視為 JPEG，LINE 的圖片訊息皆為 JPEG）"""
+    image_file.seek(0)
+    header = image_file.read(12)
+    image_file.seek(0)
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, content_type in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return content_type
+    return "image/jpeg"
 
 
 class BaseFeature(ABC):
     """所有功能的基礎類別"""
     
+    # 此功能的用戶狀態存活秒數（None 表示使用 USER_STATE_TTL_SECONDS）
+    state_ttl_seconds = None
+    
+    # 路由宣告（由 FeatureRegistry 編譯成索引）：
+    # commands：完全比對的指令；keywords：正規表示式關鍵字（在訊息任意位置比對）；
+    # global_commands / global_keywords：任何功能狀態下都優先交給此功能的指令與關鍵字
+    commands = ()
+    keywords = ()
+    global_commands = ()
+    global_keywords = ()
+    # 接受圖片的用戶狀態（FeatureRegistry 依目前狀態直接選出處理的功能）；
+    # ANY_STATE 表示沒有其他功能接手時，任何狀態下都交給此功能
+    image_states = ()
+    ANY_STATE = "*"
+    # 上傳 Replicate 前縮小到的最長邊像素（None 表示使用 IMAGE_MAX_EDGE）
+    image_max_edge = None
+    
     def __init__(self, line_bot_api: LineBotApi, publisher: MessagePublisher, state_manager: UserStateManager, member_service=None):
         self.line_bot_api = line_bot_api
         self.publisher = publisher
         self.state_manager = state_manager
         self.member_service = member_service
+        # 需要背景處理的功能在自己的建構子中設定（JobScheduler / ResultCache / SingleFlight / ImagePreprocessor）
+        self.job_scheduler = None
+        self.result_cache = None
+        self.single_flight = None
+        self.image_preprocessor = None
+        # 付費結果是否經由 outbox 送出（OUTBOX_MODE=off 時直接推送）
+        self.use_outbox = os.getenv("OUTBOX_MODE", "inline") != "off"
+        if self.state_ttl_seconds is not None:
+            state_manager.set_feature_ttl(self.name, self.state_ttl_seconds)
     
     @property
     @abstractmethod
@@ -20,118 +81,332 @@ class BaseFeature(ABC):
         pass
     
     @abstractmethod
-    def can_handle(self, message: str, user_id: str) -> bool:
-        """
-        判斷是否能處理此訊息
-        
-        Args:
-            message: 用戶訊息
-            user_id: 用戶 ID
-            
-        Returns:
-            bool: 是否能處理
-        """
-        pass
-    
-    @abstractmethod
-    def handle_text(self, event: dict) -> dict:
+    def handle_text(self, event: WebhookEvent) -> dict:
         """
         處理文字訊息
         
         Args:
-            event: LINE webhook event
+            event: WebhookEvent
             
         Returns:
             dict: Flask 回應或 None
         """
         pass
     
-    def handle_image(self, event: dict) -> dict:
+    def handle_image(self, event: WebhookEvent) -> dict:
         """
         處理圖片訊息（預設不處理）
         
         Args:
-            event: LINE webhook event
+            event: WebhookEvent
             
         Returns:
             dict: Flask 回應或 None
         """
         return None
     
-    def get_user_name(self, user_id: str) -> str:
-        """獲取用戶名稱"""
+    def get_user_name(self, event: WebhookEvent) -> str:
+        """獲取用戶名稱（同一事件只呼叫一次 get_profile）"""
+        if event.context is not None:
+            return event.context.user_name
         try:
-            profile = self.line_bot_api.get_profile(user_id)
+            profile = self.publisher.get_profile(event.user_id)
             return profile.display_name
         except Exception as e:
             print(f"無法獲取用戶名稱：{str(e)}")
             return "使用者"
     
-    def get_user_id(self, event: dict) -> str:
+    def get_member(self, event: WebhookEvent, user_name: str = None) -> dict:
+        """取得或建立會員資料（同一事件只查詢一次）"""
+        if event.context is not None:
+            return event.context.get_member(user_name)
+        return self.member_service.get_or_create_member(event.user_id, user_name)
+    
+    def get_user_id(self, event: WebhookEvent) -> str:
         """從 event 中獲取用戶 ID"""
-        return event.get('source', {}).get('userId', '')
+        return event.user_id
     
-    def get_group_id(self, event: dict) -> str:
+    def get_group_id(self, event: WebhookEvent) -> str:
         """從 event 中獲取群組 ID"""
-        return event.get('source', {}).get('groupId', '')
+        return event.group_id
     
-    def get_room_id(self, event: dict) -> str:
+    def get_room_id(self, event: WebhookEvent) -> str:
         """從 event 中獲取房間 ID"""
-        return event.get('source', {}).get('roomId', '')
+        return event.room_id
     
-    def get_source_type(self, event: dict) -> str:
+    def get_source_type(self, event: WebhookEvent) -> str:
         """從 event 中獲取來源類型"""
-        return event.get('source', {}).get('type', 'user')
+        return event.source_type
     
-    def get_target_id(self, event: dict) -> str:
+    def get_target_id(self, event: WebhookEvent) -> str:
         """
         獲取正確的目標ID（用於推送訊息）
         群組聊天時返回群組ID，個人聊天時返回用戶ID
         """
-        source_type = self.get_source_type(event)
-        if source_type == 'group':
-            return self.get_group_id(event)
-        elif source_type == 'room':
-            return self.get_room_id(event)
-        else:  # source_type == 'user'
-            return self.get_user_id(event)
+        return event.target_id
     
-    def is_group_chat(self, event: dict) -> bool:
+    def is_group_chat(self, event: WebhookEvent) -> bool:
         """判斷是否為群組聊天"""
-        source_type = self.get_source_type(event)
-        return source_type in ['group', 'room']
+        return event.is_group_chat
     
-    def get_reply_token(self, event: dict) -> str:
+    def get_reply_token(self, event: WebhookEvent) -> str:
         """從 event 中獲取回覆 token"""
-        return event.get('replyToken', '')
+        return event.reply_token
     
-    def get_message_text(self, event: dict) -> str:
+    def get_message_text(self, event: WebhookEvent) -> str:
         """從 event 中獲取訊息文字"""
-        return event.get('message', {}).get('text', '')
+        return event.text
     
-    def get_message_id(self, event: dict) -> str:
+    def get_message_id(self, event: WebhookEvent) -> str:
         """從 event 中獲取訊息 ID"""
-        return event.get('message', {}).get('id', '')
+        return event.message_id
+    
+    def push_notice(self, user_id: str, text: str, event: WebhookEvent = None):
+        """
+        推送提示訊息（開始處理、錯誤通知等），經由 PushCoalescer 與同一聊天的其他提示合併送出
+        
+        Args:
+            user_id: 用戶 ID
+            text: 提示文字
+            event: WebhookEvent（用於判斷是否為群組聊天）
+            
+        Returns:
+            Future: 合併推送的送出結果（未啟用合併或用戶無效時為 None）
+        """
+        result = self.publisher.process_push_message(user_id, TextSendMessage(text=text), event)
+        if isinstance(result, Future):
+            result.add_done_callback(
+                lambda future: future.exception() is not None and
+                print(f"⚠️ 提示訊息未送達 {user_id}: {str(future.exception())}")
+            )
+            return result
+        if result:
+            print(f"背景處理時用戶無效，JSON 回應: {result}")
+        return None
+    
+    def submit_job(self, job, reply, on_start=None):
+        """
+        把付費的圖片處理交給背景工作排程器，並以排隊位置回覆用戶
+        
+        工作會等回覆完成才開始；回覆未成功（返回 JSON 或發生例外）時工作會被取消，
+        不會替無法收到結果的用戶處理或扣點。
+        
+        Args:
+            job: 背景工作（無參數函式）
+            reply: reply(排隊提示文字) -> process_reply_message 的結果
+            on_start: 排隊等待過的工作開始執行時呼叫（例如推送開始處理的提示）
+            
+        Returns:
+            tuple: (是否已排入, 回覆結果)；佇列已滿時為 (False, None)，此時尚未回覆
+        """
+        replied = threading.Event()
+        cancelled = threading.Event()
+        
+        def gated_job():
+            replied.wait()
+            if cancelled.is_set():
+                return
+            if position and on_start is not None:
+                on_start()
+            job()
+        
+        position = self.job_scheduler.submit(gated_job)
+        if position is None:
+            return False, None
+        try:
+            notice = f"\n\n⏳ 目前排隊中，您是第 {position} 位" if position else ""
+            result = reply(notice)
+            if result is not None:
+                cancelled.set()
+            return True, result
+        except Exception:
+            cancelled.set()
+            raise
+        finally:
+            replied.set()
+    
+    def download_message_content(self, message_id: str):
+        """
+        以大區塊串流下載 LINE 訊息內容到暫存檔（超過 IMAGE_SPOOL_MAX_BYTES 時改寫到磁碟）
+        
+        不使用 SpooledTemporaryFile：它在 Python 3.11 之前不是 io.IOBase，
+        replicate.files.create 不接受；這裡返回的 BytesIO / TemporaryFile 都是一般檔案物件。
+        
+        Args:
+            message_id: 訊息 ID
+            
+        Returns:
+            tuple: (檔案物件（已移到開頭，呼叫端負責關閉）, 內容 SHA-256)
+        """
+        message_content = self.line_bot_api.get_message_content(message_id)
+        image_file = io.BytesIO()
+        digest = hashlib.sha256()
+        try:
+            for chunk in message_content.iter_content(chunk_size=IMAGE_DOWNLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+                image_file.write(chunk)
+                if isinstance(image_file, io.BytesIO) and image_file.tell() > IMAGE_SPOOL_MAX_BYTES:
+                    # 超過門檻後改寫到磁碟暫存檔
+                    disk_file = tempfile.TemporaryFile()
+                    disk_file.write(image_file.getvalue())
+                    image_file.close()
+                    image_file = disk_file
+            image_file.seek(0)
+        except Exception:
+            image_file.close()
+            raise
+        return image_file, digest.hexdigest()
+    
+    @contextmanager
+    def uploaded_image(self, image_file, model: str):
+        """
+        將圖片檔案串流上傳到 Replicate，產生模型輸入用的網址（取代 base64 data URL）
+        
+        有圖片前處理時先依模型縮小、轉正並重新編碼為 JPEG；上傳的格式依檔案內容判斷。
+        離開 with 區塊後刪除上傳的檔案（失敗只記錄）。
+        
+        Args:
+            image_file: 可讀取的檔案物件
+            model: 模型名稱（決定前處理的最長邊上限）
+            
+        Yields:
+            str: 上傳檔案的網址
+        """
+        if self.image_preprocessor is not None:
+            image_file = self.image_preprocessor.preprocess(image_file, model, self.image_max_edge)
+        content_type = guess_image_type(image_file)
+        extension = CONTENT_TYPES.get(content_type, "jpg")
+        image_file.seek(0)
+        uploaded = replicate.files.create(image_file, filename=f"input.{extension}", content_type=content_type)
+        try:
+            yield uploaded.urls["get"]
+        finally:
+            try:
+                replicate.files.delete(uploaded.id)
+            except Exception as e:
+                print(f"⚠️  刪除 Replicate 上傳檔案失敗: {str(e)}")
+    
+    def _lookup_cached_result(self, image_sha256: str, model: str, params: dict):
+        """查詢結果快取（沒有快取或查詢失敗時視為未命中，不影響工作本身）"""
+        if self.result_cache is None:
+            return None
+        try:
+            return self.result_cache.get(image_sha256, model, params)
+        except Exception as e:
+            print(f"⚠️  查詢 Replicate 結果快取失敗，視為未命中: {str(e)}")
+            return None
+    
+    def run_model(self, model: str, image_sha256: str, params: dict, compute):
+        """
+        執行 Replicate 模型，有結果快取時先查詢快取
+        
+        相同輸入（圖片、模型、參數）同時進行中的工作只執行一次，
+        其他請求等待並共用同一個輸出網址（single-flight）。
+        
+        Args:
+            model: 模型名稱
+            image_sha256: 輸入圖片的 SHA-256
+            params: 影響輸出的參數（提示詞等）
+            compute: 未命中時呼叫的函式，返回輸出網址
+            
+        Returns:
+            tuple: (輸出網址, 應扣除的點數)
+        """
+        cached_url = self._lookup_cached_result(image_sha256, model, params)
+        if cached_url:
+            print(f"⚡ 命中 Replicate 結果快取: {model}")
+            return cached_url, self.result_cache.charge_for_hit(self.required_points)
+        
+        def compute_and_store():
+            output_url = compute()
+            if self.result_cache is not None:
+                try:
+                    self.result_cache.put(image_sha256, model, params, output_url)
+                except Exception as e:
+                    # 已付費取得的輸出仍要送給用戶，快取寫入失敗只記錄
+                    print(f"⚠️  寫入 Replicate 結果快取失敗: {str(e)}")
+            return output_url
+        
+        if self.single_flight is None:
+            return compute_and_store(), self.required_points
+        # 取得跨程序鎖後再查一次快取：其他程序可能剛完成同一個工作
+        recheck = (lambda: self._lookup_cached_result(image_sha256, model, params)) if self.result_cache else None
+        output_url, shared = self.single_flight.do(
+            ResultCache.make_key(image_sha256, model, params), compute_and_store, recheck=recheck
+        )
+        if shared:
+            print(f"🔗 共用進行中的相同 Replicate 工作結果: {model}")
+            if self.result_cache is not None:
+                return output_url, self.result_cache.charge_for_hit(self.required_points)
+        return output_url, self.required_points
+    
+    def deliver_paid_result(self, user_id: str, messages, points: int, description: str, event: WebhookEvent = None):
+        """
+        扣除點數並送出付費功能的結果
+        
+        啟用 outbox 時，結果與扣點寫在同一個交易中，由 OutboxDispatcher 送達，
+        工作程序在送出前被回收也不會讓已付費的用戶收不到結果；
+        扣點失敗（或沒有會員服務）時仍直接推送結果。
+        
+        Args:
+            user_id: 用戶 ID
+            messages: 要推送的訊息
+            points: 要扣除的點數
+            description: 交易說明
+            event: WebhookEvent（用於判斷推送目標）
+            
+        Returns:
+            dict: Flask 回應或 None
+        """
+        if self.member_service and points > 0:
+            target_id = self.get_target_id(event) if event is not None else user_id
+            outbox = (target_id, messages) if self.use_outbox else None
+            if self.member_service.deduct_points(user_id, points, description, outbox=outbox):
+                if outbox is not None:
+                    print(f"📮 結果已寫入 outbox: {target_id}")
+                    return None
+            else:
+                print(f"⚠️ 扣點失敗，但圖片已處理完成: {user_id}")
+        # 已扣點的結果不合併推送，送出失敗時例外會傳回呼叫端
+        return self.publisher.process_push_message(user_id, messages, event, coalesce=False)
+    
+    def _get_context(self, user_id: str, event: WebhookEvent = None):
+        """取得屬於此用戶的 EventContext（背景執行緒等沒有 event 的情況返回 None）"""
+        if event is not None and event.context is not None and event.context.user_id == user_id:
+            return event.context
+        return None
     
-    def set_user_state(self, user_id: str, state: str, data: dict = None):
+    def set_user_state(self, user_id: str, state: str, data: dict = None, event: WebhookEvent = None):
         """設定用戶狀態"""
-        self.state_manager.set_state(user_id, {
+        new_state = {
             "feature": self.name, 
             "state": state,
             "data": data
-        })
+        }
+        context = self._get_context(user_id, event)
+        if context is not None:
+            context.set_state(new_state)
+        else:
+            self.state_manager.set_state(user_id, new_state)
     
-    def get_user_state(self, user_id: str) -> dict:
-        """獲取用戶狀態"""
+    def get_user_state(self, user_id: str, event: WebhookEvent = None) -> dict:
+        """獲取用戶狀態（有 event 時使用事件上下文中已載入的狀態）"""
+        context = self._get_context(user_id, event)
+        if context is not None:
+            return context.user_state
         return self.state_manager.get_state(user_id)
     
-    def clear_user_state(self, user_id: str):
+    def clear_user_state(self, user_id: str, event: WebhookEvent = None):
         """清除用戶狀態"""
-        self.state_manager.clear_state(user_id)
+        context = self._get_context(user_id, event)
+        if context is not None:
+            context.clear_state()
+        else:
+            self.state_manager.clear_state(user_id)
     
-    def is_user_in_state(self, user_id: str, state: str) -> bool:
+    def is_user_in_state(self, user_id: str, state: str, event: WebhookEvent = None) -> bool:
         """檢查用戶是否在特定狀態"""
-        user_state = self.get_user_state(user_id)
+        user_state = self.get_user_state(user_id, event)
         if not user_state:
             return False
         return (user_state.get("feature") == self.name and 
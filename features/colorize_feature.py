@@ -1,19 +1,35 @@
 import os
-import base64
-import tempfile
-import requests
 import replicate
-import threading
-import time
 from .base_feature import BaseFeature
+from webhook_event import WebhookEvent
+from services.job_scheduler import JobScheduler
+from services.single_flight import SingleFlight
 from linebot.models import TextSendMessage, ImageSendMessage, QuickReply, QuickReplyButton, MessageAction, Sender
 
 
 class ColorizeFeature(BaseFeature):
     """圖片彩色化功能處理器"""
     
-    def __init__(self, line_bot_api, publisher, state_manager, member_service=None):
+    commands = ("圖片彩色化",)
+    image_states = ("waiting",)
+    
+    # 上傳圖片後未完成的流程一小時後失效
+    state_ttl_seconds = 3600
+    # 上傳前縮小到的最長邊（可用 IMAGE_MAX_EDGE_<模型> 覆寫）
+    image_max_edge = 2048
+    
+    def __init__(self, line_bot_api, publisher, state_manager, member_service=None, job_scheduler=None,
+                 result_cache=None, single_flight=None,
+                 image_preprocessor=None):
         super().__init__(line_bot_api, publisher, state_manager, member_service)
+        # 彩色化在共用的背景工作排程器中執行（並行數與佇列長度有上限）
+        self.job_scheduler = job_scheduler or JobScheduler()
+        # 相同照片的彩色化結果快取（None 表示停用）
+        self.result_cache = result_cache
+        # 相同照片同時送出時只呼叫一次 Replicate
+        self.single_flight = single_flight or SingleFlight()
+        # 上傳前的圖片前處理（None 表示原圖上傳）
+        self.image_preprocessor = image_preprocessor
         # 設定 Replicate API token
         os.environ["REPLICATE_API_TOKEN"] = os.getenv("REPLICATE_API_TOKEN")
         self.replicate_model = "flux-kontext-apps/restore-image"
@@ -23,44 +39,12 @@ class ColorizeFeature(BaseFeature):
     def name(self) -> str:
         return "colorize"
     
-    def can_handle(self, message: str, user_id: str) -> bool:
-        """判斷是否能處理此訊息"""
-        # 處理彩色化相關的訊息
-        if message == "圖片彩色化":
-            return True
-        
-        # 檢查是否為全局命令（這些命令不應該被 colorize 攔截）
-        if self._is_global_command(message):
-            return False
-        
-        # 檢查用戶是否在彩色化狀態中
-        user_state = self.get_user_state(user_id)
-        if user_state and user_state.get("feature") == self.name:
-            return True
-        
-        return False
-    
-    def _is_global_command(self, message: str) -> bool:
-        """檢查是否為全局命令"""
-        message = message.strip()
-        global_commands = [
-            "點數", "點數查詢", "查看點數", "查詢點數",
-            "歷史", "交易記錄", "記錄",
-            "會員", "會員資訊",
-            "!功能", "功能", "！功能", "使用說明", "其他功能"
-        ]
-        if message in global_commands:
-            return True
-        if "點數" in message and ("查詢" in message or "查看" in message):
-            return True
-        return False
-    
-    def handle_text(self, event: dict) -> dict:
+    def handle_text(self, event: WebhookEvent) -> dict:
         """處理文字訊息"""
         user_id = self.get_user_id(event)
         reply_token = self.get_reply_token(event)
         message = self.get_message_text(event)
-        user_name = self.get_user_name(user_id)
+        user_name = self.get_user_name(event)
         
         try:
             if message == "圖片彩色化":
@@ -73,67 +57,48 @@ class ColorizeFeature(BaseFeature):
         
         return None
     
-    def handle_image(self, event: dict) -> dict:
+    def handle_image(self, event: WebhookEvent) -> dict:
         """處理圖片訊息"""
         user_id = self.get_user_id(event)
         reply_token = self.get_reply_token(event)
         message_id = self.get_message_id(event)
-        user_name = self.get_user_name(user_id)
+        user_name = self.get_user_name(event)
         
         print(f"收到圖片訊息，用戶 ID：{user_id}")
         
         # 檢查用戶是否在等待彩色化狀態
-        if not self.is_user_in_state(user_id, "waiting"):
+        if not self.is_user_in_state(user_id, "waiting", event):
             # 用戶沒有確認彩色化，靜默處理，不發送任何回覆
             print(f"用戶 {user_id} 上傳圖片但未確認彩色化功能，靜默處理")
             return None
         
+        image_file = None
         try:
             # 設定狀態為正在彩色化
-            self.set_user_state(user_id, "processing")
+            self.set_user_state(user_id, "processing", event=event)
             
-            # 1. 從 LINE 下載圖片
-            message_content = self.line_bot_api.get_message_content(message_id)
-            image_bytes = b''.join(chunk for chunk in message_content.iter_content())
+            # 1. 從 LINE 串流下載圖片到暫存檔（同時計算內容雜湊）
+            image_file, image_sha256 = self.download_message_content(message_id)
 
-            # 2. 先回覆用戶已收到圖片
-            result = self.publisher.process_reply_message(
-                reply_token,
-                TextSendMessage(text=f"{user_name}，我已經收到您的珍貴照片了！✨ 正在為您精心處理中，請稍候片刻 🌟"),
-                user_id,
-                event  # 傳遞 event 以支援群組聊天
-            )
-            if result:  # 如果回傳錯誤 JSON
-                return result
-            
-            # 3. 發送載入動畫
-            try:
-                self._start_loading_animation(user_id)
-            except Exception as e:
-                print(f"發送載入動畫失敗: {str(e)}")
-
-            # 4. 在背景執行彩色化處理
+            # 2. 背景彩色化處理
             def process_image_async():
                 try:
-                    output_url = self._colorize_image(image_bytes)
-                    
-                    # 扣除點數（如果有 member_service）
-                    if self.member_service:
-                        success = self.member_service.deduct_points(
-                            user_id, 
-                            self.required_points, 
-                            "彩色化圖片"
-                        )
-                        if not success:
-                            print(f"⚠️ 扣點失敗，但圖片已處理完成: {user_id}")
+                    output_url, points = self.run_model(
+                        self.replicate_model,
+                        image_sha256,
+                        {},
+                        lambda: self._colorize_image(image_file)
+                    )
                     
-                    # 回傳彩色圖片（載入動畫會自動停止）
-                    error_result = self.publisher.process_push_message(
+                    # 扣除點數並回傳彩色圖片（載入動畫會自動停止）
+                    error_result = self.deliver_paid_result(
                         user_id,
                         ImageSendMessage(
                             original_content_url=output_url,
                             preview_image_url=output_url
                         ),
+                        points,
+                        "彩色化圖片",
                         event  # 傳遞 event 以支援群組聊天
                     )
                     if error_result:
@@ -141,25 +106,44 @@ class ColorizeFeature(BaseFeature):
                         
                 except Exception as e:
                     # 回傳錯誤訊息（載入動畫會自動停止）
-                    error_result = self.publisher.process_push_message(
-                        user_id,
-                        TextSendMessage(text=f"處理圖片時發生錯誤: {str(e)}"),
-                        event  # 傳遞 event 以支援群組聊天
-                    )
-                    if error_result:
-                        print(f"背景處理時用戶無效，JSON 回應: {error_result}")
+                    self.push_notice(user_id, f"處理圖片時發生錯誤: {str(e)}", event)
                 finally:
-                    # 處理完成後清除用戶狀態
+                    # 處理完成後關閉暫存檔並清除用戶狀態
+                    image_file.close()
                     self.clear_user_state(user_id)
                     print(f"用戶 {user_id} 彩色化處理完成，狀態已重置")
 
-            # 啟動背景執行緒
-            thread = threading.Thread(target=process_image_async)
-            thread.start()
+            # 3. 交給共用的背景工作排程器並回覆用戶已收到圖片（滿載時請用戶稍後重新上傳）
+            queued, result = self.submit_job(process_image_async, lambda notice: self.publisher.process_reply_message(
+                reply_token,
+                TextSendMessage(text=f"{user_name}，我已經收到您的珍貴照片了！✨ 正在為您精心處理中，請稍候片刻 🌟{notice}"),
+                user_id,
+                event  # 傳遞 event 以支援群組聊天
+            ), on_start=lambda: self.push_notice(user_id, f"{user_name}，輪到您了！⏳ 開始處理您的圖片 ✨", event))
+            if not queued:
+                image_file.close()
+                self.set_user_state(user_id, "waiting", event=event)
+                return self.publisher.process_reply_message(
+                    reply_token,
+                    TextSendMessage(text=f"{user_name}，目前處理中的圖片太多了 🙏\n\n請稍等一下再重新上傳圖片。"),
+                    user_id,
+                    event
+                )
+            if result:  # 如果回傳錯誤 JSON（工作已取消）
+                image_file.close()
+                return result
+            
+            # 4. 發送載入動畫
+            try:
+                self._start_loading_animation(user_id)
+            except Exception as e:
+                print(f"發送載入動畫失敗: {str(e)}")
 
         except Exception as e:
-            # 發生錯誤時也要清除狀態
-            self.clear_user_state(user_id)
+            # 發生錯誤時也要關閉暫存檔並清除狀態（工作未排入或已取消）
+            if image_file is not None:
+                image_file.close()
+            self.clear_user_state(user_id, event)
             
             result = self.publisher.process_reply_message(
                 reply_token,
@@ -171,11 +155,11 @@ class ColorizeFeature(BaseFeature):
         
         return None
     
-    def _handle_colorize_request(self, reply_token: str, user_name: str, user_id: str, event: dict) -> dict:
+    def _handle_colorize_request(self, reply_token: str, user_name: str, user_id: str, event: WebhookEvent) -> dict:
         """處理彩色化請求"""
         # 檢查點數（如果有 member_service）
         if self.member_service:
-            member = self.member_service.get_or_create_member(user_id, user_name)
+            member = self.get_member(event, user_name)
             if member['points'] < self.required_points:
                 result = self.publisher.process_reply_message(
                     reply_token,
@@ -188,7 +172,7 @@ class ColorizeFeature(BaseFeature):
                 return result
         
         # 設定用戶狀態為等待圖片
-        self.set_user_state(user_id, "waiting")
+        self.set_user_state(user_id, "waiting", event=event)
         
         result = self.publisher.process_reply_message(
             reply_token,
@@ -201,51 +185,24 @@ class ColorizeFeature(BaseFeature):
         return result
     
     def _start_loading_animation(self, user_id: str):
-        """開始載入動畫"""
+        """開始載入動畫（經由共用連線池送出）"""
         try:
-            # 使用 LINE Bot API 的載入動畫功能
-            import requests
-            
-            # 構建請求 URL
-            url = "https://api.line.me/v2/bot/chat/loading/start"
-            
-            # 設定 headers
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {os.getenv("CHANNEL_ACCESS_TOKEN")}'
-            }
-            
-            # 設定載入動畫參數（5-60秒）
-            data = {
-                "chatId": user_id,
-                "loadingSeconds": 30  # 設定為30秒，通常足夠處理圖片
-            }
-            
-            # 發送請求
-            response = requests.post(url, headers=headers, json=data)
-            
-            if response.status_code == 200:
-                print(f"載入動畫已啟動，用戶: {user_id}")
-            else:
-                print(f"載入動畫啟動失敗: {response.status_code} - {response.text}")
-                
+            # 設定載入動畫秒數（5-60秒），通常足夠處理圖片
+            self.publisher.start_loading_animation(user_id, 30)
         except Exception as e:
             print(f"啟動載入動畫時發生錯誤: {str(e)}")
     
-    def _colorize_image(self, image_bytes: bytes) -> str:
-        """呼叫 Replicate 彩色化 API"""
+    def _colorize_image(self, image_file) -> str:
+        """呼叫 Replicate 彩色化 API（image_file 為下載的暫存檔）"""
         try:
-            # 將 bytes 轉換為 base64 格式
-            image_b64 = base64.b64encode(image_bytes).decode('utf-8')
-            image_data_url = f"data:image/jpeg;base64,{image_b64}"
-            
-            # 使用 Replicate Python SDK
-            output = replicate.run(
-                self.replicate_model,
-                input={
-                    "input_image": image_data_url,
-                }
-            )
+            # 以檔案串流上傳圖片，並使用 Replicate Python SDK
+            with self.uploaded_image(image_file, self.replicate_model) as image_url:
+                output = replicate.run(
+                    self.replicate_model,
+                    input={
+                        "input_image": image_url,
+                    }
+                )
             
             if output:
                 # 如果 output 是字串（URL），直接回傳
@@ -1,19 +1,39 @@
 import os
 import base64
-import tempfile
-import requests
 import replicate
-import threading
-import time
-from .base_feature import BaseFeature
+from .base_feature import BaseFeature, IMAGE_DOWNLOAD_CHUNK_SIZE
+from webhook_event import WebhookEvent
+from services.blob_store import BlobStore
+from services.job_scheduler import JobScheduler
+from services.single_flight import SingleFlight
 from linebot.models import TextSendMessage, ImageSendMessage, QuickReply, QuickReplyButton, MessageAction, Sender
 
 
 class EditFeature(BaseFeature):
     """圖片編輯功能處理器"""
     
-    def __init__(self, line_bot_api, publisher, state_manager, member_service=None):
+    commands = ("圖片編輯",)
+    image_states = ("waiting_image",)
+    
+    # 上傳圖片後未完成的流程一小時後失效
+    state_ttl_seconds = 3600
+    # 上傳前縮小到的最長邊（可用 IMAGE_MAX_EDGE_<模型> 覆寫）
+    image_max_edge = 1536
+    
+    def __init__(self, line_bot_api, publisher, state_manager, member_service=None, blob_store=None,
+                 job_scheduler=None, result_cache=None, single_flight=None,
+                 image_preprocessor=None):
         super().__init__(line_bot_api, publisher, state_manager, member_service)
+        # 圖片編輯在共用的背景工作排程器中執行（並行數與佇列長度有上限）
+        self.job_scheduler = job_scheduler or JobScheduler()
+        # 相同圖片與編輯描述的結果快取（None 表示停用）
+        self.result_cache = result_cache
+        # 相同圖片與編輯描述同時送出時只呼叫一次 Replicate
+        self.single_flight = single_flight or SingleFlight()
+        # 上傳前的圖片前處理（None 表示原圖上傳）
+        self.image_preprocessor = image_preprocessor
+        # 上傳的圖片存在 blob store，用戶狀態只保存內容雜湊鍵值
+        self.blob_store = blob_store or BlobStore()
         # 設定 Replicate API token
         os.environ["REPLICATE_API_TOKEN"] = os.getenv("REPLICATE_API_TOKEN")
         self.replicate_model = "google/nano-banana"
@@ -23,51 +43,19 @@ class EditFeature(BaseFeature):
     def name(self) -> str:
         return "edit"
     
-    def can_handle(self, message: str, user_id: str) -> bool:
-        """判斷是否能處理此訊息"""
-        # 處理圖片編輯相關的訊息
-        if message == "圖片編輯":
-            return True
-        
-        # 檢查是否為全局命令（這些命令不應該被 edit 攔截）
-        if self._is_global_command(message):
-            return False
-        
-        # 檢查用戶是否在圖片編輯狀態中
-        user_state = self.get_user_state(user_id)
-        if user_state and user_state.get("feature") == self.name:
-            return True
-        
-        return False
-    
-    def _is_global_command(self, message: str) -> bool:
-        """檢查是否為全局命令"""
-        message = message.strip()
-        global_commands = [
-            "點數", "點數查詢", "查看點數", "查詢點數",
-            "歷史", "交易記錄", "記錄",
-            "會員", "會員資訊",
-            "!功能", "功能", "！功能", "使用說明", "其他功能"
-        ]
-        if message in global_commands:
-            return True
-        if "點數" in message and ("查詢" in message or "查看" in message):
-            return True
-        return False
-    
-    def handle_text(self, event: dict) -> dict:
+    def handle_text(self, event: WebhookEvent) -> dict:
         """處理文字訊息"""
         user_id = self.get_user_id(event)
         reply_token = self.get_reply_token(event)
         message = self.get_message_text(event)
-        user_name = self.get_user_name(user_id)
+        user_name = self.get_user_name(event)
         
         try:
             if message == "圖片編輯":
                 return self._handle_edit_request(reply_token, user_name, user_id, event)
             
             # 檢查用戶是否在等待編輯描述狀態
-            if self.is_user_in_state(user_id, "waiting_description"):
+            if self.is_user_in_state(user_id, "waiting_description", event):
                 return self._handle_description_input(reply_token, user_name, user_id, message, event)
                 
         except Exception as e:
@@ -77,30 +65,30 @@ class EditFeature(BaseFeature):
         
         return None
     
-    def handle_image(self, event: dict) -> dict:
+    def handle_image(self, event: WebhookEvent) -> dict:
         """處理圖片訊息"""
         user_id = self.get_user_id(event)
         reply_token = self.get_reply_token(event)
         message_id = self.get_message_id(event)
-        user_name = self.get_user_name(user_id)
+        user_name = self.get_user_name(event)
         
         print(f"收到圖片訊息，用戶 ID：{user_id}")
         
         # 檢查用戶是否在等待圖片狀態
-        if not self.is_user_in_state(user_id, "waiting_image"):
+        if not self.is_user_in_state(user_id, "waiting_image", event):
             # 用戶沒有確認圖片編輯，靜默處理，不發送任何回覆
             print(f"用戶 {user_id} 上傳圖片但未確認圖片編輯功能，靜默處理")
             return None
         
         try:
-            # 1. 從 LINE 下載圖片並暫存
+            # 1. 從 LINE 下載圖片，逐塊寫入 blob store
             message_content = self.line_bot_api.get_message_content(message_id)
-            image_bytes = b''.join(chunk for chunk in message_content.iter_content())
+            image_key = self.blob_store.put(message_content.iter_content(chunk_size=IMAGE_DOWNLOAD_CHUNK_SIZE))
             
-            # 2. 設定狀態為等待編輯描述，同時保存圖片數據
+            # 2. 設定狀態為等待編輯描述，只保存圖片的 blob 鍵值
             self.set_user_state(user_id, "waiting_description", {
-                "image_data": base64.b64encode(image_bytes).decode('utf-8')
-            })
+                "image_key": image_key
+            }, event=event)
             
             # 3. 回覆用戶已收到圖片，請輸入編輯描述
             result = self.publisher.process_reply_message(
@@ -113,7 +101,7 @@ class EditFeature(BaseFeature):
 
         except Exception as e:
             # 發生錯誤時清除狀態
-            self.clear_user_state(user_id)
+            self.clear_user_state(user_id, event)
             
             result = self.publisher.process_reply_message(
                 reply_token,
@@ -125,11 +113,11 @@ class EditFeature(BaseFeature):
         
         return None
     
-    def _handle_edit_request(self, reply_token: str, user_name: str, user_id: str, event: dict) -> dict:
+    def _handle_edit_request(self, reply_token: str, user_name: str, user_id: str, event: WebhookEvent) -> dict:
         """處理圖片編輯請求"""
         # 檢查點數（如果有 member_service）
         if self.member_service:
-            member = self.member_service.get_or_create_member(user_id, user_name)
+            member = self.get_member(event, user_name)
             if member['points'] < self.required_points:
                 result = self.publisher.process_reply_message(
                     reply_token,
@@ -142,7 +130,7 @@ class EditFeature(BaseFeature):
                 return result
         
         # 設定用戶狀態為等待圖片
-        self.set_user_state(user_id, "waiting_image")
+        self.set_user_state(user_id, "waiting_image", event=event)
         
         result = self.publisher.process_reply_message(
             reply_token,
@@ -154,15 +142,19 @@ class EditFeature(BaseFeature):
         )
         return result
     
-    def _handle_description_input(self, reply_token: str, user_name: str, user_id: str, description: str, event: dict) -> dict:
+    def _handle_description_input(self, reply_token: str, user_name: str, user_id: str, description: str, event: WebhookEvent) -> dict:
         """處理編輯描述輸入"""
         try:
             # 獲取暫存的圖片數據
-            user_state = self.get_user_state(user_id)
-            image_data = user_state.get("data", {}).get("image_data") if user_state else None
+            user_state = self.get_user_state(user_id, event)
+            state_data = (user_state.get("data") or {}) if user_state else {}
+            image_key = state_data.get("image_key")
+            if not image_key and state_data.get("image_data"):
+                # 舊版狀態（圖片以 base64 存在狀態中）：轉存到 blob store
+                image_key = self.blob_store.put(base64.b64decode(state_data["image_data"]))
             
-            if not image_data:
-                self.clear_user_state(user_id)
+            if not image_key or not self.blob_store.exists(image_key):
+                self.clear_user_state(user_id, event)
                 return self.publisher.process_reply_message(
                     reply_token,
                     TextSendMessage(text="找不到您上傳的圖片，請重新開始圖片編輯流程。"),
@@ -170,29 +162,13 @@ class EditFeature(BaseFeature):
                     event  # 傳遞 event 以支援群組聊天
                 )
             
-            # 設定狀態為正在處理，保留圖片數據和描述
+            # 設定狀態為正在處理，保留圖片鍵值和描述
             self.set_user_state(user_id, "processing", {
-                "image_data": image_data,
+                "image_key": image_key,
                 "description": description
-            })
-            
-            # 1. 先回覆用戶已收到描述
-            result = self.publisher.process_reply_message(
-                reply_token,
-                TextSendMessage(text=f"{user_name}，我已經收到您的編輯需求！🎨\n\n編輯描述：「{description}」\n\n正在為您精心處理中，請稍候片刻 ✨"),
-                user_id,
-                event  # 傳遞 event 以支援群組聊天
-            )
-            if result:  # 如果回傳錯誤 JSON
-                return result
+            }, event=event)
             
-            # 2. 發送載入動畫
-            try:
-                self._start_loading_animation(user_id)
-            except Exception as e:
-                print(f"發送載入動畫失敗: {str(e)}")
-
-            # 3. 在背景執行圖片編輯處理
+            # 1. 背景圖片編輯處理
             def process_image_async():
                 try:
                     # 重新獲取狀態以確保數據完整
@@ -201,42 +177,35 @@ class EditFeature(BaseFeature):
                         print(f"用戶 {user_id} 狀態已清除，停止處理")
                         return
                     
-                    image_data = current_state.get("data", {}).get("image_data")
+                    image_key = current_state.get("data", {}).get("image_key")
                     description = current_state.get("data", {}).get("description")
                     
-                    if not image_data or not description:
-                        error_result = self.publisher.process_push_message(
-                            user_id,
-                            TextSendMessage(text="處理過程中遺失了圖片或描述資料，請重新開始。"),
-                            event  # 傳遞 event 以支援群組聊天
-                        )
-                        if error_result:
-                            print(f"背景處理時用戶無效，JSON 回應: {error_result}")
+                    if not image_key or not description or not self.blob_store.exists(image_key):
+                        self.push_notice(user_id, "處理過程中遺失了圖片或描述資料，請重新開始。", event)
                         return
                     
-                    # 將 base64 轉回 bytes
-                    image_bytes = base64.b64decode(image_data)
+                    def edit_stored_image():
+                        # 直接以 blob 檔案串流上傳並使用 Replicate API 處理
+                        with self.blob_store.open(image_key) as image_file:
+                            return self._edit_image(image_file, description)
                     
-                    # 使用 Replicate API 處理圖片
-                    output_url = self._edit_image(image_bytes, description)
-                    
-                    # 扣除點數（如果有 member_service）
-                    if self.member_service:
-                        success = self.member_service.deduct_points(
-                            user_id, 
-                            self.required_points, 
-                            f"圖片編輯：{description[:20]}"
-                        )
-                        if not success:
-                            print(f"⚠️ 扣點失敗，但圖片已處理完成: {user_id}")
+                    # blob 鍵值即為圖片的 SHA-256
+                    output_url, points = self.run_model(
+                        self.replicate_model,
+                        image_key,
+                        {"prompt": description, "output_format": "jpg"},
+                        edit_stored_image
+                    )
                     
-                    # 回傳編輯後的圖片（載入動畫會自動停止）
-                    error_result = self.publisher.process_push_message(
+                    # 扣除點數並回傳編輯後的圖片（載入動畫會自動停止）
+                    error_result = self.deliver_paid_result(
                         user_id,
                         ImageSendMessage(
                             original_content_url=output_url,
                             preview_image_url=output_url
                         ),
+                        points,
+                        f"圖片編輯：{description[:20]}",
                         event  # 傳遞 event 以支援群組聊天
                     )
                     if error_result:
@@ -244,25 +213,39 @@ class EditFeature(BaseFeature):
                         
                 except Exception as e:
                     # 回傳錯誤訊息（載入動畫會自動停止）
-                    error_result = self.publisher.process_push_message(
-                        user_id,
-                        TextSendMessage(text=f"處理圖片時發生錯誤: {str(e)}"),
-                        event  # 傳遞 event 以支援群組聊天
-                    )
-                    if error_result:
-                        print(f"背景處理時用戶無效，JSON 回應: {error_result}")
+                    self.push_notice(user_id, f"處理圖片時發生錯誤: {str(e)}", event)
                 finally:
                     # 處理完成後清除用戶狀態
                     self.clear_user_state(user_id)
                     print(f"用戶 {user_id} 圖片編輯處理完成，狀態已重置")
 
-            # 啟動背景執行緒
-            thread = threading.Thread(target=process_image_async)
-            thread.start()
+            # 2. 交給共用的背景工作排程器並回覆用戶已收到描述（滿載時保留圖片，請用戶稍後再送出描述）
+            queued, result = self.submit_job(process_image_async, lambda notice: self.publisher.process_reply_message(
+                reply_token,
+                TextSendMessage(text=f"{user_name}，我已經收到您的編輯需求！🎨\n\n編輯描述：「{description}」\n\n正在為您精心處理中，請稍候片刻 ✨{notice}"),
+                user_id,
+                event  # 傳遞 event 以支援群組聊天
+            ), on_start=lambda: self.push_notice(user_id, f"{user_name}，輪到您了！⏳ 開始處理您的圖片 ✨", event))
+            if not queued:
+                self.set_user_state(user_id, "waiting_description", {"image_key": image_key}, event=event)
+                return self.publisher.process_reply_message(
+                    reply_token,
+                    TextSendMessage(text=f"{user_name}，目前處理中的圖片太多了 🙏\n\n您的圖片已保留，請稍等一下再重新輸入編輯描述。"),
+                    user_id,
+                    event
+                )
+            if result:  # 如果回傳錯誤 JSON
+                return result
+            
+            # 3. 發送載入動畫
+            try:
+                self._start_loading_animation(user_id)
+            except Exception as e:
+                print(f"發送載入動畫失敗: {str(e)}")
 
         except Exception as e:
             # 發生錯誤時也要清除狀態
-            self.clear_user_state(user_id)
+            self.clear_user_state(user_id, event)
             
             result = self.publisher.process_reply_message(
                 reply_token,
@@ -275,61 +258,34 @@ class EditFeature(BaseFeature):
         return None
     
     def _start_loading_animation(self, user_id: str):
-        """開始載入動畫"""
+        """開始載入動畫（經由共用連線池送出）"""
         try:
-            # 使用 LINE Bot API 的載入動畫功能
-            import requests
-            
-            # 構建請求 URL
-            url = "https://api.line.me/v2/bot/chat/loading/start"
-            
-            # 設定 headers
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {os.getenv("CHANNEL_ACCESS_TOKEN")}'
-            }
-            
-            # 設定載入動畫參數（5-60秒）
-            data = {
-                "chatId": user_id,
-                "loadingSeconds": 45  # 圖片編輯可能需要更長時間
-            }
-            
-            # 發送請求
-            response = requests.post(url, headers=headers, json=data)
-            
-            if response.status_code == 200:
-                print(f"載入動畫已啟動，用戶: {user_id}")
-            else:
-                print(f"載入動畫啟動失敗: {response.status_code} - {response.text}")
-                
+            # 設定載入動畫秒數（5-60秒），圖片編輯可能需要更長時間
+            self.publisher.start_loading_animation(user_id, 45)
         except Exception as e:
             print(f"啟動載入動畫時發生錯誤: {str(e)}")
     
-    def _edit_image(self, image_bytes: bytes, description: str) -> str:
-        """呼叫 Replicate 圖片編輯 API"""
+    def _edit_image(self, image_file, description: str) -> str:
+        """呼叫 Replicate 圖片編輯 API（image_file 為 blob store 中的圖片檔案）"""
         try:
             print(f"🔍 開始處理圖片編輯...")
-            print(f"📊 圖片大小: {len(image_bytes)} bytes")
+            print(f"📊 圖片大小: {os.fstat(image_file.fileno()).st_size} bytes")
             print(f"📝 編輯描述: {description}")
             
-            # 將 bytes 轉換為 base64 格式
-            image_b64 = base64.b64encode(image_bytes).decode('utf-8')
-            image_data_url = f"data:image/jpeg;base64,{image_b64}"
-            
             print(f"🤖 呼叫模型: {self.replicate_model}")
             print("📡 正在發送請求到 Replicate API...")
             
-            # 使用 Replicate Python SDK 呼叫 google/nano-banana 模型
+            # 以檔案串流上傳圖片，並使用 Replicate Python SDK 呼叫 google/nano-banana 模型
             # 根據官方範例使用正確的參數格式
-            output = replicate.run(
-                self.replicate_model,
-                input={
-                    "prompt": description,
-                    "image_input": [image_data_url],  # 使用 image_input 而不是 image
-                    "output_format": "jpg"
-                }
-            )
+            with self.uploaded_image(image_file, self.replicate_model) as image_url:
+                output = replicate.run(
+                    self.replicate_model,
+                    input={
+                        "prompt": description,
+                        "image_input": [image_url],  # 使用 image_input 而不是 image
+                        "output_format": "jpg"
+                    }
+                )
             
             print(f"✅ API 回應類型: {type(output)}")
             print(f"📄 API 回應內容: {output}")
@@ -389,42 +345,3 @@ class EditFeature(BaseFeature):
                 raise Exception("輸入參數格式錯誤，請檢查圖片和描述格式")
             else:
                 raise Exception(f"圖片編輯處理失敗: {str(e)}")
-    
-    def _convert_base64_to_url(self, image_base64: str) -> str:
-        """將 Base64 圖片數據轉換為可訪問的 URL"""
-        try:
-            import uuid
-            import tempfile
-            import os
-            
-            # 生成唯一的圖片 ID
-            image_id = str(uuid.uuid4())
-            
-            # 將 Base64 轉回 bytes
-            image_bytes = base64.b64decode(image_base64)
-            
-            # 創建臨時文件
-            temp_dir = tempfile.gettempdir()
-            temp_filename = f"linebot_image_{image_id}.jpg"
-            temp_filepath = os.path.join(temp_dir, temp_filename)
-            
-            # 寫入圖片文件
-            with open(temp_filepath, 'wb') as f:
-                f.write(image_bytes)
-            
-            print(f"📁 臨時圖片已保存: {temp_filepath}")
-            
-            # 返回可訪問的 URL（需要配置 web server 提供靜態文件服務）
-            # 這裡暫時返回 file:// URL 用於測試
-            file_url = f"file://{temp_filepath}"
-            
-            # 實際部署時應該返回 HTTP URL，例如：
-            # server_url = os.getenv("SERVER_URL", "https://your-app.herokuapp.com")
-            # return f"{server_url}/temp/{temp_filename}"
-            
-            print(f"🔗 生成的圖片 URL: {file_url}")
-            return file_url
-            
-        except Exception as e:
-            print(f"❌ Base64 轉 URL 失敗: {str(e)}")
-            raise Exception(f"圖片 URL 轉換失敗: {str(e)}")
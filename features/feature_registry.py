@@ -1,123 +1,181 @@
-from typing import List, Optional
+import re
+import threading
+from collections import Counter
+from typing import List, Optional, Dict
 from .base_feature import BaseFeature
+from webhook_event import WebhookEvent
 
 
 class FeatureRegistry:
-    """功能註冊表，負責路由訊息到對應的功能處理器"""
+    """
+    功能註冊表，負責路由訊息到對應的功能處理器
     
-    # 全局命令：這些命令可以在任何功能狀態下被執行
-    GLOBAL_COMMANDS = [
+    註冊時把各功能宣告的指令編譯成 dict（完全比對）與單一正規表示式（關鍵字），
+    路由時只查一次用戶狀態，成本不隨功能數量增加。
+    優先順序：全局指令 / 關鍵字 → 用戶目前所在的功能 → 指令 → 關鍵字；
+    同一層中先註冊的功能優先。
+    """
+    
+    # 保留的全局命令：不論宣告這些命令的功能是否已註冊（例如沒有資料庫時不註冊會員功能），
+    # 都不會被交給用戶目前所在的功能（例如被圖片編輯當成編輯描述）
+    GLOBAL_COMMANDS = frozenset({
         "點數", "點數查詢", "查看點數", "查詢點數",
         "歷史", "交易記錄", "記錄",
         "會員", "會員資訊",
         "!功能", "功能", "！功能", "使用說明", "其他功能"
-    ]
+    })
+    # 保留的全局關鍵字：包含「點數」與「查詢」或「查看」的訊息
+    GLOBAL_KEYWORDS = re.compile(r"點數[\s\S]*(?:查詢|查看)|(?:查詢|查看)[\s\S]*點數")
     
     def __init__(self):
         self.features: List[BaseFeature] = []
+        self._features_by_name: Dict[str, BaseFeature] = {}
+        self._global_commands: Dict[str, BaseFeature] = {}
+        self._commands: Dict[str, BaseFeature] = {}
+        self._global_keyword_matcher = None
+        self._keyword_matcher = None
+        # (功能名稱, 狀態) -> 接受圖片的功能；_any_state_image_feature 為不限狀態的備援
+        self._image_handlers: Dict[tuple, BaseFeature] = {}
+        self._any_state_image_feature: Optional[BaseFeature] = None
+        self._stats_lock = threading.Lock()
+        self._images_routed = Counter()
+        self._images_unrouted = 0
     
     def register(self, feature: BaseFeature):
-        """註冊功能"""
+        """註冊功能並更新路由索引"""
         self.features.append(feature)
+        self._features_by_name.setdefault(feature.name, feature)
+        for command in feature.global_commands:
+            self._global_commands.setdefault(command, feature)
+        for command in feature.commands:
+            self._commands.setdefault(command, feature)
+        for state in feature.image_states:
+            if state == BaseFeature.ANY_STATE:
+                self._any_state_image_feature = self._any_state_image_feature or feature
+            else:
+                self._image_handlers.setdefault((feature.name, state), feature)
+        self._global_keyword_matcher = self._compile_keywords("global_keywords")
+        self._keyword_matcher = self._compile_keywords("keywords")
         print(f"已註冊功能: {feature.name}")
     
+    def _compile_keywords(self, attribute: str):
+        """
+        把所有功能的關鍵字合併成單一正規表示式
+        
+        每個功能是一個從開頭 lookahead 的具名群組，match() 依註冊順序嘗試，
+        lastgroup 即為第一個在訊息任意位置命中關鍵字的功能。
+        """
+        branches = []
+        for index, feature in enumerate(self.features):
+            patterns = getattr(feature, attribute)
+            if patterns:
+                alternatives = "|".join(f"(?:{pattern})" for pattern in patterns)
+                branches.append(f"(?P<f{index}>(?=[\\s\\S]*?(?:{alternatives})))")
+        return re.compile("|".join(branches)) if branches else None
+    
+    def _match_keyword(self, matcher, message: str) -> Optional[BaseFeature]:
+        if matcher is None:
+            return None
+        match = matcher.match(message)
+        if match is None:
+            return None
+        return self.features[int(match.lastgroup[1:])]
+    
     def get_feature_by_name(self, name: str) -> Optional[BaseFeature]:
         """根據名稱獲取功能"""
-        for feature in self.features:
-            if feature.name == name:
-                return feature
-        return None
+        return self._features_by_name.get(name)
     
-    def route_text_message(self, event: dict) -> dict:
+    def route_text_message(self, event: WebhookEvent) -> dict:
         """
         路由文字訊息到對應的功能處理器
         
         Args:
-            event: LINE webhook event
+            event: WebhookEvent
             
         Returns:
             dict: Flask 回應或 None
         """
-        user_id = event.get('source', {}).get('userId', '')
-        message = event.get('message', {}).get('text', '').strip()
+        message = event.text.strip()
         
-        # 檢查是否為全局命令
-        is_global_command = self._is_global_command(message)
+        # 1. 全局命令：不論用戶狀態，直接交給宣告的功能（不需要查詢用戶狀態）
+        feature = self._global_commands.get(message) or self._match_keyword(self._global_keyword_matcher, message)
+        if feature:
+            print(f"全局命令路由到功能: {feature.name}")
+            return feature.handle_text(event)
+        if message in self.GLOBAL_COMMANDS or self.GLOBAL_KEYWORDS.search(message):
+            # 保留的全局命令 / 關鍵字但對應功能未註冊：不交給用戶目前所在的功能
+            print(f"全局命令沒有已註冊的功能處理: {message}")
+            return None
         
-        # 1. 如果是全局命令，直接尋找能處理此訊息的功能（跳過用戶狀態檢查）
-        if is_global_command:
-            for feature in self.features:
-                if feature.can_handle(message, user_id):
-                    print(f"全局命令路由到功能: {feature.name}")
-                    return feature.handle_text(event)
-        
-        # 2. 如果不是全局命令，首先檢查用戶是否有特定功能的狀態
-        user_state = self._get_user_state(user_id)
+        # 2. 用戶有特定功能的狀態時，交給該功能處理（整個事件只查詢一次狀態）
+        user_state = self._get_user_state(event)
         if user_state and user_state.get("feature"):
             feature_name = user_state.get("feature")
             feature = self.get_feature_by_name(feature_name)
-            if feature and feature.can_handle(message, user_id):
+            if feature:
                 print(f"根據用戶狀態路由到功能: {feature_name}")
                 return feature.handle_text(event)
         
-        # 3. 如果沒有狀態或狀態中的功能無法處理，則尋找能處理此訊息的功能
-        for feature in self.features:
-            if feature.can_handle(message, user_id):
-                print(f"路由到功能: {feature.name}")
-                return feature.handle_text(event)
+        # 3. 完全比對的指令，其次是關鍵字
+        feature = self._commands.get(message) or self._match_keyword(self._keyword_matcher, message)
+        if feature:
+            print(f"路由到功能: {feature.name}")
+            return feature.handle_text(event)
         
         # 4. 沒有功能能處理此訊息
         print(f"沒有功能能處理訊息: {message}")
         return None
     
-    def route_image_message(self, event: dict) -> dict:
+    def route_image_message(self, event: WebhookEvent) -> dict:
         """
         路由圖片訊息到對應的功能處理器
         
         Args:
-            event: LINE webhook event
+            event: WebhookEvent
             
         Returns:
             dict: Flask 回應或 None
         """
-        user_id = event.get('source', {}).get('userId', '')
+        # 1. 依已載入的用戶狀態直接選出宣告接受圖片的功能
+        user_state = self._get_user_state(event)
+        feature = None
+        if user_state:
+            feature = self._image_handlers.get((user_state.get("feature"), user_state.get("state")))
+        if feature:
+            print(f"根據用戶狀態路由圖片到功能: {feature.name}")
         
-        # 1. 首先檢查用戶是否有特定功能的狀態
-        user_state = self._get_user_state(user_id)
-        if user_state and user_state.get("feature"):
-            feature_name = user_state.get("feature")
-            feature = self.get_feature_by_name(feature_name)
-            if feature:
-                print(f"根據用戶狀態路由圖片到功能: {feature_name}")
-                return feature.handle_image(event)
+        # 2. 沒有對應狀態時交給不限狀態的功能
+        elif self._any_state_image_feature:
+            feature = self._any_state_image_feature
+            print(f"路由圖片到功能: {feature.name}")
         
-        # 2. 如果沒有狀態，則尋找能處理圖片的功能
-        for feature in self.features:
-            if hasattr(feature, 'handle_image') and feature.handle_image(event) is not None:
-                print(f"路由圖片到功能: {feature.name}")
-                return feature.handle_image(event)
+        # 3. 沒有功能能處理此圖片（不試探呼叫任何功能）
+        if feature is None:
+            with self._stats_lock:
+                self._images_unrouted += 1
+            print(f"沒有功能能處理圖片訊息")
+            return None
         
-        # 3. 沒有功能能處理此圖片
-        print(f"沒有功能能處理圖片訊息")
-        return None
+        with self._stats_lock:
+            self._images_routed[feature.name] += 1
+        return feature.handle_image(event)
     
-    def _is_global_command(self, message: str) -> bool:
-        """檢查訊息是否為全局命令"""
-        message = message.strip()
-        # 完全匹配
-        if message in self.GLOBAL_COMMANDS:
-            return True
-        # 包含關鍵字的命令
-        if "點數" in message and ("查詢" in message or "查看" in message):
-            return True
-        return False
-    
-    def _get_user_state(self, user_id: str) -> dict:
-        """獲取用戶狀態（需要從第一個功能中獲取 state_manager）"""
+    def _get_user_state(self, event: WebhookEvent) -> dict:
+        """獲取用戶狀態（優先使用事件上下文，否則從第一個功能中獲取 state_manager）"""
+        if event.context is not None:
+            return event.context.user_state
         if self.features:
-            return self.features[0].get_user_state(user_id)
+            return self.features[0].get_user_state(event.user_id)
         return None
     
+    def get_stats(self) -> dict:
+        """取得圖片路由統計"""
+        with self._stats_lock:
+            return {
+                "images_routed": dict(self._images_routed),
+                "images_unrouted": self._images_unrouted,
+            }
+    
     def get_all_features(self) -> List[BaseFeature]:
         """獲取所有註冊的功能"""
         return self.features.copy()
@@ -1,39 +1,26 @@
 from features.base_feature import BaseFeature
+from webhook_event import WebhookEvent
 from datetime import datetime
 
 
 class MemberFeature(BaseFeature):
     """會員功能 - 提供點數查詢、交易記錄等功能"""
     
+    commands = ("點數", "歷史", "會員資訊", "會員")
+    keywords = (r"歷史|交易記錄|記錄", r"會員")
+    global_commands = ("點數", "點數查詢", "查看點數", "查詢點數", "歷史", "交易記錄", "記錄", "會員", "會員資訊")
+    global_keywords = (r"點數.*(?:查詢|查看)|(?:查詢|查看).*點數",)
+    
     @property
     def name(self) -> str:
         return "member"
     
-    def can_handle(self, message: str, user_id: str) -> bool:
-        """判斷是否能處理此訊息"""
-        message = message.strip()
-        
-        # 完全匹配的指令
-        exact_commands = ["點數", "歷史", "會員資訊", "會員"]
-        if message in exact_commands:
-            return True
-        
-        # 包含關鍵字的指令（支援更靈活的輸入）
-        if "點數" in message and ("查詢" in message or "查看" in message or message == "點數"):
-            return True
-        if "歷史" in message or "交易記錄" in message or "記錄" in message:
-            return True
-        if "會員" in message:
-            return True
-        
-        return False
-    
-    def handle_text(self, event: dict) -> dict:
+    def handle_text(self, event: WebhookEvent) -> dict:
         """處理文字訊息"""
         user_id = self.get_user_id(event)
         reply_token = self.get_reply_token(event)
         message = self.get_message_text(event).strip()
-        user_name = self.get_user_name(user_id)
+        user_name = self.get_user_name(event)
         
         # 點數相關查詢
         if message == "點數" or ("點數" in message and ("查詢" in message or "查看" in message)):
@@ -47,11 +34,11 @@ class MemberFeature(BaseFeature):
         
         return None
     
-    def _handle_points_query(self, user_id: str, user_name: str, reply_token: str, event: dict):
+    def _handle_points_query(self, user_id: str, user_name: str, reply_token: str, event: WebhookEvent):
         """處理點數查詢"""
         try:
             # 使用統一的會員服務獲取或建立會員
-            member = self.member_service.get_or_create_member(user_id, user_name)
+            member = self.get_member(event, user_name)
             
             if not member:
                 self.publisher.reply_text(reply_token, "❌ 無法取得會員資料，請稍後再試", user_id, event)
@@ -99,11 +86,11 @@ class MemberFeature(BaseFeature):
             self.publisher.reply_text(reply_token, "❌ 查詢失敗，請稍後再試", user_id, event)
             return "OK"
     
-    def _handle_history_query(self, user_id: str, user_name: str, reply_token: str, event: dict):
+    def _handle_history_query(self, user_id: str, user_name: str, reply_token: str, event: WebhookEvent):
         """處理交易記錄查詢"""
         try:
             # 使用統一的會員服務獲取或建立會員
-            member = self.member_service.get_or_create_member(user_id, user_name)
+            member = self.get_member(event, user_name)
             
             if not member:
                 self.publisher.reply_text(reply_token, "❌ 無法取得會員資料，請稍後再試", user_id, event)
@@ -165,11 +152,11 @@ class MemberFeature(BaseFeature):
             self.publisher.reply_text(reply_token, "❌ 查詢失敗，請稍後再試", user_id, event)
             return "OK"
     
-    def _handle_member_info(self, user_id: str, user_name: str, reply_token: str, event: dict):
+    def _handle_member_info(self, user_id: str, user_name: str, reply_token: str, event: WebhookEvent):
         """處理會員資訊查詢"""
         try:
             # 使用統一的會員服務獲取或建立會員
-            member = self.member_service.get_or_create_member(user_id, user_name)
+            member = self.get_member(event, user_name)
             
             if not member:
                 self.publisher.reply_text(reply_token, "❌ 無法取得會員資料，請稍後再試", user_id, event)
@@ -1,25 +1,24 @@
 from .base_feature import BaseFeature
+from webhook_event import WebhookEvent
 from linebot.models import TextSendMessage, QuickReply, QuickReplyButton, MessageAction
 
 
 class MenuFeature(BaseFeature):
     """功能選單處理器"""
     
+    commands = ("!功能", "功能", "！功能", "使用說明", "其他功能")
+    global_commands = commands
+    
     @property
     def name(self) -> str:
         return "menu"
     
-    def can_handle(self, message: str, user_id: str) -> bool:
-        """處理功能選單相關的訊息"""
-        menu_commands = ["!功能", "功能", "！功能", "使用說明", "其他功能"]
-        return message in menu_commands
-    
-    def handle_text(self, event: dict) -> dict:
+    def handle_text(self, event: WebhookEvent) -> dict:
         """處理文字訊息"""
         user_id = self.get_user_id(event)
         reply_token = self.get_reply_token(event)
         message = self.get_message_text(event)
-        user_name = self.get_user_name(user_id)
+        user_name = self.get_user_name(event)
         
         try:
             if message in ["!功能", "功能", "！功能"]:
@@ -36,7 +35,7 @@ class MenuFeature(BaseFeature):
         
         return None
     
-    def _handle_main_menu(self, reply_token: str, user_name: str, user_id: str, event: dict) -> dict:
+    def _handle_main_menu(self, reply_token: str, user_name: str, user_id: str, event: WebhookEvent) -> dict:
         """處理主功能選單"""
         quick_reply_buttons = [
             QuickReplyButton(action=MessageAction(label="📸 圖片彩色化", text="圖片彩色化")),
@@ -58,7 +57,7 @@ class MenuFeature(BaseFeature):
         )
         return result
     
-    def _handle_help(self, reply_token: str, user_name: str, user_id: str, event: dict) -> dict:
+    def _handle_help(self, reply_token: str, user_name: str, user_id: str, event: WebhookEvent) -> dict:
         """處理使用說明"""
         help_message = f"""{user_name} 你好！✨
 ❓ 使用說明
@@ -95,7 +94,7 @@ class MenuFeature(BaseFeature):
         )
         return result
     
-    def _handle_other_features(self, reply_token: str, user_name: str, user_id: str, event: dict) -> dict:
+    def _handle_other_features(self, reply_token: str, user_name: str, user_id: str, event: WebhookEvent) -> dict:
         """處理其他功能說明"""
         result = self.publisher.process_reply_message(
             reply_token,
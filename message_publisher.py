@@ -1,3 +1,4 @@
+import json
 import time
 import requests
 from flask import jsonify
@@ -7,42 +8,82 @@ from linebot.exceptions import LineBotApiError
 class MessagePublisher:
     """統一的訊息發送器，負責用戶驗證和訊息發送"""
     
-    def __init__(self, line_bot_api):
+    def __init__(self, line_bot_api, profile_cache=None, push_coalescer=None):
         self.line_bot_api = line_bot_api
+        self.profile_cache = profile_cache
+        self.push_coalescer = push_coalescer
+    
+    def get_profile(self, user_id):
+        """取得用戶 profile（有設定 ProfileCache 時經由快取）"""
+        if self.profile_cache is not None:
+            return self.profile_cache.get_profile(user_id)
+        return self.line_bot_api.get_profile(user_id)
+    
+    def start_loading_animation(self, chat_id, loading_seconds=30):
+        """
+        顯示載入動畫（與 LineBotApi 共用同一個 HTTP 連線池）
+        
+        Args:
+            chat_id (str): 要顯示動畫的聊天 ID（目前僅支援個人聊天）
+            loading_seconds (int): 動畫秒數（5-60 秒）
+        
+        Returns:
+            bool: 是否成功啟動
+        """
+        response = self.line_bot_api.http_client.post(
+            self.line_bot_api.endpoint + '/v2/bot/chat/loading/start',
+            headers=self.line_bot_api.headers,
+            data=json.dumps({"chatId": chat_id, "loadingSeconds": loading_seconds})
+        )
+        if response.status_code in (200, 202):
+            print(f"載入動畫已啟動，用戶: {chat_id}")
+            return True
+        print(f"載入動畫啟動失敗: {response.status_code} - {response.text}")
+        return False
     
     def _get_source_type(self, event):
         """
         檢測訊息來源類型
         
         Args:
-            event: LINE webhook event
+            event: WebhookEvent
             
         Returns:
-            str: 'user', 'group', 'room' 或 'unknown'
+            str: 'user', 'group' 或 'room'
         """
-        source = event.get('source', {})
-        source_type = source.get('type', 'unknown')
-        return source_type
+        return event.source_type
     
     def _is_group_chat(self, event):
         """
         判斷是否為群組聊天
         
         Args:
-            event: LINE webhook event
+            event: WebhookEvent
             
         Returns:
             bool: True 如果是群組聊天，False 如果是個人聊天
         """
-        source_type = self._get_source_type(event)
-        return source_type in ['group', 'room']
+        return event.is_group_chat
     
-    def _is_valid_user(self, user_id):
+    def _get_profile(self, user_id, event=None):
+        """
+        取得用戶 profile（同一事件的 EventContext 已載入時直接使用）
+        
+        Args:
+            user_id (str): LINE userId
+            event: WebhookEvent（可選）
+        """
+        if event is not None and event.context is not None and event.context.user_id == user_id:
+            return event.context.get_profile()
+        return self.get_profile(user_id)
+    
+    def _is_valid_user(self, user_id, event=None):
         """
         驗證 LINE userId 是否有效
         
         Args:
             user_id (str): 要驗證的 LINE userId
+            event: WebhookEvent（可選，用於共用同一事件已取得的 profile）
         
         Returns:
             dict: 驗證結果，包含以下欄位：
@@ -75,7 +116,7 @@ class MessagePublisher:
             }
         try:
             # 使用 get_profile 方法驗證用戶是否存在且已加為好友
-            profile = self.line_bot_api.get_profile(user_id)
+            profile = self._get_profile(user_id, event)
             
             # 如果成功獲取到 profile，表示 userId 有效且用戶已加 Bot 為好友
             user_info = {
@@ -110,11 +151,13 @@ class MessagePublisher:
                     "reason": "無權限獲取用戶資訊，可能是 Bot 未被用戶加為好友",
                     "error_code": "PERMISSION_DENIED"
                 }
-            elif status_code == 429:
+            elif status_code == 429 or (status_code is not None and status_code >= 500):
+                # 限流或 LINE 暫時性錯誤（已在 HTTP 層重試過）無法代表用戶無效，
+                # 視為有效以免對真實用戶回傳測試用 JSON
                 return {
-                    "is_valid": False,
-                    "reason": "API 呼叫頻率過高，請稍後再試",
-                    "error_code": "RATE_LIMIT_EXCEEDED"
+                    "is_valid": True,
+                    "reason": "LINE API 暫時無法驗證用戶，視為有效",
+                    "error_code": "RATE_LIMIT_EXCEEDED" if status_code == 429 else f"LINE_API_ERROR_{status_code}"
                 }
             else:
                 return {
@@ -190,7 +233,7 @@ class MessagePublisher:
             reply_token: LINE 回覆 token
             messages: 要發送的訊息
             user_id: 用戶 ID
-            event: LINE webhook event（用於判斷是否為群組聊天）
+            event: WebhookEvent（用於判斷是否為群組聊天）
         
         Returns:
             Flask Response: 包含純訊息的 JSON 回應或 None（表示正常處理）
@@ -202,7 +245,7 @@ class MessagePublisher:
             return None
         
         # 個人聊天才進行用戶驗證
-        validation_result = self._is_valid_user(user_id)
+        validation_result = self._is_valid_user(user_id, event)
         print(f"驗證結果: {validation_result}")
         if not validation_result['is_valid']:
             # invalid user (unit test)：回傳純訊息 JSON
@@ -219,23 +262,14 @@ class MessagePublisher:
         獲取正確的目標ID（用於推送訊息）
         
         Args:
-            event: LINE webhook event
+            event: WebhookEvent
             
         Returns:
             str: 群組ID（群組聊天）或用戶ID（個人聊天）
         """
         if not event:
             return None
-            
-        source = event.get('source', {})
-        source_type = source.get('type', 'user')
-        
-        if source_type == 'group':
-            return source.get('groupId', '')
-        elif source_type == 'room':
-            return source.get('roomId', '')
-        else:  # source_type == 'user'
-            return source.get('userId', '')
+        return event.target_id
     
     def reply_text(self, reply_token, text, user_id=None, event=None):
         """
@@ -245,7 +279,7 @@ class MessagePublisher:
             reply_token: LINE 回覆 token
             text: 要回覆的文字內容
             user_id: 用戶 ID（用於驗證）
-            event: LINE webhook event（用於判斷是否為群組聊天）
+            event: WebhookEvent（用於判斷是否為群組聊天）
         
         Returns:
             Flask Response: 包含純訊息的 JSON 回應或 None（表示正常處理）
@@ -253,32 +287,50 @@ class MessagePublisher:
         from linebot.models import TextSendMessage
         return self.process_reply_message(reply_token, TextSendMessage(text=text), user_id, event)
     
-    def process_push_message(self, user_id, messages, event=None):
+    def _push(self, target_id, messages, coalesce: bool = True):
+        """
+        送出推送訊息（有設定 PushCoalescer 且 coalesce 時合併同一目標的短時間內推送）
+        
+        Returns:
+            Future: 合併推送的送出結果；直接送出時返回 None（失敗時直接拋出例外）
+        """
+        if self.push_coalescer is None:
+            self.line_bot_api.push_message(target_id, messages)
+            return None
+        if coalesce:
+            return self.push_coalescer.push(target_id, messages)
+        # 不合併的推送仍經由同一目標的送出順序，排在已緩衝的提示之後；等待送出完成以拋出例外
+        self.push_coalescer.send_now(target_id, messages).result()
+        return None
+    
+    def process_push_message(self, user_id, messages, event=None, coalesce: bool = True):
         """
         處理推送訊息，包含用戶驗證和 Flask 回應
         
         Args:
             user_id: 用戶 ID（個人聊天使用）
             messages: 要發送的訊息
-            event: LINE webhook event（用於判斷是否為群組聊天）
+            event: WebhookEvent（用於判斷是否為群組聊天）
+            coalesce: 是否允許合併推送；提示類訊息使用預設的 True，
+                      呼叫端需要依結果處理的推送（付費結果）設為 False，送出後才返回，失敗時拋出例外
         
         Returns:
-            Flask Response: 包含純訊息的 JSON 回應或 None（表示正常處理）
+            Future: 合併推送時返回送出結果（送出失敗時 exception() 為失敗原因）
+            Flask Response: invalid user 時包含純訊息的 JSON 回應
+            None: 直接送出完成
         """
         # 如果是群組聊天，跳過用戶驗證，使用群組ID推送訊息
         if event and self._is_group_chat(event):
             target_id = self._get_target_id(event)
             print(f"群組聊天，跳過用戶驗證，直接推送訊息到: {target_id}")
-            self.line_bot_api.push_message(target_id, messages)
-            return None
+            return self._push(target_id, messages, coalesce)
         
         # 個人聊天才進行用戶驗證
-        validation_result = self._is_valid_user(user_id)
+        validation_result = self._is_valid_user(user_id, event)
         if not validation_result['is_valid']:
             # invalid user (unit test)：回傳純訊息 JSON
             json_response = self._create_json_response(user_id, messages)
             return jsonify(json_response)
         
         # valid user：直接使用 LINE Bot API
-        self.line_bot_api.push_message(user_id, messages)
-        return None  # 表示正常處理，不需要特殊回應
+        return self._push(user_id, messages, coalesce)  # Future 或 None（表示正常處理）
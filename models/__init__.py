@@ -2,6 +2,9 @@ from models.database import Base, get_session, init_database
 from models.member import Member
 from models.point_transaction import PointTransaction
 from models.user_state import UserState
+from models.processed_event import ProcessedEvent
+from models.outbox_message import OutboxMessage
+from models.replicate_result import ReplicateResult
 
-__all__ = ['Base', 'get_session', 'init_database', 'Member', 'PointTransaction', 'UserState']
+__all__ = ['Base', 'get_session', 'init_database', 'Member', 'PointTransaction', 'UserState', 'ProcessedEvent', 'OutboxMessage', 'ReplicateResult']
 
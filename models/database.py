@@ -11,16 +11,31 @@ _engine = None
 _SessionFactory = None
 
 
-def init_database():
-    """初始化資料庫連線"""
+def init_database(database_url=None):
+    """
+    初始化資料庫連線
+    
+    Args:
+        database_url: 資料庫 URL（預設讀取 DATABASE_URL；sqlite:// 可用於本機測試與效能比較）
+    """
     global _engine, _SessionFactory
     
-    database_url = os.getenv("DATABASE_URL")
+    database_url = database_url or os.getenv("DATABASE_URL")
     if not database_url:
         raise ValueError("DATABASE_URL 環境變數未設定")
     
     print(f"🗄️  連接資料庫...")
     
+    if database_url.startswith("sqlite"):
+        _engine = create_engine(
+            database_url,
+            connect_args={"check_same_thread": False, "timeout": 30},
+            echo=False
+        )
+        _SessionFactory = sessionmaker(bind=_engine)
+        print("✅ 資料庫連線初始化完成")
+        return _engine
+    
     # 建立 engine，優化連線設定
     _engine = create_engine(
         database_url,
@@ -0,0 +1,63 @@
+import json
+from sqlalchemy import Column, Integer, String, DateTime, Text, func, Index
+from models.database import Base
+
+
+class OutboxMessage(Base):
+    """
+    待推送訊息（transactional outbox）
+
+    與扣點寫在同一個交易中，確保「已扣點」與「待送出的結果」同時成立；
+    由 OutboxDispatcher 批次取出送出，工作程序重啟後仍會繼續送達。
+    """
+    __tablename__ = 'outbox_messages'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True, comment='訊息 ID')
+    target_id = Column(String(50), nullable=False, comment='推送目標（userId / groupId / roomId）')
+    payload = Column(Text, nullable=False, comment='LINE 訊息內容（JSON 陣列）')
+    status = Column(String(20), nullable=False, default='pending', comment='狀態 (pending, sent, dead)')
+    attempts = Column(Integer, nullable=False, default=0, comment='已嘗試次數')
+    last_error = Column(Text, nullable=True, comment='最後一次錯誤')
+    available_at = Column(DateTime, server_default=func.now(), nullable=False, comment='可被取出的時間（租約 / 重試退避）')
+    created_at = Column(DateTime, server_default=func.now(), nullable=False, comment='建立時間')
+    sent_at = Column(DateTime, nullable=True, comment='送出時間')
+    
+    # 依狀態與順序取出待送訊息；依送出時間清理已送出的記錄
+    __table_args__ = (
+        Index('idx_outbox_status_available', 'status', 'available_at', 'id'),
+        Index('idx_outbox_status_sent_at', 'status', 'sent_at'),
+    )
+    
+    @classmethod
+    def create(cls, target_id, messages):
+        """
+        由 LINE 訊息物件建立 outbox 記錄
+        
+        Args:
+            target_id: 推送目標 ID
+            messages: 單一 SendMessage 或列表（最多 5 則）
+        """
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        return cls(
+            target_id=target_id,
+            payload=json.dumps([message.as_json_dict() for message in messages], ensure_ascii=False),
+            status='pending',
+            attempts=0
+        )
+    
+    def __repr__(self):
+        return f"<OutboxMessage(id={self.id}, target_id='{self.target_id}', status='{self.status}')>"
+    
+    def to_dict(self):
+        """轉換為字典格式"""
+        return {
+            'id': self.id,
+            'target_id': self.target_id,
+            'messages': json.loads(self.payload),
+            'status': self.status,
+            'attempts': self.attempts,
+            'last_error': self.last_error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'sent_at': self.sent_at.isoformat() if self.sent_at else None,
+        }
@@ -0,0 +1,18 @@
+from sqlalchemy import Column, String, DateTime, func, Index
+from models.database import Base
+
+
+class ProcessedEvent(Base):
+    """已處理的 webhook 事件（用於多節點的重複事件過濾）"""
+    __tablename__ = 'processed_events'
+    
+    webhook_event_id = Column(String(64), primary_key=True, comment='LINE webhookEventId')
+    created_at = Column(DateTime, server_default=func.now(), nullable=False, comment='處理時間')
+    
+    # 依時間清理過期記錄
+    __table_args__ = (
+        Index('idx_processed_events_created_at', 'created_at'),
+    )
+    
+    def __repr__(self):
+        return f"<ProcessedEvent(webhook_event_id='{self.webhook_event_id}')>"
@@ -0,0 +1,47 @@
+import json
+from sqlalchemy import Column, Integer, String, DateTime, Text, func, Index
+from models.database import Base
+
+
+class ReplicateResult(Base):
+    """
+    Replicate 結果快取索引
+
+    以（輸入圖片 SHA-256、模型、參數）為鍵值，記錄輸出圖片在本機 blob store 中的鍵值；
+    相同的圖片與指令再次送出時直接回傳快取的結果，不再呼叫 replicate.run。
+    """
+    __tablename__ = 'replicate_results'
+
+    cache_key = Column(String(64), primary_key=True, comment='快取鍵值（輸入雜湊 + 模型 + 參數的 SHA-256）')
+    image_sha256 = Column(String(64), nullable=False, comment='輸入圖片 SHA-256')
+    model = Column(String(100), nullable=False, comment='Replicate 模型名稱')
+    params = Column(Text, nullable=True, comment='模型參數（JSON）')
+    blob_key = Column(String(64), nullable=False, comment='輸出圖片在 blob store 中的鍵值')
+    extension = Column(String(10), nullable=False, default='jpg', comment='輸出圖片副檔名')
+    size_bytes = Column(Integer, nullable=False, default=0, comment='輸出圖片大小')
+    hits = Column(Integer, nullable=False, default=0, comment='命中次數')
+    created_at = Column(DateTime, server_default=func.now(), nullable=False, comment='建立時間')
+    last_hit_at = Column(DateTime, nullable=True, comment='最後命中時間')
+
+    # 依建立時間淘汰過期結果
+    __table_args__ = (
+        Index('idx_replicate_results_created_at', 'created_at'),
+    )
+
+    def __repr__(self):
+        return f"<ReplicateResult(cache_key='{self.cache_key}', model='{self.model}', hits={self.hits})>"
+
+    def to_dict(self):
+        """轉換為字典格式"""
+        return {
+            'cache_key': self.cache_key,
+            'image_sha256': self.image_sha256,
+            'model': self.model,
+            'params': json.loads(self.params) if self.params else None,
+            'blob_key': self.blob_key,
+            'extension': self.extension,
+            'size_bytes': self.size_bytes,
+            'hits': self.hits,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'last_hit_at': self.last_hit_at.isoformat() if self.last_hit_at else None,
+        }
@@ -0,0 +1,132 @@
+"""
+用戶狀態儲存後端效能比較
+對 memory / sqlite / database 後端執行 get / set / clear，比較延遲與吞吐量
+
+使用方式:
+    python scripts/benchmark_state_store.py [--ops 2000] [--threads 1] [--backends memory,sqlite,database]
+    
+範例:
+    python scripts/benchmark_state_store.py                         # 比較所有可用後端
+    python scripts/benchmark_state_store.py --threads 8 --ops 5000  # 多執行緒並行
+"""
+
+import os
+import sys
+import time
+import tempfile
+import argparse
+import threading
+
+# 將專案根目錄加入 Python 路徑
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+from services.state_store import MemoryStateStore, SqliteStateStore, DatabaseStateStore
+
+
+def percentile(values, pct):
+    """計算百分位數（values 需已排序）"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def run_operation(store, operation, user_ids, threads):
+    """
+    並行執行單一操作並收集每次呼叫的延遲
+    
+    Returns:
+        tuple: (延遲列表（毫秒）, 總耗時秒數)
+    """
+    state = {"feature": "edit", "state": "waiting", "data": {"blob_key": "0" * 64, "description": "benchmark"}}
+    latencies = []
+    lock = threading.Lock()
+    
+    def worker(ids):
+        local = []
+        for user_id in ids:
+            started = time.perf_counter()
+            if operation == "set":
+                store.set(user_id, state)
+            elif operation == "get":
+                store.get(user_id)
+            else:
+                store.clear(user_id)
+            local.append((time.perf_counter() - started) * 1000)
+        with lock:
+            latencies.extend(local)
+    
+    slices = [user_ids[i::threads] for i in range(threads)]
+    workers = [threading.Thread(target=worker, args=(ids,)) for ids in slices]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return sorted(latencies), time.perf_counter() - started
+
+
+def benchmark(store, ops, threads):
+    """依序測試 set → get → clear"""
+    user_ids = [f"Ubench{i:08d}" for i in range(ops)]
+    results = {}
+    for operation in ("set", "get", "clear"):
+        latencies, elapsed = run_operation(store, operation, user_ids, threads)
+        results[operation] = {
+            "avg_ms": sum(latencies) / len(latencies),
+            "p50_ms": percentile(latencies, 50),
+            "p99_ms": percentile(latencies, 99),
+            "ops_per_second": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        }
+    return results
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='用戶狀態儲存後端效能比較')
+    parser.add_argument('--ops', type=int, default=2000, help='每種操作的次數')
+    parser.add_argument('--threads', type=int, default=1, help='並行執行緒數')
+    parser.add_argument('--backends', default='memory,sqlite,database', help='要測試的後端（逗號分隔）')
+    args = parser.parse_args()
+    
+    print("=" * 70)
+    print("⏱️  用戶狀態儲存後端效能比較")
+    print("=" * 70)
+    print(f"每種操作 {args.ops} 次，{args.threads} 個執行緒")
+    print()
+    
+    load_dotenv()
+    
+    all_results = {}
+    for backend in [name.strip() for name in args.backends.split(',') if name.strip()]:
+        if backend == 'memory':
+            store = MemoryStateStore()
+        elif backend == 'sqlite':
+            store = SqliteStateStore(os.path.join(tempfile.mkdtemp(), 'bench_states.db'))
+        elif backend == 'database':
+            if not os.getenv("DATABASE_URL"):
+                print("ℹ️  未設定 DATABASE_URL，略過 database 後端")
+                continue
+            from models.database import init_database
+            init_database()
+            store = DatabaseStateStore()
+        else:
+            print(f"⚠️  未知的後端：{backend}")
+            continue
+        
+        print(f"🔄 測試 {backend}...")
+        all_results[backend] = benchmark(store, args.ops, args.threads)
+        store.close()
+    
+    print()
+    print(f"{'後端':<10}{'操作':<8}{'平均(ms)':>12}{'p50(ms)':>12}{'p99(ms)':>12}{'ops/s':>12}")
+    print("-" * 66)
+    for backend, results in all_results.items():
+        for operation, stats in results.items():
+            print(f"{backend:<10}{operation:<8}{stats['avg_ms']:>12.3f}{stats['p50_ms']:>12.3f}"
+                  f"{stats['p99_ms']:>12.3f}{stats['ops_per_second']:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+set_state 寫入方式效能比較
+比較「先 SELECT 再 UPDATE / INSERT」與單一 INSERT ... ON CONFLICT DO UPDATE
+在多個並發寫入者（同時寫入相同用戶）下的吞吐量、延遲與主鍵衝突錯誤
+
+使用方式:
+    python scripts/benchmark_state_upsert.py [--writers 8] [--ops 500] [--users 20] [--url 資料庫URL]
+    
+範例:
+    python scripts/benchmark_state_upsert.py                                  # 使用 DATABASE_URL
+    python scripts/benchmark_state_upsert.py --url sqlite:////tmp/bench.db    # 使用本機 SQLite
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+
+# 將專案根目錄加入 Python 路徑
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+from models.database import init_database, create_tables, get_session
+from models.user_state import UserState
+from services.state_store import DatabaseStateStore
+
+
+def legacy_set(store, user_id, state):
+    """舊做法：先查詢再更新或新增（兩次往返）"""
+    with get_session() as session:
+        store._select_then_write(session, user_id, state)
+        session.commit()
+
+
+def upsert_set(store, user_id, state):
+    """新做法：單一 UPSERT"""
+    store.set(user_id, state)
+
+
+def clear_benchmark_rows(prefix):
+    """清除測試資料"""
+    with get_session() as session:
+        session.query(UserState).filter(UserState.user_id.like(f"{prefix}%")).delete(synchronize_session=False)
+        session.commit()
+
+
+def run(method, writers, ops, users, prefix):
+    """
+    多個寫入者同時對 users 個用戶寫入狀態
+    
+    Returns:
+        dict: 吞吐量、平均與 p99 延遲、錯誤數
+    """
+    store = DatabaseStateStore()
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(writers)
+    
+    def writer(index):
+        local_latencies = []
+        local_errors = 0
+        start_barrier.wait()
+        for i in range(ops):
+            # 每一輪所有寫入者都寫入同一個用戶，製造同一主鍵的競爭
+            user_id = f"{prefix}{i % users:06d}"
+            state = {"feature": "edit", "state": "waiting", "data": {"writer": index, "seq": i}}
+            started = time.perf_counter()
+            try:
+                method(store, user_id, state)
+            except Exception:
+                local_errors += 1
+            local_latencies.append((time.perf_counter() - started) * 1000)
+        with lock:
+            latencies.extend(local_latencies)
+            errors.append(local_errors)
+    
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "ops_per_second": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "avg_ms": sum(latencies) / len(latencies),
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        "errors": sum(errors),
+    }
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='set_state 寫入方式效能比較')
+    parser.add_argument('--writers', type=int, default=8, help='並發寫入者數量')
+    parser.add_argument('--ops', type=int, default=500, help='每個寫入者的寫入次數')
+    parser.add_argument('--users', type=int, default=20, help='寫入的用戶數（越少競爭越激烈）')
+    parser.add_argument('--url', default=None, help='資料庫 URL（預設使用 DATABASE_URL）')
+    args = parser.parse_args()
+    
+    print("=" * 60)
+    print("⏱️  set_state：SELECT + UPDATE/INSERT vs UPSERT")
+    print("=" * 60)
+    
+    load_dotenv()
+    if not args.url and not os.getenv("DATABASE_URL"):
+        print("❌ 錯誤：請設定 DATABASE_URL 或使用 --url")
+        sys.exit(1)
+    
+    init_database(args.url)
+    create_tables()
+    print(f"{args.writers} 個寫入者 × {args.ops} 次，共 {args.users} 個用戶")
+    print()
+    
+    prefix = "Ubenchupsert"
+    results = {}
+    for name, method in (("select+write", legacy_set), ("upsert", upsert_set)):
+        clear_benchmark_rows(prefix)
+        print(f"🔄 測試 {name}...")
+        results[name] = run(method, args.writers, args.ops, args.users, prefix)
+    clear_benchmark_rows(prefix)
+    
+    print()
+    print(f"{'方式':<14}{'ops/s':>10}{'平均(ms)':>12}{'p99(ms)':>12}{'錯誤':>8}")
+    print("-" * 56)
+    for name, stats in results.items():
+        print(f"{name:<14}{stats['ops_per_second']:>10.0f}{stats['avg_ms']:>12.3f}"
+              f"{stats['p99_ms']:>12.3f}{stats['errors']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,12 @@
 清理超過指定時間的舊用戶狀態
 
 使用方式:
-    python scripts/cleanup_user_states.py [小時數]
+    python scripts/cleanup_user_states.py [小時數] [--show 筆數]
     
 範例:
     python scripts/cleanup_user_states.py 24    # 清理超過 24 小時的狀態
     python scripts/cleanup_user_states.py 168   # 清理超過 7 天的狀態
+    python scripts/cleanup_user_states.py 24 --show 100   # 清理前列出最多 100 個將被清理的狀態
 """
 
 import os
@@ -21,7 +22,13 @@ from dotenv import load_dotenv
 from models.database import init_database
 from user_state_manager import UserStateManager
 
-def cleanup_user_states(hours=24):
+def print_counts(counts):
+    """列出各功能 / 狀態的數量"""
+    for row in counts:
+        print(f"  - {row['feature']} / {row['state']}: {row['count']}")
+
+
+def cleanup_user_states(hours=24, show=20):
     """清理用戶狀態"""
     print("=" * 50)
     print("🧹 用戶狀態清理腳本")
@@ -48,34 +55,37 @@ def cleanup_user_states(hours=24):
         state_manager = UserStateManager()
         print("✅ UserStateManager 建立完成")
         
-        # 檢查清理前的狀態數量
+        # 檢查清理前的狀態數量（由資料庫彙總，不載入整張表）
         print(f"\n🔍 檢查超過 {hours} 小時的舊狀態...")
-        all_states = state_manager.get_all_states()
-        print(f"📊 目前總共有 {len(all_states)} 個狀態")
+        total = sum(row["count"] for row in state_manager.count_states())
+        expired_counts = state_manager.count_states(older_than_hours=hours)
+        expired = sum(row["count"] for row in expired_counts)
+        print(f"📊 目前總共有 {total} 個狀態，其中 {expired} 個超過 {hours} 小時")
+        print_counts(expired_counts)
         
-        if all_states:
-            print("現有狀態:")
-            for user_id, state in all_states.items():
+        if expired and show:
+            print(f"將被清理的狀態（最多列出 {show} 個）:")
+            for index, (user_id, state) in enumerate(state_manager.iter_states(older_than_hours=hours)):
+                if index >= show:
+                    print(f"  ... 另有 {expired - show} 個")
+                    break
                 print(f"  - {user_id}: {state.get('feature')} - {state.get('state')}")
         
-        # 執行清理
+        # 執行清理（分批刪除）
         print(f"\n🧹 開始清理超過 {hours} 小時的舊狀態...")
         cleaned_count = state_manager.cleanup_old_states(hours=hours)
         
         # 檢查清理後的狀態
-        remaining_states = state_manager.get_all_states()
-        print(f"📊 清理後剩餘 {len(remaining_states)} 個狀態")
-        
-        if remaining_states:
-            print("剩餘狀態:")
-            for user_id, state in remaining_states.items():
-                print(f"  - {user_id}: {state.get('feature')} - {state.get('state')}")
+        remaining_counts = state_manager.count_states()
+        remaining = sum(row["count"] for row in remaining_counts)
+        print(f"📊 清理後剩餘 {remaining} 個狀態")
+        print_counts(remaining_counts)
         
         print("\n" + "=" * 50)
         print("✅ 清理完成！")
         print("=" * 50)
         print(f"🧹 已清理 {cleaned_count} 個舊狀態")
-        print(f"📊 剩餘 {len(remaining_states)} 個活躍狀態")
+        print(f"📊 剩餘 {remaining} 個活躍狀態")
         print()
         
         return True
@@ -91,6 +101,8 @@ def main():
     parser = argparse.ArgumentParser(description='清理用戶狀態')
     parser.add_argument('hours', type=int, nargs='?', default=24,
                        help='清理超過指定小時數的狀態 (預設: 24)')
+    parser.add_argument('--show', type=int, default=20,
+                       help='清理前列出的狀態筆數上限 (預設: 20，0 表示不列出)')
     
     args = parser.parse_args()
     
@@ -105,7 +117,7 @@ def main():
             print("❌ 已取消清理")
             sys.exit(0)
     
-    success = cleanup_user_states(args.hours)
+    success = cleanup_user_states(args.hours, args.show)
     sys.exit(0 if success else 1)
 
 if __name__ == "__main__":
@@ -68,6 +68,9 @@ def main():
         from models.member import Member
         from models.point_transaction import PointTransaction
         from models.user_state import UserState
+        from models.processed_event import ProcessedEvent
+        from models.outbox_message import OutboxMessage
+        from models.replicate_result import ReplicateResult
         
         print("已建立以下資料表：")
         print("  1. members - 會員表")
@@ -95,6 +98,24 @@ def main():
         print("     - data (額外數據，JSON格式)")
         print("     - created_at, updated_at")
         print()
+        print("  4. processed_events - 已處理 webhook 事件表（重複事件過濾）")
+        print("     - webhook_event_id (主鍵)")
+        print("     - created_at")
+        print()
+        print("  5. outbox_messages - 待推送訊息表（transactional outbox）")
+        print("     - id (主鍵)")
+        print("     - target_id")
+        print("     - payload (LINE 訊息，JSON格式)")
+        print("     - status (pending / sent / dead)")
+        print("     - attempts, last_error")
+        print("     - available_at, created_at, sent_at")
+        print()
+        print("  6. replicate_results - Replicate 結果快取索引")
+        print("     - cache_key (主鍵)")
+        print("     - image_sha256, model, params")
+        print("     - blob_key, extension, size_bytes")
+        print("     - hits, created_at, last_hit_at")
+        print()
         
         print("=" * 50)
         print("🎉 資料庫初始化完成！")
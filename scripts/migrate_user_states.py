@@ -44,13 +44,19 @@ def migrate_user_states():
         state_manager = UserStateManager()
         print("✅ UserStateManager 建立完成")
         
-        # 檢查是否有現有狀態
+        # 檢查是否有現有狀態（由資料庫彙總，不載入整張表）
         print("\n🔍 檢查現有狀態...")
-        all_states = state_manager.get_all_states()
+        counts = state_manager.count_states()
+        total = sum(row["count"] for row in counts)
         
-        if all_states:
-            print(f"📊 發現 {len(all_states)} 個現有狀態:")
-            for user_id, state in all_states.items():
+        if total:
+            print(f"📊 發現 {total} 個現有狀態:")
+            for row in counts:
+                print(f"  - {row['feature']} / {row['state']}: {row['count']}")
+            print("狀態範例（前 20 個）:")
+            for index, (user_id, state) in enumerate(state_manager.iter_states(page_size=20)):
+                if index >= 20:
+                    break
                 print(f"  - {user_id}: {state.get('feature')} - {state.get('state')}")
         else:
             print("ℹ️  沒有發現現有狀態")
@@ -0,0 +1,59 @@
+"""
+Outbox 推送程序
+持續取出 outbox_messages 中待送的訊息並推送給用戶（可與 web 程序分開部署）
+
+使用方式:
+    python scripts/outbox_dispatcher.py          # 持續運行
+    python scripts/outbox_dispatcher.py --once   # 只處理一批後結束
+"""
+
+import os
+import sys
+import signal
+import argparse
+
+# 將專案根目錄加入 Python 路徑
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+from linebot import LineBotApi
+from models.database import init_database
+from services.line_http_client import LineHttpClient
+from services.outbox_dispatcher import OutboxDispatcher
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='Outbox 推送程序')
+    parser.add_argument('--once', action='store_true', help='只處理一批後結束')
+    args = parser.parse_args()
+    
+    load_dotenv()
+    
+    if not os.getenv("DATABASE_URL"):
+        print("❌ 錯誤：未設定 DATABASE_URL 環境變數")
+        sys.exit(1)
+    if not os.getenv("CHANNEL_ACCESS_TOKEN"):
+        print("❌ 錯誤：未設定 CHANNEL_ACCESS_TOKEN 環境變數")
+        sys.exit(1)
+    
+    init_database()
+    line_bot_api = LineBotApi(os.getenv("CHANNEL_ACCESS_TOKEN"), http_client=LineHttpClient)
+    dispatcher = OutboxDispatcher(line_bot_api)
+    
+    if args.once:
+        processed = dispatcher.run_once()
+        print(f"✅ 已處理 {processed} 筆訊息")
+        print(f"📊 {dispatcher.get_stats()}")
+        return
+    
+    # 收到 SIGTERM（例如部署重啟）時處理完目前這批再結束
+    signal.signal(signal.SIGTERM, lambda *_: dispatcher.stop())
+    try:
+        dispatcher.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+會員公告發送腳本
+以 multicast（每次 500 人）批次發送公告給所有會員，可中斷後續傳
+
+使用方式:
+    python scripts/send_announcement.py "公告內容" [--status normal] [--checkpoint 檔案] [--concurrency 4] [--dry-run]
+    
+範例:
+    python scripts/send_announcement.py "🎉 本週點數加倍！"
+    python scripts/send_announcement.py "VIP 專屬活動" --status vip --checkpoint vip_promo.json
+"""
+
+import os
+import sys
+import argparse
+
+# 將專案根目錄加入 Python 路徑
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+from linebot import LineBotApi
+from linebot.models import TextSendMessage
+from models.database import init_database
+from services.line_http_client import LineHttpClient
+from services.announcement_service import AnnouncementService
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='會員公告發送腳本')
+    parser.add_argument('text', help='公告內容')
+    parser.add_argument('--status', default=None, help='只發送給此狀態的會員 (normal, vip, suspended, banned)')
+    parser.add_argument('--checkpoint', default='announcement_checkpoint.json', help='進度檔路徑（用於續傳）')
+    parser.add_argument('--concurrency', type=int, default=None, help='同時送出的 multicast 數量')
+    parser.add_argument('--dry-run', action='store_true', help='只計算收件人數，不實際送出')
+    args = parser.parse_args()
+    
+    print("=" * 50)
+    print("📢 會員公告發送腳本")
+    print("=" * 50)
+    
+    load_dotenv()
+    
+    if not os.getenv("DATABASE_URL"):
+        print("❌ 錯誤：未設定 DATABASE_URL 環境變數")
+        sys.exit(1)
+    if not os.getenv("CHANNEL_ACCESS_TOKEN"):
+        print("❌ 錯誤：未設定 CHANNEL_ACCESS_TOKEN 環境變數")
+        sys.exit(1)
+    
+    print("🔌 初始化資料庫...")
+    init_database()
+    
+    # 使用共用連線池與速率限制（multicast 依 LINE 文件限制為 200 req/s）
+    line_bot_api = LineBotApi(os.getenv("CHANNEL_ACCESS_TOKEN"), http_client=LineHttpClient)
+    service = AnnouncementService(line_bot_api, concurrency=args.concurrency)
+    
+    print(f"🎯 對象：{args.status or '全部會員'}")
+    if args.dry_run:
+        print("🧪 dry-run 模式，不會實際送出，也不會讀寫進度檔")
+    else:
+        print(f"💾 進度檔：{args.checkpoint}")
+    print()
+    
+    stats = service.send(
+        TextSendMessage(text=args.text),
+        status=args.status,
+        checkpoint_path=args.checkpoint,
+        dry_run=args.dry_run
+    )
+    
+    print()
+    print("=" * 50)
+    print("✅ 公告發送完成")
+    print("=" * 50)
+    print(f"  本次送出：{stats['recipients']} 人（{stats['chunks']} 個 multicast）")
+    print(f"  失敗：{stats['failed_recipients']} 人（{stats['failed_chunks']} 個 multicast）")
+    if stats['pending_failed_chunks']:
+        print(f"  ⚠️  {stats['pending_failed_chunks']} 個 multicast 尚未送達，請以相同內容重新執行以重送")
+    print(f"  累計送出：{stats['total_sent']} 人")
+    print(f"  耗時：{stats['elapsed_seconds']} 秒（{stats['recipients_per_second']} 人/秒）")
+    if not args.dry_run:
+        print(f"  API 統計：{line_bot_api.http_client.get_stats()['rate_limits']}")
+
+
+if __name__ == "__main__":
+    main()
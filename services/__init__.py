@@ -1,4 +1,24 @@
 from services.member_service import MemberService
+from services.event_queue import EventQueue
+from services.sharded_executor import ShardedExecutor
+from services.idempotency_store import IdempotencyStore
+from services.profile_cache import ProfileCache
+from services.line_http_client import LineHttpClient
+from services.push_coalescer import PushCoalescer
+from services.announcement_service import AnnouncementService
+from services.state_cache import StateCache, LocalInvalidationChannel, PostgresInvalidationChannel
+from services.state_store import StateStore, MemoryStateStore, SqliteStateStore, DatabaseStateStore, create_state_store
+from services.blob_store import BlobStore
+from services.state_reaper import StateReaper
+from services.job_scheduler import JobScheduler
+from services.result_cache import ResultCache
+from services.single_flight import SingleFlight
+from services.image_preprocessor import ImagePreprocessor
 
-__all__ = ['MemberService']
-
+__all__ = [
+    'MemberService', 'EventQueue', 'ShardedExecutor', 'IdempotencyStore', 'ProfileCache',
+    'LineHttpClient', 'PushCoalescer', 'AnnouncementService',
+    'StateCache', 'LocalInvalidationChannel', 'PostgresInvalidationChannel',
+    'StateStore', 'MemoryStateStore', 'SqliteStateStore', 'DatabaseStateStore', 'create_state_store',
+    'BlobStore', 'StateReaper', 'JobScheduler', 'ResultCache', 'SingleFlight', 'ImagePreprocessor',
+]
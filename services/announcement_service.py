@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from models.database import get_session
+from models.member import Member
+
+
+class AnnouncementService:
+    """
+    會員公告批次發送服務
+
+    以 server-side cursor 依 user_id 順序串流讀取會員，每 500 人組成一次 multicast，
+    並行數受限地送出（速率由 LineHttpClient 的 multicast token bucket 控制）。
+    進度寫入 checkpoint 檔，中斷後可從最後一個「之前全部完成」的 user_id 繼續；
+    checkpoint 以公告內容與對象計算的 run_key 區分，失敗的區塊記錄收件人並在續傳時重送，
+    全部送達後刪除 checkpoint 檔。
+    """
+
+    MULTICAST_MAX_RECIPIENTS = 500
+
+    def __init__(self, line_bot_api, concurrency: int = None, chunk_size: int = None):
+        """
+        Args:
+            line_bot_api: LineBotApi（建議使用 LineHttpClient 以套用速率限制與重試）
+            concurrency: 同時送出的 multicast 數量
+            chunk_size: 每次 multicast 的收件人數（最多 500）
+        """
+        self.line_bot_api = line_bot_api
+        self.concurrency = concurrency or int(os.getenv("ANNOUNCEMENT_CONCURRENCY", "4"))
+        self.chunk_size = min(chunk_size or self.MULTICAST_MAX_RECIPIENTS, self.MULTICAST_MAX_RECIPIENTS)
+
+    def iter_member_ids(self, status: str = None, after_user_id: str = None, fetch_size: int = 1000):
+        """
+        依 user_id 順序串流讀取會員 ID（不一次載入整張表）
+
+        Args:
+            status: 只選取此狀態的會員（None 表示全部）
+            after_user_id: 從此 user_id 之後開始（用於續傳）
+            fetch_size: 每次從資料庫取回的筆數
+
+        Yields:
+            str: user_id
+        """
+        with get_session() as session:
+            query = session.query(Member.user_id)
+            if status:
+                query = query.filter(Member.status == status)
+            if after_user_id:
+                query = query.filter(Member.user_id > after_user_id)
+            query = query.order_by(Member.user_id)\
+                .execution_options(stream_results=True, yield_per=fetch_size)
+            for (user_id,) in query:
+                yield user_id
+
+    def iter_chunks(self, user_ids):
+        """將 user_id 串流切成 multicast 大小的區塊"""
+        chunk = []
+        for user_id in user_ids:
+            chunk.append(user_id)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def make_run_key(messages, status: str = None) -> str:
+        """以公告內容與對象計算 checkpoint 的 run_key（不同公告不會沿用彼此的進度）"""
+        message_list = messages if isinstance(messages, (list, tuple)) else [messages]
+        raw = json.dumps([[message.as_json_dict() for message in message_list], status],
+                         sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def load_checkpoint(path: str, run_key: str = None) -> dict:
+        """讀取 checkpoint（不存在或屬於其他公告時返回空進度）"""
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+            if checkpoint.get("run_key") == run_key:
+                return checkpoint
+            print(f"⚠️  進度檔 {path} 屬於其他公告，從頭開始發送")
+        return {"run_key": run_key, "last_user_id": None, "sent": 0, "chunks": 0, "failed_chunks": []}
+
+    @staticmethod
+    def save_checkpoint(path: str, checkpoint: dict):
+        """原子地寫入 checkpoint（先寫暫存檔再改名）"""
+        if not path:
+            return
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    def send(self, messages, status: str = None, checkpoint_path: str = None, dry_run: bool = False) -> dict:
+        """
+        發送公告給所有符合條件的會員
+
+        Args:
+            messages: LINE 訊息（最多 5 則）
+            status: 只發送給此狀態的會員
+            checkpoint_path: checkpoint 檔路徑（None 表示不續傳）
+            dry_run: 只計算收件人與區塊，不實際送出（不讀寫 checkpoint）
+
+        Returns:
+            dict: 發送統計（收件人數、區塊數、失敗數、耗時與每秒收件人數）
+        """
+        if dry_run:
+            checkpoint_path = None
+        checkpoint = self.load_checkpoint(checkpoint_path, self.make_run_key(messages, status))
+        if checkpoint.get("last_user_id"):
+            print(f"↩️  從 checkpoint 續傳：{checkpoint['last_user_id']} 之後（已送出 {checkpoint['sent']} 人）")
+        # 上次失敗的區塊先重送（成功後從 checkpoint 移除，再次失敗則保留）
+        retries = [record for record in checkpoint["failed_chunks"] if record.get("user_ids")]
+        if retries:
+            print(f"🔁 重送上次失敗的 {len(retries)} 個 multicast")
+
+        lock = threading.Lock()
+        in_flight = threading.BoundedSemaphore(self.concurrency * 2)
+        # 依提交順序記錄每個區塊的完成狀態，只有前面全部完成時才推進 checkpoint
+        pending = []  # [(sequence, last_user_id（重送區塊為 None）, chunk, retry_record)]
+        done = {}     # sequence -> error or None
+        run_stats = {"recipients": 0, "chunks": 0, "failed_chunks": 0, "failed_recipients": 0}
+        started = time.perf_counter()
+
+        def advance_checkpoint():
+            while pending and pending[0][0] in done:
+                sequence, last_user_id, chunk, retry_record = pending.pop(0)
+                error = done.pop(sequence)
+                if last_user_id is not None:
+                    checkpoint["last_user_id"] = last_user_id
+                    checkpoint["chunks"] += 1
+                if error is None:
+                    checkpoint["sent"] += len(chunk)
+                    if retry_record is not None:
+                        checkpoint["failed_chunks"].remove(retry_record)
+                elif retry_record is not None:
+                    retry_record["error"] = error
+                else:
+                    checkpoint["failed_chunks"].append({"user_ids": chunk, "size": len(chunk), "error": error})
+            self.save_checkpoint(checkpoint_path, checkpoint)
+
+        def send_chunk(sequence, chunk):
+            error = None
+            try:
+                if not dry_run:
+                    self.line_bot_api.multicast(chunk, messages)
+            except Exception as e:
+                error = str(e)
+                print(f"❌ multicast 失敗（{chunk[0]} ~ {chunk[-1]}，{len(chunk)} 人）: {error}")
+            finally:
+                in_flight.release()
+            with lock:
+                done[sequence] = error
+                run_stats["chunks"] += 1
+                if error is None:
+                    run_stats["recipients"] += len(chunk)
+                else:
+                    run_stats["failed_chunks"] += 1
+                    run_stats["failed_recipients"] += len(chunk)
+                advance_checkpoint()
+                if run_stats["chunks"] % 20 == 0:
+                    elapsed = time.perf_counter() - started
+                    print(f"📤 已送出 {run_stats['recipients']} 人（{run_stats['recipients'] / elapsed:.0f} 人/秒）")
+
+        def iter_work():
+            for record in retries:
+                yield None, record["user_ids"], record
+            user_ids = self.iter_member_ids(status=status, after_user_id=checkpoint.get("last_user_id"))
+            for chunk in self.iter_chunks(user_ids):
+                yield chunk[-1], chunk, None
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="announce") as executor:
+            for sequence, (last_user_id, chunk, retry_record) in enumerate(iter_work()):
+                in_flight.acquire()
+                with lock:
+                    pending.append((sequence, last_user_id, chunk, retry_record))
+                executor.submit(send_chunk, sequence, chunk)
+
+        # 全部送達後刪除 checkpoint，仍有失敗的區塊時保留以便續傳重送
+        if checkpoint_path and not checkpoint["failed_chunks"] and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+            print(f"🧹 公告已全部送達，刪除進度檔 {checkpoint_path}")
+
+        elapsed = time.perf_counter() - started
+        run_stats.update({
+            "elapsed_seconds": round(elapsed, 3),
+            "recipients_per_second": round(run_stats["recipients"] / elapsed, 1) if elapsed > 0 else 0.0,
+            "total_sent": checkpoint["sent"],
+            "last_user_id": checkpoint.get("last_user_id"),
+            "pending_failed_chunks": len(checkpoint["failed_chunks"]),
+        })
+        return run_stats
@@ -0,0 +1,177 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+_KEY_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class BlobStore:
+    """
+    以內容雜湊（SHA-256）為鍵值的本機檔案 blob 儲存
+
+    上傳的圖片存成檔案，用戶狀態只記錄 64 字元的鍵值，不再把整張圖片以 base64
+    寫進資料庫。總容量超過 max_bytes 時，依最後使用時間淘汰最舊的檔案
+    （min_age_seconds 內使用過的檔案不會被淘汰，避免刪掉處理中的圖片）。
+    讀取時直接開啟檔案串流，不需要把整個檔案複製進記憶體。
+    """
+
+    def __init__(self, root: str = None, max_bytes: int = None, min_age_seconds: float = None):
+        self.root = root or os.getenv("BLOB_STORE_PATH", "blob_store")
+        self.max_bytes = max_bytes or int(os.getenv("BLOB_STORE_MAX_BYTES", str(512 * 1024 * 1024)))
+        self.min_age_seconds = min_age_seconds if min_age_seconds is not None else \
+            float(os.getenv("BLOB_STORE_MIN_AGE_SECONDS", "3600"))
+
+        self._tmp_dir = os.path.join(self.root, "tmp")
+        os.makedirs(self._tmp_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._total_bytes = self._scan_total()
+        self._puts = 0
+        self._dedup_hits = 0
+        self._reads = 0
+        self._evictions = 0
+        self._evicted_bytes = 0
+
+    def _path(self, key: str) -> str:
+        if not _KEY_PATTERN.match(key or ""):
+            raise ValueError(f"無效的 blob key: {key}")
+        return os.path.join(self.root, key[:2], key[2:])
+
+    def _iter_blobs(self):
+        """列出所有 blob 檔案 (path, size, mtime)"""
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or entry.name == "tmp":
+                continue
+            for blob in os.scandir(entry.path):
+                try:
+                    stat = blob.stat()
+                except FileNotFoundError:
+                    continue
+                yield blob.path, stat.st_size, stat.st_mtime
+
+    def _scan_total(self) -> int:
+        return sum(size for _, size, _ in self._iter_blobs())
+
+    def put(self, data) -> str:
+        """
+        寫入 blob
+
+        Args:
+            data: bytes 或 bytes 區塊的 iterable（例如 LINE 的 iter_content()）
+
+        Returns:
+            str: blob 鍵值（SHA-256 hex）
+        """
+        chunks = [data] if isinstance(data, (bytes, bytearray, memoryview)) else data
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            key = digest.hexdigest()
+            path = self._path(key)
+            if os.path.exists(path):
+                # 相同內容已存在，只更新使用時間
+                os.utime(path)
+                os.remove(tmp_path)
+                with self._lock:
+                    self._dedup_hits += 1
+                return key
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            self._puts += 1
+            self._total_bytes += size
+            over_capacity = self._total_bytes > self.max_bytes
+        if over_capacity:
+            self.evict()
+        return key
+
+    @contextmanager
+    def open(self, key: str):
+        """
+        以唯讀檔案開啟 blob（可直接串流上傳，不需要讀入記憶體）
+
+        Raises:
+            FileNotFoundError: blob 不存在（例如已被淘汰）
+        """
+        path = self._path(key)
+        with open(path, "rb") as f:
+            os.utime(path)
+            with self._lock:
+                self._reads += 1
+            yield f
+
+    def path_for(self, key: str) -> str:
+        """取得 blob 的檔案路徑（例如交給 Flask send_file）"""
+        return self._path(key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def delete(self, key: str):
+        """刪除 blob（不存在時忽略）"""
+        path = self._path(key)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._total_bytes -= size
+
+    def evict(self) -> int:
+        """
+        依最後使用時間淘汰檔案直到總容量低於上限
+
+        Returns:
+            int: 淘汰的檔案數
+        """
+        blobs = sorted(self._iter_blobs(), key=lambda blob: blob[2])
+        total = sum(size for _, size, _ in blobs)
+        cutoff = time.time() - self.min_age_seconds
+        evicted = 0
+        evicted_bytes = 0
+        for path, size, mtime in blobs:
+            if total <= self.max_bytes or mtime > cutoff:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+            evicted_bytes += size
+        with self._lock:
+            self._total_bytes = total
+            self._evictions += evicted
+            self._evicted_bytes += evicted_bytes
+        if evicted:
+            print(f"🧹 blob store 已淘汰 {evicted} 個檔案（{evicted_bytes} bytes）")
+        return evicted
+
+    def get_stats(self) -> dict:
+        """取得容量與使用統計"""
+        with self._lock:
+            return {
+                "total_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "puts": self._puts,
+                "dedup_hits": self._dedup_hits,
+                "reads": self._reads,
+                "evictions": self._evictions,
+                "evicted_bytes": self._evicted_bytes,
+            }
@@ -0,0 +1,121 @@
+import time
+from services.metrics import LatencyStats
+from services.sharded_executor import ShardedExecutor
+from webhook_event import WebhookEvent
+
+
+def event_source_key(event: WebhookEvent) -> str:
+    """
+    取得事件的分片鍵（同一個鍵的事件依序處理）
+
+    用戶狀態（UserStateManager）以 userId 為鍵，因此以 userId 分片：同一用戶在個人聊天與
+    群組中的事件落在同一分片，FeatureRegistry 的路由與狀態機轉換不會並行。
+    沒有 userId 的事件（例如部分群組事件）才改用 groupId / roomId。
+    """
+    return event.user_id or event.target_id
+
+
+class BatchDispatcher:
+    """
+    webhook 批次事件分派器
+
+    處理同一次 webhook 送來的所有事件：事件依 event_source_key 交給 ShardedExecutor，
+    不同用戶的事件並行處理，同一用戶的事件（包含跨 webhook 請求）在分片執行緒上依序經過
+    FeatureRegistry 與狀態機，最後將所有測試模式的 JSON 回應合併成一個。
+
+    順序保證只涵蓋同一程序內經由同一個執行器分派的事件：交給 JobScheduler 的背景圖片工作
+    在分片之外執行，多個 gunicorn 程序之間也不互相排序。
+    """
+
+    def __init__(self, handler, executor: ShardedExecutor = None):
+        """
+        Args:
+            handler: 處理單一事件的函式，回傳 Flask 回應或 None
+            executor: 依來源分片的執行器
+        """
+        self.handler = handler
+        self.executor = executor or ShardedExecutor(name="webhook-shard")
+        self.batch_latency = LatencyStats()
+
+    def submit(self, event: WebhookEvent):
+        """將單一事件提交到其來源所屬的分片"""
+        return self.executor.submit(event_source_key(event), self.handler, event)
+
+    def dispatch(self, events: list) -> list:
+        """
+        處理一批事件並等待全部完成
+
+        Args:
+            events: WebhookEvent 列表
+
+        Returns:
+            list: 所有非空的處理結果（依事件原始順序）
+        """
+        start = time.perf_counter()
+        futures = [self.submit(event) for event in events]
+
+        results = []
+        for future in futures:
+            try:
+                result = future.result()
+            except Exception as e:
+                # 單一事件失敗不影響同批次的其他事件
+                print(f"❌ 事件處理失敗: {str(e)}")
+                import traceback
+                traceback.print_exc()
+                result = None
+            if result:
+                results.append(result)
+
+        self.batch_latency.observe((time.perf_counter() - start) * 1000)
+        return results
+
+    @staticmethod
+    def combine_responses(results: list):
+        """
+        將多個測試模式的 JSON 回應合併成一個
+
+        Args:
+            results: 各事件的處理結果（Flask Response 或其他非空回傳值）
+
+        Returns:
+            dict | Flask Response | None: 單一結果直接回傳，多個結果合併為一個 dict
+        """
+        # 只有 MessagePublisher 產生的 JSON 回應需要合併（例如 "OK" 字串不需要）
+        json_results = [result for result in results if hasattr(result, 'get_json')]
+        if not json_results:
+            return None
+        if len(json_results) == 1:
+            return json_results[0]
+
+        responses = []
+        data = []
+        for result in json_results:
+            payload = result.get_json(silent=True)
+            if payload is None:
+                continue
+            responses.append(payload)
+            messages = payload.get('data')
+            if isinstance(messages, list):
+                data.extend(messages)
+            elif messages is not None:
+                data.append(messages)
+
+        return {
+            "status": "success",
+            "data": data,
+            "user_id": responses[0].get('user_id') if responses else None,
+            "timestamp": time.time(),
+            "responses": responses,
+        }
+
+    def get_stats(self) -> dict:
+        """取得分派器統計"""
+        return {
+            "executor": self.executor.get_stats(),
+            "batch_latency": self.batch_latency.snapshot(),
+        }
+
+    def shutdown(self):
+        """關閉分片執行器"""
+        self.executor.shutdown(wait=True)
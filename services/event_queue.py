@@ -0,0 +1,317 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from services.metrics import LatencyStats
+
+
+class EventQueue:
+    """
+    持久化的 webhook 事件佇列（SQLite 檔案，WAL 模式）
+
+    webhook 只負責寫入佇列後立即回應，由背景 worker pool 取出事件並交給 handler 處理。
+    使用 BEGIN IMMEDIATE 取得寫入鎖，因此多個 gunicorn worker 可以共用同一個佇列檔案。
+
+    提供 key_func 時，每個事件寫入時記錄排序鍵（例如 userId）：同一鍵只會取出最早一筆尚未完成的事件，
+    前一個事件處理中、等待重試或仍在 visibility timeout 內時，之後的事件不會被取出。
+    因此同一用戶的事件（包含重試）依寫入順序處理，共用同一個佇列檔案的多個程序之間也成立；
+    重試次數用盡進入 dead 的事件不再阻擋後續事件。
+
+    若提供 ShardedExecutor，改由單一取出執行緒依佇列順序取出事件，依排序鍵交給所屬的分片執行；
+    同時處理中的事件數量上限為 worker_count。
+    """
+
+    def __init__(self, path: str = None, worker_count: int = None, max_attempts: int = None,
+                 visibility_timeout: float = None, poll_interval: float = 0.2, key_func=None):
+        self.path = path or os.getenv("EVENT_QUEUE_PATH", "event_queue.db")
+        self.worker_count = worker_count or int(os.getenv("EVENT_QUEUE_WORKERS", "4"))
+        self.max_attempts = max_attempts or int(os.getenv("EVENT_QUEUE_MAX_ATTEMPTS", "3"))
+        # 取出後超過此秒數仍未完成，視為 worker 已崩潰，事件會重新排入佇列
+        self.visibility_timeout = visibility_timeout or float(os.getenv("EVENT_QUEUE_VISIBILITY_TIMEOUT", "300"))
+        self.poll_interval = poll_interval
+        # 從原始 event dict 取得排序鍵（None 表示不限制順序）
+        self.key_func = key_func
+
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._workers = []
+        self._handler = None
+        self._executor = None
+        self._decoder = None
+        self._inflight = None
+
+        self.enqueue_latency = LatencyStats()
+        self.drain_latency = LatencyStats()
+        self._counter_lock = threading.Lock()
+        self._processed = 0
+        self._failed = 0
+        self._dead = 0
+
+        self._init_schema()
+
+    def _connect(self) -> sqlite3.Connection:
+        """取得目前執行緒專用的連線"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        """建立佇列資料表"""
+        conn = self._connect()
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS webhook_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                enqueued_at REAL NOT NULL,
+                locked_at REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL DEFAULT 'pending',
+                source_key TEXT
+            )
+            """
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(webhook_events)")}
+        if "source_key" not in columns:
+            # 舊版佇列檔案沒有排序鍵欄位
+            conn.execute("ALTER TABLE webhook_events ADD COLUMN source_key TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_events_status ON webhook_events (status, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_events_source_key ON webhook_events (source_key, id)")
+
+    def enqueue_many(self, events: list) -> int:
+        """
+        將事件寫入佇列
+
+        Args:
+            events: LINE webhook events（原始 dict）
+
+        Returns:
+            int: 寫入的事件數量
+        """
+        if not events:
+            return 0
+
+        start = time.perf_counter()
+        now = time.time()
+        rows = [
+            (json.dumps(event, ensure_ascii=False), now, self.key_func(event) if self.key_func else None)
+            for event in events
+        ]
+
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT INTO webhook_events (payload, enqueued_at, source_key) VALUES (?, ?, ?)", rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        self.enqueue_latency.observe((time.perf_counter() - start) * 1000)
+        self._wakeup.set()
+        return len(rows)
+
+    def _claim_next(self):
+        """取出下一個待處理事件並標記為處理中（同一排序鍵有更早的未完成事件時略過）"""
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                """
+                SELECT id, payload, enqueued_at, attempts, source_key FROM webhook_events AS w
+                WHERE (status = 'pending' OR (status = 'processing' AND locked_at < ?))
+                  AND NOT EXISTS (
+                      SELECT 1 FROM webhook_events AS earlier
+                      WHERE earlier.source_key = w.source_key AND earlier.id < w.id
+                        AND earlier.status IN ('pending', 'processing')
+                  )
+                ORDER BY id
+                LIMIT 1
+                """,
+                (now - self.visibility_timeout,)
+            ).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE webhook_events SET status = 'processing', locked_at = ?, attempts = attempts + 1 WHERE id = ?",
+                    (now, row[0])
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return row
+
+    def _complete(self, event_id: int):
+        """處理成功，移除事件"""
+        self._connect().execute("DELETE FROM webhook_events WHERE id = ?", (event_id,))
+
+    def _fail(self, event_id: int, attempts: int):
+        """處理失敗，依重試次數決定重新排入或標記為 dead"""
+        status = "dead" if attempts >= self.max_attempts else "pending"
+        self._connect().execute(
+            "UPDATE webhook_events SET status = ?, locked_at = NULL WHERE id = ?",
+            (status, event_id)
+        )
+        return status
+
+    def _worker_loop(self):
+        """worker 主迴圈"""
+        while not self._stop.is_set():
+            try:
+                row = self._claim_next()
+            except Exception as e:
+                print(f"❌ 事件佇列讀取失敗: {str(e)}")
+                self._stop.wait(self.poll_interval)
+                continue
+
+            if row is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            event_id, payload, enqueued_at, attempts, _ = row
+            try:
+                self._handler(self._decoder(json.loads(payload)))
+            except Exception as e:
+                self._on_failure(event_id, attempts + 1, e)
+            else:
+                self._on_success(event_id, enqueued_at)
+
+    def _pump_loop(self):
+        """分片模式的取出迴圈：依佇列順序取出事件並提交到對應分片"""
+        while not self._stop.is_set():
+            # 限制同時處理中的事件數量，避免一次把整個佇列取出
+            if not self._inflight.acquire(timeout=self.poll_interval):
+                continue
+            try:
+                row = self._claim_next()
+            except Exception as e:
+                self._inflight.release()
+                print(f"❌ 事件佇列讀取失敗: {str(e)}")
+                self._stop.wait(self.poll_interval)
+                continue
+
+            if row is None:
+                self._inflight.release()
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            event_id, payload, enqueued_at, attempts, source_key = row
+            try:
+                event = self._decoder(json.loads(payload))
+                future = self._executor.submit(source_key, self._handler, event)
+            except Exception as e:
+                # 無法解析或提交的事件走同樣的重試 / dead-letter 流程，不讓取出執行緒中止
+                self._inflight.release()
+                try:
+                    self._on_failure(event_id, attempts + 1, e)
+                except Exception as fail_error:
+                    print(f"❌ 事件佇列更新失敗: {str(fail_error)}")
+                continue
+            future.add_done_callback(
+                lambda f, event_id=event_id, enqueued_at=enqueued_at, attempts=attempts + 1:
+                    self._on_done(f, event_id, enqueued_at, attempts)
+            )
+
+    def _on_done(self, future, event_id: int, enqueued_at: float, attempts: int):
+        """分片執行完成的回呼"""
+        try:
+            error = future.exception()
+            if error is None:
+                self._on_success(event_id, enqueued_at)
+            else:
+                self._on_failure(event_id, attempts, error)
+        finally:
+            self._inflight.release()
+
+    def _on_success(self, event_id: int, enqueued_at: float):
+        """記錄處理成功"""
+        self._complete(event_id)
+        with self._counter_lock:
+            self._processed += 1
+        self.drain_latency.observe((time.time() - enqueued_at) * 1000)
+        # 同一排序鍵的下一個事件現在可以取出
+        self._wakeup.set()
+
+    def _on_failure(self, event_id: int, attempts: int, error: Exception):
+        """記錄處理失敗"""
+        print(f"❌ 佇列事件處理失敗 (id={event_id}, 第 {attempts} 次): {str(error)}")
+        status = self._fail(event_id, attempts)
+        with self._counter_lock:
+            self._failed += 1
+            if status == "dead":
+                self._dead += 1
+        self._wakeup.set()
+
+    def start(self, handler, executor=None, decoder=None):
+        """
+        啟動 worker pool
+
+        Args:
+            handler: 處理單一事件的函式
+            executor: ShardedExecutor（可選），提供時改用分片依序處理（需要建立佇列時提供 key_func）
+            decoder: 將佇列中的原始 event dict 轉換為 handler 所需物件的函式（可選）
+        """
+        if self._workers:
+            return
+        if executor is not None and self.key_func is None:
+            raise ValueError("分片模式需要 key_func 提供事件的排序鍵")
+        self._handler = handler
+        self._decoder = decoder or (lambda event: event)
+        self._stop.clear()
+
+        if executor is not None:
+            self._executor = executor
+            self._inflight = threading.BoundedSemaphore(self.worker_count)
+            pump = threading.Thread(target=self._pump_loop, name="event-queue-pump", daemon=True)
+            pump.start()
+            self._workers.append(pump)
+            print(f"✅ 事件佇列已啟動: {self.path}（分片模式，最多 {self.worker_count} 個處理中事件）")
+            return
+
+        for i in range(self.worker_count):
+            worker = threading.Thread(target=self._worker_loop, name=f"event-queue-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        print(f"✅ 事件佇列已啟動: {self.path} ({self.worker_count} 個 worker)")
+
+    def stop(self, timeout: float = 5.0):
+        """停止 worker pool（未處理完的事件會留在佇列中）"""
+        self._stop.set()
+        self._wakeup.set()
+        for worker in self._workers:
+            worker.join(timeout)
+        self._workers = []
+
+    def depth(self) -> dict:
+        """各狀態的事件數量"""
+        rows = self._connect().execute(
+            "SELECT status, COUNT(*) FROM webhook_events GROUP BY status"
+        ).fetchall()
+        counts = {"pending": 0, "processing": 0, "dead": 0}
+        counts.update({status: count for status, count in rows})
+        return counts
+
+    def get_stats(self) -> dict:
+        """取得佇列統計（深度、寫入延遲、排空延遲）"""
+        with self._counter_lock:
+            counters = {
+                "processed": self._processed,
+                "failed": self._failed,
+                "dead": self._dead,
+            }
+        return {
+            "depth": self.depth(),
+            "workers": len(self._workers),
+            **counters,
+            "enqueue_latency": self.enqueue_latency.snapshot(),
+            "drain_latency": self.drain_latency.snapshot(),
+        }
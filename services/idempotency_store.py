@@ -0,0 +1,177 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+
+class IdempotencyStore:
+    """
+    webhook 事件去重儲存（以 webhookEventId 為鍵）
+
+    預設使用有容量上限的記憶體 LRU；設定 use_database=True 時，
+    另外寫入 processed_events 資料表，讓多個節點共用同一份去重記錄。
+    所有記錄在 TTL 到期後失效。
+    """
+
+    def __init__(self, max_entries: int = None, ttl_seconds: float = None, use_database: bool = None):
+        self.max_entries = max_entries or int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+        self.ttl_seconds = ttl_seconds or float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "3600"))
+        if use_database is None:
+            use_database = os.getenv("IDEMPOTENCY_BACKEND", "memory").lower() == "database"
+        self.use_database = use_database
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._redeliveries = 0
+        self._evictions = 0
+        self._db_inserts = 0
+
+    def _expire(self, now: float):
+        """移除已過期的記錄（OrderedDict 依寫入時間排序，只需檢查開頭）"""
+        while self._entries:
+            event_id, marked_at = next(iter(self._entries.items()))
+            if now - marked_at < self.ttl_seconds:
+                break
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def _remember(self, event_id: str) -> bool:
+        """
+        記錄到記憶體
+
+        Returns:
+            bool: 第一次看到此事件返回 True，重複則返回 False
+        """
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if event_id in self._entries:
+                return False
+            self._entries[event_id] = now
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+            return True
+
+    def _remember_in_database(self, event_id: str) -> bool:
+        """
+        寫入 processed_events 資料表（INSERT ... ON CONFLICT DO NOTHING）
+
+        Returns:
+            bool: 第一次寫入返回 True，已存在則返回 False
+        """
+        from sqlalchemy.dialects.postgresql import insert
+        from models.database import get_session
+        from models.processed_event import ProcessedEvent
+
+        with get_session() as session:
+            result = session.execute(
+                insert(ProcessedEvent)
+                .values(webhook_event_id=event_id)
+                .on_conflict_do_nothing(index_elements=['webhook_event_id'])
+            )
+            inserted = result.rowcount == 1
+
+        with self._lock:
+            self._db_inserts += 1
+            should_purge = self._db_inserts % 500 == 0
+        if should_purge:
+            self.purge_expired()
+        return inserted
+
+    def check_and_mark(self, event) -> bool:
+        """
+        檢查事件是否為第一次處理，並標記為已處理
+
+        Args:
+            event: WebhookEvent
+
+        Returns:
+            bool: 應該處理返回 True，重複事件返回 False
+        """
+        event_id = event.webhook_event_id
+        if not event_id:
+            # 沒有 webhookEventId 時無法去重
+            return True
+
+        is_redelivery = event.is_redelivery
+        if is_redelivery:
+            with self._lock:
+                self._redeliveries += 1
+
+        first_seen = self._remember(event_id)
+        if first_seen and self.use_database:
+            try:
+                first_seen = self._remember_in_database(event_id)
+            except Exception as e:
+                # 資料庫無法使用時退回記憶體去重，不阻擋事件處理
+                print(f"⚠️  寫入事件去重記錄失敗: {str(e)}")
+
+        with self._lock:
+            if first_seen:
+                self._misses += 1
+            else:
+                self._hits += 1
+
+        if not first_seen:
+            print(f"♻️  重複事件已略過: {event_id} (isRedelivery={is_redelivery})")
+        return first_seen
+
+    def unmark(self, event):
+        """
+        移除事件的去重記錄（處理失敗時呼叫，讓佇列重試或 LINE 重送的同一事件能再次處理）
+
+        Args:
+            event: WebhookEvent
+        """
+        event_id = event.webhook_event_id
+        if not event_id:
+            return
+        with self._lock:
+            self._entries.pop(event_id, None)
+        if self.use_database:
+            try:
+                from sqlalchemy import delete
+                from models.database import get_session
+                from models.processed_event import ProcessedEvent
+
+                with get_session() as session:
+                    session.execute(
+                        delete(ProcessedEvent).where(ProcessedEvent.webhook_event_id == event_id)
+                    )
+            except Exception as e:
+                print(f"⚠️  移除事件去重記錄失敗: {str(e)}")
+
+    def purge_expired(self) -> int:
+        """刪除資料表中已過期的去重記錄"""
+        if not self.use_database:
+            return 0
+        try:
+            from sqlalchemy import delete
+            from models.database import get_session
+            from models.processed_event import ProcessedEvent
+
+            cutoff_time = datetime.now() - timedelta(seconds=self.ttl_seconds)
+            with get_session() as session:
+                result = session.execute(
+                    delete(ProcessedEvent).where(ProcessedEvent.created_at < cutoff_time)
+                )
+                return result.rowcount
+        except Exception as e:
+            print(f"⚠️  清理事件去重記錄失敗: {str(e)}")
+            return 0
+
+    def get_stats(self) -> dict:
+        """取得命中/未命中統計"""
+        with self._lock:
+            return {
+                "backend": "database" if self.use_database else "memory",
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "redeliveries": self._redeliveries,
+                "evictions": self._evictions,
+            }
@@ -0,0 +1,172 @@
+import io
+import multiprocessing
+import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from services.metrics import LatencyStats
+
+try:
+    # 圖片處理套件（requirements.txt 已包含；未安裝時不做前處理，原圖直接上傳）
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+PILLOW_AVAILABLE = Image is not None
+
+
+def _normalize_image(source, max_edge: int, quality: int):
+    """
+    在子程序中執行：套用 EXIF 方向後移除 EXIF、縮小到最長邊 max_edge、重新以 JPEG 編碼
+
+    Args:
+        source: 圖片檔案路徑或 bytes
+        max_edge: 最長邊像素
+        quality: JPEG 品質
+
+    Returns:
+        tuple: (新圖片 bytes（不需要處理時為 None）, 原始大小, 原始尺寸, 輸出尺寸)
+    """
+    if isinstance(source, str):
+        original_size = os.path.getsize(source)
+        image = Image.open(source)
+    else:
+        original_size = len(source)
+        image = Image.open(io.BytesIO(source))
+
+    with image:
+        original_format = image.format
+        original_dimensions = image.size
+        has_exif = bool(image.info.get("exif"))
+        rotated = image.getexif().get(0x0112, 1) != 1
+        # JPEG 解碼時直接以較小的比例解碼，省下縮圖前的記憶體與時間
+        image.draft("RGB", (max_edge, max_edge))
+        normalized = ImageOps.exif_transpose(image)
+        if max(normalized.size) > max_edge:
+            normalized.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        resized = normalized.size != original_dimensions
+        if normalized.mode not in ("RGB", "L"):
+            normalized = normalized.convert("RGB")
+
+        output = io.BytesIO()
+        normalized.save(output, "JPEG", quality=quality, optimize=True,
+                        icc_profile=image.info.get("icc_profile"))
+        data = output.getvalue()
+
+    # 原圖已是夠小的 JPEG、沒有 EXIF 且重新編碼沒有變小時，直接使用原圖
+    if original_format == "JPEG" and not (resized or rotated or has_exif) and len(data) >= original_size:
+        return None, original_size, original_dimensions, original_dimensions
+    return data, original_size, original_dimensions, normalized.size
+
+
+class ImagePreprocessor:
+    """
+    上傳 Replicate 前的圖片前處理
+
+    依模型縮小到最長邊上限、套用 EXIF 方向後移除 EXIF、以指定品質重新編碼為 JPEG，
+    縮短上傳與模型處理時間。解碼與縮圖在獨立的 process pool 執行，不佔用請求程序的 GIL；
+    前處理失敗或逾時時改用原圖，不影響工作本身。
+    """
+
+    def __init__(self, max_edge: int = None, quality: int = None, workers: int = None, timeout: float = None):
+        """
+        Args:
+            max_edge: 預設最長邊像素（可用 IMAGE_MAX_EDGE_<模型> 環境變數依模型覆寫）
+            quality: JPEG 品質
+            workers: 前處理子程序數
+            timeout: 等待前處理的秒數，逾時改用原圖
+        """
+        self.max_edge = max_edge or int(os.getenv("IMAGE_MAX_EDGE", "2048"))
+        self.quality = quality or int(os.getenv("IMAGE_JPEG_QUALITY", "90"))
+        self.workers = workers or int(os.getenv("IMAGE_PREPROCESS_WORKERS", "2"))
+        self.timeout = timeout or float(os.getenv("IMAGE_PREPROCESS_TIMEOUT", "30"))
+        # 以 spawn 啟動子程序：請求程序內已有排程器等多條執行緒，fork 可能複製到被鎖住的鎖
+        self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context("spawn"))
+
+        self._lock = threading.Lock()
+        self._jobs = 0
+        self._unchanged = 0
+        self._failures = 0
+        self._bytes_in = 0
+        self._bytes_out = 0
+        self._time_stats = LatencyStats()
+
+    def max_edge_for(self, model: str, default: int = None) -> int:
+        """
+        取得模型的最長邊上限
+
+        Args:
+            model: Replicate 模型名稱（例如 google/nano-banana → IMAGE_MAX_EDGE_GOOGLE_NANO_BANANA）
+            default: 功能宣告的上限（未設定時使用 IMAGE_MAX_EDGE）
+        """
+        env_name = "IMAGE_MAX_EDGE_" + re.sub(r"[^A-Z0-9]", "_", model.upper())
+        return int(os.getenv(env_name, default or self.max_edge))
+
+    def preprocess(self, image_file, model: str, max_edge: int = None):
+        """
+        前處理圖片
+
+        Args:
+            image_file: 圖片檔案物件（有檔案路徑時子程序直接讀檔）
+            model: Replicate 模型名稱
+            max_edge: 功能宣告的最長邊上限
+
+        Returns:
+            檔案物件：前處理後的 JPEG，不需要處理或失敗時為原本的 image_file（已移到開頭）
+        """
+        started = time.perf_counter()
+        path = getattr(image_file, "name", None)
+        if isinstance(path, str) and os.path.exists(path):
+            source = path
+        else:
+            image_file.seek(0)
+            source = image_file.read()
+
+        try:
+            future = self._executor.submit(_normalize_image, source, self.max_edge_for(model, max_edge), self.quality)
+            data, original_size, original_dimensions, dimensions = future.result(timeout=self.timeout)
+        except Exception as e:
+            with self._lock:
+                self._failures += 1
+            print(f"⚠️  圖片前處理失敗，改用原圖: {str(e)}")
+            image_file.seek(0)
+            return image_file
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self._time_stats.observe(elapsed_ms)
+        output_size = len(data) if data is not None else original_size
+        with self._lock:
+            self._jobs += 1
+            self._bytes_in += original_size
+            self._bytes_out += output_size
+            if data is None:
+                self._unchanged += 1
+
+        if data is None:
+            print(f"🖼️  圖片前處理: 原圖已符合需求 ({original_size} bytes)，耗時 {elapsed_ms:.0f} ms")
+            image_file.seek(0)
+            return image_file
+        saved = original_size - output_size
+        print(f"🖼️  圖片前處理: {original_dimensions[0]}x{original_dimensions[1]} → {dimensions[0]}x{dimensions[1]}，"
+              f"{original_size} → {output_size} bytes (省下 {saved} bytes)，耗時 {elapsed_ms:.0f} ms")
+        return io.BytesIO(data)
+
+    def get_stats(self) -> dict:
+        """取得前處理統計（處理數、節省的位元組與耗時直方圖）"""
+        with self._lock:
+            stats = {
+                "workers": self.workers,
+                "max_edge": self.max_edge,
+                "quality": self.quality,
+                "jobs": self._jobs,
+                "unchanged": self._unchanged,
+                "failures": self._failures,
+                "bytes_in": self._bytes_in,
+                "bytes_out": self._bytes_out,
+                "bytes_saved": self._bytes_in - self._bytes_out,
+            }
+        stats["time"] = self._time_stats.snapshot()
+        return stats
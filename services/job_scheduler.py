@@ -0,0 +1,103 @@
+import os
+import threading
+import time
+from collections import deque
+from services.metrics import LatencyStats
+
+
+class JobScheduler:
+    """
+    有上限的背景工作排程器（圖片處理等長時間工作）
+
+    固定數量的 worker 執行緒從佇列依序取出工作，佇列長度有上限；
+    佇列已滿時 submit 直接拒絕，讓呼叫端回覆用戶稍後再試，
+    而不是為每個請求開一條新執行緒直到記憶體用盡。
+    """
+
+    def __init__(self, workers: int = None, max_queue: int = None, name: str = "image-job"):
+        """
+        Args:
+            workers: 同時執行的工作數
+            max_queue: 等待中的工作上限
+            name: 執行緒名稱前綴
+        """
+        self.workers = workers or int(os.getenv("IMAGE_JOB_WORKERS", "4"))
+        self.max_queue = max_queue or int(os.getenv("IMAGE_JOB_QUEUE_SIZE", "20"))
+        self.name = name
+
+        self._jobs = deque()
+        self._cond = threading.Condition()
+        self._active = 0
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._wait_stats = LatencyStats()
+        self._run_stats = LatencyStats()
+        self._threads = []
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"{name}-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        提交工作
+
+        Args:
+            fn: 要執行的函式
+
+        Returns:
+            int: 排隊位置（0 表示立即執行，N 表示前面還有 N - 1 個工作在等待）；
+                 佇列已滿時返回 None
+        """
+        with self._cond:
+            if len(self._jobs) >= self.max_queue:
+                self._rejected += 1
+                return None
+            self._jobs.append((time.perf_counter(), fn, args, kwargs))
+            self._submitted += 1
+            position = max(0, len(self._jobs) - (self.workers - self._active))
+            self._cond.notify()
+        return position
+
+    def _worker_loop(self):
+        """worker 執行緒主迴圈"""
+        while True:
+            with self._cond:
+                while not self._jobs:
+                    self._cond.wait()
+                submitted_at, fn, args, kwargs = self._jobs.popleft()
+                self._active += 1
+            started = time.perf_counter()
+            self._wait_stats.observe((started - submitted_at) * 1000)
+            failed = False
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                failed = True
+                print(f"❌ 背景工作執行失敗: {str(e)}")
+            finally:
+                self._run_stats.observe((time.perf_counter() - started) * 1000)
+                with self._cond:
+                    self._active -= 1
+                    self._completed += 1
+                    if failed:
+                        self._failed += 1
+
+    def get_stats(self) -> dict:
+        """取得排程統計（執行中、排隊中、完成數與等待 / 執行時間直方圖）"""
+        with self._cond:
+            stats = {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "active": self._active,
+                "queued": len(self._jobs),
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+            }
+        stats["wait_time"] = self._wait_stats.snapshot()
+        stats["run_time"] = self._run_stats.snapshot()
+        return stats
@@ -0,0 +1,234 @@
+import os
+import random
+import re
+import threading
+import time
+import uuid
+import requests
+from requests.adapters import HTTPAdapter
+from linebot.http_client import HttpClient, RequestsHttpResponse
+from services.metrics import LatencyStats
+from services.rate_limiter import TokenBucket
+
+
+# 將 URL 中的 ID 類路徑片段歸為同一個端點，避免每個用戶各自一組統計
+_ID_SEGMENT = re.compile(r"/(?:[UCR][0-9a-f]{32}|\d+)(?=/|$)")
+
+
+def endpoint_name(method: str, url: str) -> str:
+    """
+    將請求轉為端點名稱（例如 "GET /v2/bot/profile/{id}"）
+
+    Args:
+        method: HTTP 方法
+        url: 完整請求 URL
+
+    Returns:
+        str: 端點名稱
+    """
+    path = url.split("://", 1)[-1]
+    path = path[path.find("/"):] if "/" in path else "/"
+    path = path.split("?", 1)[0]
+    return f"{method} {_ID_SEGMENT.sub('/{id}', path)}"
+
+
+def retry_after_seconds(response):
+    """解析 Retry-After 標頭（秒數），沒有或無法解析時回傳 None"""
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+class LineHttpClient(HttpClient):
+    """
+    共用連線池的 LINE API HTTP 客戶端
+
+    以單一 requests.Session 維持 keep-alive 連線，取代 RequestsHttpClient
+    每次呼叫 requests.get / requests.post 都重新建立 TLS 連線的做法。
+    建立 LineBotApi 時以 http_client=LineHttpClient 傳入，所有 reply / push /
+    profile / 下載內容以及載入動畫都經由同一個連線池，並記錄各端點的延遲。
+
+    送出前依端點取得 token bucket 的 token（依 LINE 文件的速率限制），
+    遇到 429 時依 Retry-After 或帶抖動的指數退避重試，突發流量會被平滑排隊而不是直接失敗。
+    5xx 只重試 GET 與帶 X-Line-Retry-Key 的請求：reply 等請求可能已被 LINE 接受，
+    重送會用掉已使用過的 reply token。
+    """
+
+    # LINE Messaging API 文件列出的速率限制：(端點前綴, 每秒請求數, 突發容量)
+    # 每個端點各自一個 bucket，大量 profile 查詢不會拖慢 reply / push；
+    # 未列出的端點共用 LINE_RATE_LIMIT_PER_SECOND（文件預設 2,000 req/s）
+    RATE_LIMITS = (
+        ("POST /v2/bot/message/multicast", 200, 200),
+        ("POST /v2/bot/message/narrowcast", 60 / 3600, 1),
+        ("POST /v2/bot/message/broadcast", 60 / 3600, 1),
+        ("POST /v2/bot/message/push", 2000, 2000),
+        ("POST /v2/bot/message/reply", 2000, 2000),
+        ("GET /v2/bot/profile", 2000, 2000),
+        ("GET /v2/bot/message/{id}/content", 2000, 2000),
+    )
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+    # 可帶 X-Line-Retry-Key 讓 LINE 端去重的端點，重試時不會重複發送
+    RETRY_KEY_ENDPOINTS = (
+        "POST /v2/bot/message/push",
+        "POST /v2/bot/message/multicast",
+        "POST /v2/bot/message/narrowcast",
+        "POST /v2/bot/message/broadcast",
+    )
+
+    def __init__(self, timeout=None, pool_size: int = None):
+        """
+        Args:
+            timeout: 逾時秒數或 (connect, read) tuple，未指定時使用環境變數
+            pool_size: 每個 host 的連線池大小
+        """
+        if timeout is None or timeout == HttpClient.DEFAULT_TIMEOUT:
+            timeout = (
+                float(os.getenv("LINE_HTTP_CONNECT_TIMEOUT", "3")),
+                float(os.getenv("LINE_HTTP_READ_TIMEOUT", "10")),
+            )
+        super().__init__(timeout)
+        self.pool_size = pool_size or int(os.getenv("LINE_HTTP_POOL_SIZE", "20"))
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.max_retries = int(os.getenv("LINE_HTTP_MAX_RETRIES", "3"))
+        self.backoff_base = float(os.getenv("LINE_HTTP_BACKOFF_BASE_SECONDS", "0.5"))
+        self.backoff_max = float(os.getenv("LINE_HTTP_BACKOFF_MAX_SECONDS", "10"))
+        self.default_rate = float(os.getenv("LINE_RATE_LIMIT_PER_SECOND", "2000"))
+
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._status_counts = {}
+        self._errors = {}
+        self._buckets = {}
+        self._retries = 0
+        self._retry_sleep_seconds = 0.0
+        self._gave_up = 0
+
+    def _bucket_for(self, name: str) -> TokenBucket:
+        """取得端點對應的 token bucket（同一限制群組共用一個 bucket）"""
+        key, rate, capacity = "default", self.default_rate, None
+        for prefix, limit, burst in self.RATE_LIMITS:
+            if name.startswith(prefix):
+                key, rate, capacity = prefix, limit, burst
+                break
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate, capacity)
+            return bucket
+
+    def _backoff_seconds(self, attempt: int, response) -> float:
+        """計算重試等待時間：優先使用 Retry-After，否則為 full jitter 指數退避"""
+        retry_after = retry_after_seconds(response)
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _request(self, method: str, url: str, timeout=None, headers=None, **kwargs):
+        """依端點限流送出請求，429（及可安全重送請求的 5xx）時退避重試，並記錄端點延遲"""
+        name = endpoint_name(method, url)
+        bucket = self._bucket_for(name)
+        if name in self.RETRY_KEY_ENDPOINTS:
+            headers = dict(headers or {})
+            headers.setdefault("X-Line-Retry-Key", str(uuid.uuid4()))
+        # 429 表示請求未被處理，一律可重試；5xx 只在重送不會造成重複處理時重試
+        retry_server_errors = method == "GET" or "X-Line-Retry-Key" in (headers or {})
+
+        attempt = 0
+        while True:
+            bucket.acquire()
+            started = time.perf_counter()
+            try:
+                response = self.session.request(
+                    method, url, headers=headers,
+                    timeout=timeout if timeout is not None else self.timeout, **kwargs
+                )
+            except requests.exceptions.RequestException:
+                self._record(name, started, None)
+                raise
+            self._record(name, started, response.status_code)
+
+            if response.status_code not in self.RETRY_STATUS_CODES:
+                return RequestsHttpResponse(response)
+            if response.status_code != 429 and not retry_server_errors:
+                return RequestsHttpResponse(response)
+            if attempt >= self.max_retries:
+                with self._lock:
+                    self._gave_up += 1
+                return RequestsHttpResponse(response)
+
+            delay = self._backoff_seconds(attempt, response)
+            if response.status_code == 429:
+                # 速率限制是整個端點共用的，暫停 bucket 讓其他請求一起放慢
+                bucket.pause(delay)
+            print(f"⏳ LINE API {name} 回應 {response.status_code}，{delay:.2f} 秒後重試（第 {attempt + 1} 次）")
+            response.close()
+            with self._lock:
+                self._retries += 1
+                self._retry_sleep_seconds += delay
+            if response.status_code != 429:
+                time.sleep(delay)
+            attempt += 1
+
+    def _record(self, name: str, started: float, status_code):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            stats = self._latency.get(name)
+            if stats is None:
+                stats = self._latency[name] = LatencyStats()
+            if status_code is None:
+                self._errors[name] = self._errors.get(name, 0) + 1
+            else:
+                codes = self._status_counts.setdefault(name, {})
+                codes[status_code] = codes.get(status_code, 0) + 1
+        stats.observe(elapsed_ms)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request("GET", url, headers=headers, params=params, stream=stream, timeout=timeout)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request("POST", url, headers=headers, data=data, timeout=timeout)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request("DELETE", url, headers=headers, data=data, timeout=timeout)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request("PUT", url, headers=headers, data=data, timeout=timeout)
+
+    def get_stats(self) -> dict:
+        """取得連線池設定與各端點延遲統計"""
+        with self._lock:
+            names = list(self._latency.keys())
+            status_counts = {name: dict(codes) for name, codes in self._status_counts.items()}
+            errors = dict(self._errors)
+            buckets = dict(self._buckets)
+            retry_stats = {
+                "retries": self._retries,
+                "retry_sleep_seconds": round(self._retry_sleep_seconds, 3),
+                "gave_up": self._gave_up,
+            }
+        bucket_stats = {key: bucket.get_stats() for key, bucket in buckets.items()}
+        return {
+            "pool_size": self.pool_size,
+            "timeout": self.timeout,
+            "queue_depth": sum(stats["waiting"] for stats in bucket_stats.values()),
+            "throttle_seconds": round(sum(stats["throttle_seconds"] for stats in bucket_stats.values()), 3),
+            "rate_limits": bucket_stats,
+            "retries": retry_stats,
+            "endpoints": {
+                name: dict(
+                    self._latency[name].snapshot(),
+                    status_counts=status_counts.get(name, {}),
+                    network_errors=errors.get(name, 0),
+                )
+                for name in names
+            },
+        }
@@ -2,6 +2,7 @@ from datetime import datetime
 from models.database import get_session
 from models.member import Member
 from models.point_transaction import PointTransaction
+from models.outbox_message import OutboxMessage
 
 
 class MemberService:
@@ -137,7 +138,7 @@ class MemberService:
                 print(f"❌ 增加點數失敗: {str(e)}")
                 return False
     
-    def deduct_points(self, user_id, points, description=None):
+    def deduct_points(self, user_id, points, description=None, outbox=None):
         """
         扣除點數並記錄交易
         
@@ -145,6 +146,8 @@ class MemberService:
             user_id: LINE user ID
             points: 要扣除的點數（正數）
             description: 交易說明
+            outbox: (target_id, messages)，與扣點在同一交易中寫入 outbox，
+                    扣點成功才會送出（由 OutboxDispatcher 負責推送）
             
         Returns:
             bool: 成功返回 True，餘額不足或失敗返回 False
@@ -180,6 +183,11 @@ class MemberService:
                 )
                 session.add(transaction)
                 
+                # 待送出的結果與扣點一起提交
+                if outbox is not None:
+                    target_id, messages = outbox
+                    session.add(OutboxMessage.create(target_id, messages))
+                
                 session.commit()
                 print(f"✅ 點數已扣除: {user_id} (-{points}), 餘額: {new_balance}")
                 return True
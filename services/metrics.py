@@ -0,0 +1,43 @@
+import threading
+
+
+class LatencyStats:
+    """執行緒安全的延遲統計（次數、平均、最大值與分桶直方圖）"""
+
+    # 直方圖分桶上限（毫秒），最後一桶收集所有超出上限的值
+    DEFAULT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+    def __init__(self, buckets_ms=None):
+        self.buckets_ms = tuple(buckets_ms or self.DEFAULT_BUCKETS_MS)
+        self._lock = threading.Lock()
+        self._count = 0
+        self._total_ms = 0.0
+        self._max_ms = 0.0
+        self._bucket_counts = [0] * (len(self.buckets_ms) + 1)
+
+    def observe(self, elapsed_ms: float):
+        """記錄一次耗時（毫秒）"""
+        index = len(self.buckets_ms)
+        for i, upper in enumerate(self.buckets_ms):
+            if elapsed_ms <= upper:
+                index = i
+                break
+
+        with self._lock:
+            self._count += 1
+            self._total_ms += elapsed_ms
+            if elapsed_ms > self._max_ms:
+                self._max_ms = elapsed_ms
+            self._bucket_counts[index] += 1
+
+    def snapshot(self) -> dict:
+        """取得目前統計數據"""
+        with self._lock:
+            histogram = {f"<={upper}ms": count for upper, count in zip(self.buckets_ms, self._bucket_counts)}
+            histogram[f">{self.buckets_ms[-1]}ms"] = self._bucket_counts[-1]
+            return {
+                "count": self._count,
+                "avg_ms": round(self._total_ms / self._count, 3) if self._count else 0.0,
+                "max_ms": round(self._max_ms, 3),
+                "histogram": histogram,
+            }
@@ -0,0 +1,227 @@
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import timedelta
+from sqlalchemy import func
+from models.database import get_session
+from models.outbox_message import OutboxMessage
+
+# 由 outbox ID 產生固定的 X-Line-Retry-Key，重複送出時 LINE 會以 409 拒絕而不是再推一次
+_RETRY_KEY_NAMESPACE = uuid.UUID("6f1c2b4e-8a0d-4b1e-9c55-3d2f7a9e4c10")
+
+
+def outbox_stats() -> dict:
+    """
+    查詢 outbox 的積壓狀況
+
+    Returns:
+        dict: pending / dead 筆數與最舊待送訊息的等待秒數
+    """
+    with get_session() as session:
+        now, oldest, pending = session.query(
+            func.now(), func.min(OutboxMessage.created_at), func.count(OutboxMessage.id)
+        ).filter(OutboxMessage.status == 'pending').one()
+        dead = session.query(func.count(OutboxMessage.id)).filter(OutboxMessage.status == 'dead').scalar()
+    if oldest is not None and now is not None:
+        oldest_age = max(0.0, (now.replace(tzinfo=None) - oldest.replace(tzinfo=None)).total_seconds())
+    else:
+        oldest_age = 0.0
+    return {
+        "depth": pending,
+        "oldest_age_seconds": round(oldest_age, 3),
+        "dead": dead,
+    }
+
+
+class OutboxDispatcher:
+    """
+    outbox 推送程序
+
+    批次取出到期的 pending 訊息（Postgres 使用 FOR UPDATE SKIP LOCKED，多個程序可同時運行），
+    先把 available_at 往後推一個租約時間再送出；程序在送出途中被終止時，租約到期後會被重新取出。
+    每筆訊息以固定的 X-Line-Retry-Key 推送，重新送出時不會讓用戶收到兩次。
+    已送出超過保留時間的記錄由 run_forever 定期分批刪除，outbox 資料表不會無限成長。
+    """
+
+    def __init__(self, line_bot_api, batch_size: int = None, poll_interval: float = None,
+                 lease_seconds: float = None, max_attempts: int = None):
+        self.line_bot_api = line_bot_api
+        self.batch_size = batch_size or int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+        self.poll_interval = poll_interval or float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
+        self.lease_seconds = lease_seconds or float(os.getenv("OUTBOX_LEASE_SECONDS", "60"))
+        self.max_attempts = max_attempts or int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+        self.sent_retention_hours = float(os.getenv("OUTBOX_SENT_RETENTION_HOURS", "24"))
+        self.purge_interval = float(os.getenv("OUTBOX_PURGE_INTERVAL", "600"))
+        self.purge_batch_size = int(os.getenv("OUTBOX_PURGE_BATCH_SIZE", "1000"))
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._sent = 0
+        self._failed = 0
+        self._dead = 0
+        self._batches = 0
+        self._purged = 0
+
+    def _claim_batch(self) -> list:
+        """取出一批到期訊息並延後其 available_at（租約）"""
+        with get_session() as session:
+            rows = session.query(OutboxMessage)\
+                .filter(OutboxMessage.status == 'pending', OutboxMessage.available_at <= func.now())\
+                .order_by(OutboxMessage.id)\
+                .limit(self.batch_size)\
+                .with_for_update(skip_locked=True)\
+                .all()
+            # 以資料庫時鐘計算租約，避免與應用程式主機的時區 / 時鐘差異
+            lease_until = session.query(func.now()).scalar() + timedelta(seconds=self.lease_seconds)
+            claimed = []
+            for row in rows:
+                row.attempts += 1
+                row.available_at = lease_until
+                claimed.append((row.id, row.target_id, row.payload, row.attempts))
+            session.commit()
+            return claimed
+
+    def _send(self, message_id: int, target_id: str, payload: str):
+        """
+        推送一筆訊息
+
+        Returns:
+            tuple: (是否成功, 是否為永久性錯誤, 錯誤訊息)
+        """
+        headers = dict(self.line_bot_api.headers)
+        headers['X-Line-Retry-Key'] = str(uuid.uuid5(_RETRY_KEY_NAMESPACE, str(message_id)))
+        response = self.line_bot_api.http_client.post(
+            self.line_bot_api.endpoint + '/v2/bot/message/push',
+            headers=headers,
+            data=json.dumps({"to": target_id, "messages": json.loads(payload)})
+        )
+        # 409：同一個 retry key 已被接受過（先前的送出其實已成功）
+        if response.status_code in (200, 409):
+            return True, False, None
+        permanent = 400 <= response.status_code < 500 and response.status_code != 429
+        return False, permanent, f"{response.status_code} {response.text[:200]}"
+
+    def _finish(self, message_id: int, attempts: int, ok: bool, permanent: bool, error: str):
+        """依送出結果更新 outbox 記錄"""
+        with get_session() as session:
+            row = session.get(OutboxMessage, message_id)
+            if row is None:
+                return
+            now = session.query(func.now()).scalar()
+            if ok:
+                row.status = 'sent'
+                row.sent_at = now
+                row.last_error = None
+            elif permanent or attempts >= self.max_attempts:
+                row.status = 'dead'
+                row.last_error = error
+            else:
+                # 指數退避後重試
+                row.available_at = now + timedelta(seconds=min(300, 2 ** attempts))
+                row.last_error = error
+            session.commit()
+
+        with self._lock:
+            if ok:
+                self._sent += 1
+            elif permanent or attempts >= self.max_attempts:
+                self._dead += 1
+                print(f"💀 outbox 訊息 {message_id} 放棄推送: {error}")
+            else:
+                self._failed += 1
+                print(f"⚠️  outbox 訊息 {message_id} 推送失敗，稍後重試: {error}")
+
+    def run_once(self) -> int:
+        """
+        處理一批訊息
+
+        Returns:
+            int: 本批處理的筆數
+        """
+        claimed = self._claim_batch()
+        for message_id, target_id, payload, attempts in claimed:
+            try:
+                ok, permanent, error = self._send(message_id, target_id, payload)
+            except Exception as e:
+                ok, permanent, error = False, False, str(e)
+            self._finish(message_id, attempts, ok, permanent, error)
+        if claimed:
+            with self._lock:
+                self._batches += 1
+        return len(claimed)
+
+    def purge_sent(self) -> int:
+        """
+        分批刪除已送出超過 sent_retention_hours 的記錄（每批一個短交易）
+
+        Returns:
+            int: 刪除筆數
+        """
+        total = 0
+        while not self._stop.is_set():
+            with get_session() as session:
+                cutoff = session.query(func.now()).scalar() - timedelta(hours=self.sent_retention_hours)
+                ids = [message_id for (message_id,) in session.query(OutboxMessage.id)
+                       .filter(OutboxMessage.status == 'sent', OutboxMessage.sent_at < cutoff)
+                       .order_by(OutboxMessage.sent_at)
+                       .limit(self.purge_batch_size)]
+                if ids:
+                    session.query(OutboxMessage).filter(OutboxMessage.id.in_(ids))\
+                        .delete(synchronize_session=False)
+                    session.commit()
+            total += len(ids)
+            if len(ids) < self.purge_batch_size:
+                break
+        if total:
+            with self._lock:
+                self._purged += total
+            print(f"🧹 已刪除 {total} 筆已送出的 outbox 記錄")
+        return total
+
+    def run_forever(self):
+        """持續處理直到 stop()（每 purge_interval 秒清理一次已送出的記錄）"""
+        print(f"📮 Outbox dispatcher 啟動（batch={self.batch_size}, lease={self.lease_seconds}s）")
+        next_purge = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                processed = self.run_once()
+                if self.purge_interval > 0 and time.monotonic() >= next_purge:
+                    next_purge = time.monotonic() + self.purge_interval
+                    self.purge_sent()
+            except Exception as e:
+                print(f"❌ Outbox dispatcher 錯誤: {str(e)}")
+                processed = 0
+            # 一批滿載時立即繼續，否則等待下一輪
+            if processed < self.batch_size:
+                self._stop.wait(self.poll_interval)
+        print("📮 Outbox dispatcher 已停止")
+
+    def start(self):
+        """在背景執行緒中運行（web 程序內嵌模式）"""
+        self._thread = threading.Thread(target=self.run_forever, name="outbox-dispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止背景執行緒"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def get_stats(self) -> dict:
+        """取得 outbox 積壓與本程序的送出統計"""
+        with self._lock:
+            stats = {
+                "sent": self._sent,
+                "retried": self._failed,
+                "gave_up": self._dead,
+                "batches": self._batches,
+                "purged": self._purged,
+            }
+        try:
+            stats.update(outbox_stats())
+        except Exception as e:
+            stats["error"] = str(e)
+        return stats
@@ -0,0 +1,133 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from linebot.exceptions import LineBotApiError
+
+
+class ProfileCache:
+    """
+    LINE 用戶 profile 快取（TTL + LRU）
+
+    - 成功取得的 profile 快取 ttl_seconds 秒，超過 max_entries 時淘汰最久未使用的項目
+    - 404 / 403（用戶不存在或未加好友）做短時間的負面快取，避免反覆查詢
+    - 同一用戶同時發生的多個未命中只會送出一次 get_profile，其他呼叫等待同一個結果
+    - follow / unfollow 事件時呼叫 invalidate() 讓快取失效
+    """
+
+    NEGATIVE_STATUS_CODES = (403, 404)
+
+    def __init__(self, line_bot_api, ttl_seconds: float = None, max_entries: int = None,
+                 negative_ttl_seconds: float = None):
+        self.line_bot_api = line_bot_api
+        self.ttl_seconds = ttl_seconds or float(os.getenv("PROFILE_CACHE_TTL_SECONDS", "600"))
+        self.max_entries = max_entries or int(os.getenv("PROFILE_CACHE_MAX_ENTRIES", "5000"))
+        self.negative_ttl_seconds = negative_ttl_seconds or float(os.getenv("PROFILE_CACHE_NEGATIVE_TTL_SECONDS", "30"))
+
+        # user_id -> (expires_at, profile, error)
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._negative_hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def get_profile(self, user_id: str, on_fetch=None):
+        """
+        取得用戶 profile
+
+        Args:
+            user_id: LINE user ID
+            on_fetch: 實際呼叫 LINE API 時執行的回呼（用於統計外部呼叫次數）
+
+        Raises:
+            LineBotApiError: 用戶不存在或無權限（可能來自負面快取）
+            Exception: 其他 get_profile 錯誤（不會被快取）
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                expires_at, profile, error = entry
+                if expires_at > now:
+                    self._entries.move_to_end(user_id)
+                    if error is not None:
+                        self._negative_hits += 1
+                        raise error
+                    self._hits += 1
+                    return profile
+                del self._entries[user_id]
+
+            future = self._inflight.get(user_id)
+            if future is not None:
+                # 已有其他執行緒正在查詢同一用戶，等待其結果
+                self._coalesced += 1
+                is_leader = False
+            else:
+                future = Future()
+                self._inflight[user_id] = future
+                self._misses += 1
+                is_leader = True
+
+        if not is_leader:
+            return future.result()
+
+        if on_fetch is not None:
+            on_fetch()
+        try:
+            profile = self.line_bot_api.get_profile(user_id)
+        except LineBotApiError as e:
+            if getattr(e, 'status_code', None) in self.NEGATIVE_STATUS_CODES:
+                self._store(user_id, None, e, self.negative_ttl_seconds)
+            self._finish(user_id, future, error=e)
+            raise
+        except Exception as e:
+            self._finish(user_id, future, error=e)
+            raise
+
+        self._store(user_id, profile, None, self.ttl_seconds)
+        self._finish(user_id, future, profile=profile)
+        return profile
+
+    def _store(self, user_id: str, profile, error, ttl: float):
+        """寫入快取並依容量淘汰最久未使用的項目"""
+        with self._lock:
+            self._entries[user_id] = (time.time() + ttl, profile, error)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def _finish(self, user_id: str, future: Future, profile=None, error: Exception = None):
+        """通知等待中的呼叫並移除 in-flight 記錄"""
+        with self._lock:
+            self._inflight.pop(user_id, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(profile)
+
+    def invalidate(self, user_id: str):
+        """讓指定用戶的快取失效（follow / unfollow 時呼叫）"""
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self._invalidations += 1
+
+    def get_stats(self) -> dict:
+        """取得快取統計"""
+        with self._lock:
+            lookups = self._hits + self._negative_hits + self._misses + self._coalesced
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "negative_hits": self._negative_hits,
+                "misses": self._misses,
+                "coalesced": self._coalesced,
+                "evictions": self._evictions,
+                "invalidations": self._invalidations,
+                "hit_rate": round((self._hits + self._negative_hits) / lookups, 3) if lookups else 0.0,
+            }
@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+from concurrent.futures import Future
+from services.sharded_executor import ShardedExecutor
+
+
+class PushCoalescer:
+    """
+    推送訊息合併緩衝區
+
+    同一個目標（userId / groupId / roomId）在短時間內的多次推送會暫存起來，
+    到達期限或累積滿 5 則（LINE 單次 push 上限）時合併成一次 push_message 呼叫，
+    減少 API 呼叫次數與訊息配額的使用。
+
+    實際送出交給依目標分片的 ShardedExecutor，同一目標的訊息維持原本順序。
+    每次 push 返回 Future，在該次的訊息全部送出後完成（送出失敗時帶有例外）；
+    呼叫端需要依結果處理的推送（例如付費結果）以 send_now 單獨送出，不與其他訊息合併，
+    但仍排在同一目標已緩衝的提示之後，維持訊息順序。
+    """
+
+    MAX_MESSAGES_PER_PUSH = 5
+
+    def __init__(self, send, window_seconds: float = None, workers: int = None):
+        """
+        Args:
+            send: 實際送出的函式 send(target_id, messages)，通常為 line_bot_api.push_message
+            window_seconds: 第一則訊息進入緩衝區後最多等待的秒數
+            workers: 送出執行緒數量
+        """
+        self.send = send
+        self.window_seconds = window_seconds if window_seconds is not None else \
+            int(os.getenv("PUSH_COALESCE_WINDOW_MS", "300")) / 1000
+        self._executor = ShardedExecutor(workers or int(os.getenv("PUSH_COALESCE_WORKERS", "4")), name="push")
+
+        # target_id -> (deadline, [(message, future, 是否為該次 push 的最後一則)])
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._running = True
+        self._requested = 0
+        self._messages = 0
+        self._api_calls = 0
+        self._failures = 0
+
+        self._flusher = threading.Thread(target=self._flush_loop, name="push-coalescer", daemon=True)
+        self._flusher.start()
+
+    def push(self, target_id: str, messages):
+        """
+        將訊息加入目標的緩衝區（滿 5 則時立即送出）
+
+        Args:
+            target_id: 推送目標 ID
+            messages: 單一訊息或訊息列表
+
+        Returns:
+            Future: 這些訊息全部送出後完成；送出失敗時 exception() 為失敗原因
+        """
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        future = Future()
+        if not messages:
+            future.set_result(None)
+            return future
+
+        with self._condition:
+            self._requested += 1
+            self._messages += len(messages)
+            deadline, pending = self._pending.get(target_id, (time.monotonic() + self.window_seconds, []))
+            pending.extend((message, future, index == len(messages) - 1) for index, message in enumerate(messages))
+            while len(pending) >= self.MAX_MESSAGES_PER_PUSH:
+                self._submit(target_id, pending[:self.MAX_MESSAGES_PER_PUSH])
+                pending = pending[self.MAX_MESSAGES_PER_PUSH:]
+            if pending:
+                self._pending[target_id] = (deadline, pending)
+                self._condition.notify()
+            else:
+                self._pending.pop(target_id, None)
+        return future
+
+    def send_now(self, target_id: str, messages) -> Future:
+        """
+        立即單獨送出（不與其他訊息合併），同一目標緩衝中的訊息會先送出
+
+        Args:
+            target_id: 推送目標 ID
+            messages: 單一訊息或訊息列表（最多 5 則）
+
+        Returns:
+            Future: 送出結果；送出失敗時 exception() 為失敗原因
+        """
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        future = Future()
+        with self._condition:
+            pending = self._pending.pop(target_id, None)
+            if pending is not None:
+                self._submit(target_id, pending[1])
+            self._submit(target_id, [(message, future, index == len(messages) - 1)
+                                     for index, message in enumerate(messages)])
+        return future
+
+    def _submit(self, target_id: str, batch: list):
+        """交給目標所屬的分片送出（呼叫時需持有 self._condition）"""
+        self._api_calls += 1
+        self._executor.submit(target_id, self._send, target_id, batch)
+
+    def _send(self, target_id: str, batch: list):
+        messages = [message for message, _, _ in batch]
+        try:
+            self.send(target_id, messages if len(messages) > 1 else messages[0])
+        except Exception as e:
+            with self._condition:
+                self._failures += 1
+            print(f"❌ 合併推送失敗 {target_id}（{len(messages)} 則）: {str(e)}")
+            # 同一目標依序送出，先失敗的批次會讓跨批次的 push 以此例外完成
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for _, future, is_last in batch:
+            if is_last and not future.done():
+                future.set_result(None)
+
+    def _flush_loop(self):
+        """到期的緩衝區送出"""
+        with self._condition:
+            while self._running:
+                now = time.monotonic()
+                due = [target_id for target_id, (deadline, _) in self._pending.items() if deadline <= now]
+                for target_id in due:
+                    self._submit(target_id, self._pending.pop(target_id)[1])
+                if self._pending:
+                    next_deadline = min(deadline for deadline, _ in self._pending.values())
+                    self._condition.wait(max(0.0, next_deadline - now))
+                else:
+                    self._condition.wait()
+
+    def flush(self):
+        """立即送出所有緩衝中的訊息"""
+        with self._condition:
+            for target_id in list(self._pending.keys()):
+                self._submit(target_id, self._pending.pop(target_id)[1])
+
+    def get_stats(self) -> dict:
+        """取得合併統計"""
+        with self._condition:
+            pending_messages = sum(len(batch) for _, batch in self._pending.values())
+            return {
+                "window_ms": round(self.window_seconds * 1000),
+                "push_requests": self._requested,
+                "messages": self._messages,
+                "api_calls": self._api_calls,
+                "pending_targets": len(self._pending),
+                "pending_messages": pending_messages,
+                "failures": self._failures,
+                "send_queue": self._executor.get_stats()["queued"],
+            }
+
+    def shutdown(self):
+        """送出剩餘訊息並停止"""
+        self.flush()
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._executor.shutdown()
@@ -0,0 +1,87 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    執行緒安全的 token bucket 限流器
+
+    以固定速率補充 token，acquire() 在 token 不足時阻塞等待，
+    讓突發流量被平滑成穩定的送出速率；pause() 可在收到 429 的
+    Retry-After 時暫停整個 bucket，讓同一端點的其他請求一起放慢。
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        Args:
+            rate: 每秒補充的 token 數
+            capacity: bucket 容量（允許的突發數量），預設等於 rate（至少 1）
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+        self._waiting = 0
+        self._acquired = 0
+        self._throttled = 0
+        self._throttle_seconds = 0.0
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated_at
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated_at = now
+
+    def acquire(self) -> float:
+        """
+        取得一個 token，不足時阻塞等待
+
+        Returns:
+            float: 等待的秒數
+        """
+        waited = 0.0
+        with self._lock:
+            self._waiting += 1
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if now >= self._paused_until and self._tokens >= 1:
+                        self._tokens -= 1
+                        self._acquired += 1
+                        if waited > 0:
+                            self._throttled += 1
+                            self._throttle_seconds += waited
+                        return waited
+                    if now < self._paused_until:
+                        delay = self._paused_until - now
+                    else:
+                        delay = (1 - self._tokens) / self.rate
+                time.sleep(delay)
+                waited += delay
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def pause(self, seconds: float):
+        """暫停發放 token（例如依 Retry-After 退避）"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = 0.0
+
+    def get_stats(self) -> dict:
+        """取得限流統計"""
+        with self._lock:
+            return {
+                "rate_per_second": self.rate,
+                "waiting": self._waiting,
+                "acquired": self._acquired,
+                "throttled": self._throttled,
+                "throttle_seconds": round(self._throttle_seconds, 3),
+            }
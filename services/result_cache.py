@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import timedelta
+import requests
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from models.database import get_session
+from models.replicate_result import ReplicateResult
+from services.blob_store import BlobStore
+
+# 輸出圖片的 Content-Type 與網址副檔名
+CONTENT_TYPES = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/webp": "webp",
+    "image/gif": "gif",
+}
+EXTENSION_MIMETYPES = {extension: content_type for content_type, extension in CONTENT_TYPES.items()}
+
+
+class ResultCache:
+    """
+    Replicate 結果快取
+
+    以（輸入圖片 SHA-256、模型、參數）為鍵值：索引存在 replicate_results 資料表，
+    輸出圖片下載到本機 blob store（依容量 LRU 淘汰），由 /results/<blob_key>.<副檔名>
+    經 PUBLIC_BASE_URL 提供給 LINE（Replicate 的輸出網址會過期，不能直接快取網址）。
+    超過 max_age_hours 的結果視為過期並定期清除。
+    命中快取時依 charge_percent 扣點（100 為原價，0 為免費）。
+    """
+
+    def __init__(self, public_base_url: str, blob_store: BlobStore = None, max_age_hours: float = None,
+                 charge_percent: int = None):
+        """
+        Args:
+            public_base_url: 對外網址（LINE 需要可從外部以 HTTPS 存取）
+            blob_store: 輸出圖片的儲存（預設 RESULT_CACHE_PATH / RESULT_CACHE_MAX_BYTES）
+            max_age_hours: 結果保留的小時數
+            charge_percent: 命中快取時收取的點數百分比
+        """
+        self.public_base_url = public_base_url.rstrip("/")
+        self.blob_store = blob_store or BlobStore(
+            root=os.getenv("RESULT_CACHE_PATH", "result_cache"),
+            max_bytes=int(os.getenv("RESULT_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+        )
+        self.max_age_hours = max_age_hours or float(os.getenv("RESULT_CACHE_MAX_AGE_HOURS", "168"))
+        self.charge_percent = charge_percent if charge_percent is not None else \
+            int(os.getenv("RESULT_CACHE_CHARGE_PERCENT", "100"))
+        self.prune_interval = float(os.getenv("RESULT_CACHE_PRUNE_INTERVAL", "3600"))
+
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+        self._hits = 0
+        self._misses = 0
+        self._stores = 0
+        self._store_failures = 0
+        self._pruned = 0
+
+    @staticmethod
+    def make_key(image_sha256: str, model: str, params: dict = None) -> str:
+        """計算快取鍵值（參數以排序後的 JSON 表示）"""
+        raw = json.dumps([image_sha256, model, params or {}], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def url_for(self, blob_key: str, extension: str) -> str:
+        """輸出圖片的對外網址"""
+        return f"{self.public_base_url}/results/{blob_key}.{extension}"
+
+    def charge_for_hit(self, points: int) -> int:
+        """命中快取時應扣除的點數"""
+        return max(0, round(points * self.charge_percent / 100))
+
+    def get(self, image_sha256: str, model: str, params: dict = None):
+        """
+        查詢快取
+
+        Returns:
+            str: 快取結果的對外網址（未命中返回 None）
+        """
+        cache_key = self.make_key(image_sha256, model, params)
+        with get_session() as session:
+            row = session.get(ReplicateResult, cache_key)
+            url = None
+            if row is not None:
+                now = session.query(func.now()).scalar().replace(tzinfo=None)
+                expired = row.created_at < now - timedelta(hours=self.max_age_hours)
+                if expired or not self.blob_store.exists(row.blob_key):
+                    # 已過期或輸出圖片已被容量淘汰
+                    session.delete(row)
+                else:
+                    row.hits += 1
+                    row.last_hit_at = now
+                    url = self.url_for(row.blob_key, row.extension)
+                session.commit()
+
+        with self._lock:
+            if url:
+                self._hits += 1
+            else:
+                self._misses += 1
+        return url
+
+    def put(self, image_sha256: str, model: str, params: dict, output_url: str) -> bool:
+        """
+        下載 Replicate 的輸出並寫入快取（失敗只記錄，不影響結果送出）
+
+        Returns:
+            bool: 是否成功寫入
+        """
+        try:
+            with requests.get(output_url, stream=True, timeout=(3, 30)) as response:
+                response.raise_for_status()
+                content_type = response.headers.get("Content-Type", "image/jpeg").split(";")[0].strip()
+                extension = CONTENT_TYPES.get(content_type, "jpg")
+                blob_key = self.blob_store.put(response.iter_content(chunk_size=64 * 1024))
+
+            with get_session() as session:
+                session.merge(ReplicateResult(
+                    cache_key=self.make_key(image_sha256, model, params),
+                    image_sha256=image_sha256,
+                    model=model,
+                    params=json.dumps(params or {}, sort_keys=True, ensure_ascii=False),
+                    blob_key=blob_key,
+                    extension=extension,
+                    size_bytes=os.path.getsize(self.blob_store.path_for(blob_key)),
+                    hits=0
+                ))
+                try:
+                    session.commit()
+                except IntegrityError:
+                    # 另一個程序同時寫入了相同的結果
+                    session.rollback()
+            with self._lock:
+                self._stores += 1
+        except Exception as e:
+            with self._lock:
+                self._store_failures += 1
+            print(f"⚠️  Replicate 結果快取寫入失敗: {str(e)}")
+            return False
+
+        self._maybe_prune()
+        return True
+
+    def _maybe_prune(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_prune < self.prune_interval:
+                return
+            self._last_prune = now
+        try:
+            self.prune()
+        except Exception as e:
+            print(f"⚠️  清除過期 Replicate 結果快取失敗: {str(e)}")
+
+    def prune(self, batch_size: int = 500) -> int:
+        """
+        分批刪除過期的快取結果與其輸出圖片
+
+        Returns:
+            int: 刪除筆數
+        """
+        total = 0
+        while True:
+            with get_session() as session:
+                now = session.query(func.now()).scalar().replace(tzinfo=None)
+                rows = session.query(ReplicateResult)\
+                    .filter(ReplicateResult.created_at < now - timedelta(hours=self.max_age_hours))\
+                    .order_by(ReplicateResult.created_at)\
+                    .limit(batch_size)\
+                    .all()
+                blob_keys = [row.blob_key for row in rows]
+                for row in rows:
+                    session.delete(row)
+                session.commit()
+            for blob_key in blob_keys:
+                self.blob_store.delete(blob_key)
+            total += len(blob_keys)
+            if len(blob_keys) < batch_size:
+                break
+        with self._lock:
+            self._pruned += total
+        if total:
+            print(f"🧹 已清除 {total} 筆過期的 Replicate 結果快取")
+        return total
+
+    def get_stats(self) -> dict:
+        """取得快取統計"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            stats = {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 3) if lookups else 0.0,
+                "stores": self._stores,
+                "store_failures": self._store_failures,
+                "pruned": self._pruned,
+                "charge_percent": self.charge_percent,
+            }
+        stats["storage"] = self.blob_store.get_stats()
+        return stats
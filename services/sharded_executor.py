@@ -0,0 +1,83 @@
+import os
+import queue
+import threading
+import zlib
+from concurrent.futures import Future
+
+
+class ShardedExecutor:
+    """
+    依鍵值分片的執行器
+
+    相同鍵值（例如同一個 userId）的工作永遠落在同一個分片，由該分片的專屬執行緒依序執行；
+    不同分片之間互不阻塞並行執行。這樣同一用戶的狀態機不會發生競爭，不同用戶又能同時處理。
+    """
+
+    def __init__(self, shard_count: int = None, name: str = "shard"):
+        self.shard_count = shard_count or int(os.getenv("EVENT_SHARDS", "8"))
+        self._queues = [queue.Queue() for _ in range(self.shard_count)]
+        self._processed = [0] * self.shard_count
+        self._threads = []
+        for index in range(self.shard_count):
+            thread = threading.Thread(
+                target=self._shard_loop,
+                args=(index,),
+                name=f"{name}-{index}",
+                daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def shard_for(self, key: str) -> int:
+        """計算鍵值所屬的分片（使用穩定雜湊，跨程序一致）"""
+        return zlib.crc32((key or '').encode('utf-8')) % self.shard_count
+
+    def submit(self, key: str, fn, *args, **kwargs) -> Future:
+        """
+        提交工作到鍵值對應的分片
+
+        Args:
+            key: 分片鍵值（userId / groupId / roomId）
+            fn: 要執行的函式
+
+        Returns:
+            Future: 工作結果
+        """
+        future = Future()
+        self._queues[self.shard_for(key)].put((future, fn, args, kwargs))
+        return future
+
+    def _shard_loop(self, index: int):
+        """分片執行緒主迴圈"""
+        work_queue = self._queues[index]
+        while True:
+            item = work_queue.get()
+            if item is None:
+                break
+            future, fn, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                self._processed[index] += 1
+
+    def get_stats(self) -> dict:
+        """取得各分片的排隊數與已處理數"""
+        depths = [work_queue.qsize() for work_queue in self._queues]
+        return {
+            "shards": self.shard_count,
+            "queued": sum(depths),
+            "max_shard_queued": max(depths) if depths else 0,
+            "processed": sum(self._processed),
+        }
+
+    def shutdown(self, wait: bool = True):
+        """停止所有分片執行緒（已排入的工作會先執行完）"""
+        for work_queue in self._queues:
+            work_queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
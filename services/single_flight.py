@@ -0,0 +1,149 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    相同工作的 in-flight 合併（single-flight）
+
+    同一個鍵值同時只會有一個呼叫（leader）實際執行，
+    同一程序內並行的重複呼叫等待 leader 的 Future 並取得相同的結果。
+
+    提供 engine（Postgres）時另外以 advisory lock 協調多個工作程序：
+    leader 先取得以鍵值雜湊為編號的 advisory lock，取得後呼叫 recheck
+    （例如查詢結果快取）確認其他程序是否已完成同一工作，沒有才實際執行。
+    """
+
+    def __init__(self, engine=None, lock_timeout: float = None, poll_interval: float = 0.5):
+        """
+        Args:
+            engine: SQLAlchemy engine（非 Postgres 時只做程序內合併）
+            lock_timeout: 等待其他程序釋放 advisory lock 的秒數，逾時後直接執行
+            poll_interval: 嘗試取得 advisory lock 的間隔秒數
+        """
+        self.engine = engine if engine is not None and engine.dialect.name == "postgresql" else None
+        self.lock_timeout = lock_timeout or float(os.getenv("SINGLE_FLIGHT_LOCK_TIMEOUT", "300"))
+        self.poll_interval = poll_interval
+
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._leaders = 0
+        self._coalesced = 0
+        self._lock_waits = 0
+        self._lock_timeouts = 0
+        self._rechecked = 0
+
+    @staticmethod
+    def advisory_key(key: str) -> int:
+        """將鍵值轉為 Postgres advisory lock 使用的 64 位元整數"""
+        return int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:8], "big", signed=True)
+
+    def do(self, key: str, fn, recheck=None):
+        """
+        執行工作（相同鍵值的並行呼叫只執行一次）
+
+        Args:
+            key: 工作鍵值（內容雜湊 + 模型 + 參數）
+            fn: 實際執行的函式
+            recheck: 取得跨程序鎖後呼叫，返回非 None 時視為其他程序已完成的結果
+
+        Returns:
+            tuple: (結果, 是否共用了其他呼叫的結果)
+
+        Raises:
+            Exception: leader 執行失敗時，等待中的呼叫收到相同的錯誤
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                # 已有其他執行緒正在處理相同的工作，等待其結果
+                self._coalesced += 1
+                is_leader = False
+            else:
+                future = Future()
+                self._inflight[key] = future
+                self._leaders += 1
+                is_leader = True
+
+        if not is_leader:
+            return future.result(), True
+
+        try:
+            if self.engine is not None:
+                result, shared = self._run_with_advisory_lock(key, fn, recheck)
+            else:
+                result, shared = fn(), False
+        except Exception as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result=result)
+        return result, shared
+
+    def _run_with_advisory_lock(self, key: str, fn, recheck):
+        """在 Postgres advisory lock 保護下執行（同一鍵值跨程序只執行一次）"""
+        from sqlalchemy import text
+        lock_id = self.advisory_key(key)
+        connection = self.engine.connect()
+        locked = False
+        try:
+            deadline = time.monotonic() + self.lock_timeout
+            waited = False
+            while True:
+                locked = connection.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": lock_id}).scalar()
+                # 不在交易中等待，避免連線長時間 idle in transaction
+                connection.commit()
+                if locked or time.monotonic() >= deadline:
+                    break
+                waited = True
+                time.sleep(self.poll_interval)
+
+            with self._lock:
+                if waited:
+                    self._lock_waits += 1
+                if not locked:
+                    self._lock_timeouts += 1
+            if not locked:
+                print("⚠️  等待其他程序的相同工作逾時，直接執行")
+
+            if waited and recheck is not None:
+                result = recheck()
+                if result is not None:
+                    with self._lock:
+                        self._rechecked += 1
+                    return result, True
+            return fn(), False
+        finally:
+            try:
+                if locked:
+                    connection.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": lock_id})
+                    connection.commit()
+            except Exception as e:
+                # 釋放失敗時丟棄連線（session 層級的鎖隨連線關閉釋放），避免帶著鎖回到連線池
+                print(f"⚠️  釋放 advisory lock 失敗: {str(e)}")
+                connection.invalidate()
+            connection.close()
+
+    def _finish(self, key: str, future: Future, result=None, error: Exception = None):
+        """通知等待中的呼叫並移除 in-flight 記錄"""
+        with self._lock:
+            self._inflight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def get_stats(self) -> dict:
+        """取得合併統計"""
+        with self._lock:
+            return {
+                "inflight": len(self._inflight),
+                "leaders": self._leaders,
+                "coalesced": self._coalesced,
+                "advisory_lock": self.engine is not None,
+                "lock_waits": self._lock_waits,
+                "lock_timeouts": self._lock_timeouts,
+                "shared_across_workers": self._rechecked,
+            }
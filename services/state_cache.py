@@ -0,0 +1,244 @@
+import copy
+import os
+import select
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# 清除所有快取的特殊鍵值（例如批次清理舊狀態之後）
+INVALIDATE_ALL = "*"
+
+
+class StateCache:
+    """
+    用戶狀態的程序內快取（TTL + LRU）
+
+    由 UserStateManager 以 write-through 方式維護：set_state / clear_state 寫入資料庫後
+    同步更新快取；「沒有狀態」（None）也會被快取，避免對沒有狀態的用戶反覆查詢。
+    讀取時若期間有任何寫入或失效，不會把可能過期的查詢結果放回快取。
+    """
+
+    def __init__(self, max_entries: int = None, ttl_seconds: float = None):
+        self.max_entries = max_entries or int(os.getenv("USER_STATE_CACHE_MAX_ENTRIES", "10000"))
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else \
+            float(os.getenv("USER_STATE_CACHE_TTL_SECONDS", "30"))
+
+        # user_id -> (expires_at, state)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._write_version = 0
+        self._hits = 0
+        self._misses = 0
+        self._writes = 0
+        self._evictions = 0
+        self._invalidations = 0
+        self._remote_invalidations = 0
+
+    def get(self, user_id: str):
+        """
+        讀取快取
+
+        Returns:
+            tuple: (是否命中, 狀態副本)
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                expires_at, state = entry
+                if expires_at > now:
+                    self._entries.move_to_end(user_id)
+                    self._hits += 1
+                    return True, copy.deepcopy(state)
+                del self._entries[user_id]
+            self._misses += 1
+            return False, None
+
+    def begin_load(self) -> int:
+        """快取未命中、準備查詢資料庫前取得版本號"""
+        with self._lock:
+            return self._write_version
+
+    def finish_load(self, user_id: str, state, version: int):
+        """查詢完成後放入快取（期間若有寫入或失效則放棄，避免覆蓋較新的值）"""
+        with self._lock:
+            if version == self._write_version:
+                self._store(user_id, state)
+
+    def put(self, user_id: str, state):
+        """寫入快取（set_state / clear_state 的 write-through）"""
+        with self._lock:
+            self._write_version += 1
+            self._writes += 1
+            self._store(user_id, state)
+
+    def _store(self, user_id: str, state):
+        self._entries[user_id] = (time.monotonic() + self.ttl_seconds, copy.deepcopy(state))
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def invalidate(self, user_id: str, remote: bool = False):
+        """
+        讓快取失效
+
+        Args:
+            user_id: 用戶 ID，INVALIDATE_ALL 表示全部
+            remote: 是否來自其他程序的通知
+        """
+        with self._lock:
+            self._write_version += 1
+            if user_id == INVALIDATE_ALL:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+            if remote:
+                self._remote_invalidations += 1
+            else:
+                self._invalidations += 1
+
+    def get_stats(self) -> dict:
+        """取得快取統計"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 3) if lookups else 0.0,
+                "writes": self._writes,
+                "evictions": self._evictions,
+                "invalidations": self._invalidations,
+                "remote_invalidations": self._remote_invalidations,
+            }
+
+
+class LocalInvalidationChannel:
+    """
+    程序內的失效通知頻道
+
+    多個 UserStateManager（模擬多個 worker）訂閱同一個頻道時，
+    其中一個寫入會通知其他訂閱者讓快取失效；用於測試或單機多實例。
+    """
+
+    def __init__(self):
+        self.sender_id = uuid.uuid4().hex
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback) -> str:
+        """
+        訂閱失效通知
+
+        Returns:
+            str: 訂閱者 ID（發布時用來略過自己的通知）
+        """
+        subscriber_id = uuid.uuid4().hex
+        with self._lock:
+            self._subscribers.append((subscriber_id, callback))
+        return subscriber_id
+
+    def publish(self, user_id: str, subscriber_id: str = None, session=None):
+        """通知其他訂閱者讓 user_id 的快取失效（有 session 時等交易提交後才通知）"""
+        if session is not None:
+            from sqlalchemy import event
+            event.listen(session, "after_commit", lambda _: self._deliver(user_id, subscriber_id), once=True)
+        else:
+            self._deliver(user_id, subscriber_id)
+
+    def _deliver(self, user_id: str, subscriber_id: str = None):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for other_id, callback in subscribers:
+            if other_id != subscriber_id:
+                callback(user_id)
+
+    def close(self):
+        with self._lock:
+            self._subscribers.clear()
+
+
+class PostgresInvalidationChannel:
+    """
+    以 Postgres LISTEN / NOTIFY 實作的跨程序失效通知
+
+    發布時在寫入狀態的同一個交易中執行 pg_notify，交易提交後才會送達其他程序；
+    每個程序以一條獨立連線 LISTEN，收到通知後讓本機快取失效（略過自己發出的通知）。
+    """
+
+    def __init__(self, engine, channel: str = None):
+        self.engine = engine
+        self.channel = channel or os.getenv("USER_STATE_NOTIFY_CHANNEL", "user_state_invalidate")
+        self.sender_id = uuid.uuid4().hex
+        self._callbacks = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe(self, callback) -> str:
+        """訂閱失效通知並啟動 LISTEN 執行緒"""
+        self._callbacks.append(callback)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._listen_loop, name="state-listen", daemon=True)
+            self._thread.start()
+        return self.sender_id
+
+    def publish(self, user_id: str, subscriber_id: str = None, session=None):
+        """
+        發布失效通知
+
+        Args:
+            user_id: 用戶 ID 或 INVALIDATE_ALL
+            subscriber_id: 發布者 ID
+            session: 寫入狀態的 session（在同一交易中通知，提交後才送達）
+        """
+        from sqlalchemy import text
+        payload = f"{subscriber_id or self.sender_id}:{user_id}"
+        statement = text("SELECT pg_notify(:channel, :payload)")
+        params = {"channel": self.channel, "payload": payload}
+        if session is not None:
+            session.execute(statement, params)
+        else:
+            with self.engine.begin() as conn:
+                conn.execute(statement, params)
+
+    def _listen_loop(self):
+        """LISTEN 主迴圈（斷線時重新連線）"""
+        while not self._stop.is_set():
+            connection = None
+            try:
+                connection = self.engine.raw_connection()
+                connection.detach()
+                dbapi_connection = connection.driver_connection
+                dbapi_connection.autocommit = True
+                with dbapi_connection.cursor() as cursor:
+                    cursor.execute(f'LISTEN "{self.channel}"')
+                print(f"👂 已訂閱狀態失效通知頻道: {self.channel}")
+                while not self._stop.is_set():
+                    if select.select([dbapi_connection], [], [], 5) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        notify = dbapi_connection.notifies.pop(0)
+                        sender_id, _, user_id = notify.payload.partition(":")
+                        if sender_id == self.sender_id:
+                            continue
+                        for callback in self._callbacks:
+                            callback(user_id)
+            except Exception as e:
+                print(f"⚠️  狀態失效通知連線中斷，5 秒後重試: {str(e)}")
+                # 斷線期間可能漏掉通知，清空所有快取
+                for callback in self._callbacks:
+                    callback(INVALIDATE_ALL)
+                self._stop.wait(5)
+            finally:
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+
+    def close(self):
+        self._stop.set()
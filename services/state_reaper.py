@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+from services.rate_limiter import TokenBucket
+
+
+class StateReaper:
+    """
+    過期用戶狀態的背景清理程序
+
+    每輪依 updated_at 由舊到新分批刪除超過 TTL 的狀態（走 idx_updated_at 索引，
+    每批一個短交易），批次之間以 token bucket 限速，避免長時間鎖定或佔滿資料庫。
+    一批刪滿時繼續下一批，否則等待下一輪。
+    """
+
+    def __init__(self, state_manager, interval: float = None, batch_size: int = None,
+                 batches_per_second: float = None):
+        """
+        Args:
+            state_manager: UserStateManager
+            interval: 每輪清理的間隔秒數
+            batch_size: 每批最多刪除的筆數
+            batches_per_second: 每秒最多執行的批次數
+        """
+        self.state_manager = state_manager
+        self.interval = interval or float(os.getenv("USER_STATE_REAPER_INTERVAL", "60"))
+        self.batch_size = batch_size or int(os.getenv("USER_STATE_REAPER_BATCH_SIZE", "500"))
+        self.bucket = TokenBucket(
+            batches_per_second or float(os.getenv("USER_STATE_REAPER_BATCHES_PER_SECOND", "5")), capacity=1
+        )
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._runs = 0
+        self._batches = 0
+        self._deleted = 0
+        self._errors = 0
+        self._last_run_deleted = 0
+        self._last_run_seconds = 0.0
+
+    def run_once(self) -> int:
+        """
+        執行一輪清理（直到沒有滿批的過期狀態）
+
+        Returns:
+            int: 本輪刪除筆數
+        """
+        started = time.perf_counter()
+        deleted = 0
+        while not self._stop.is_set():
+            self.bucket.acquire()
+            batch = self.state_manager.delete_expired_states(self.batch_size)
+            deleted += batch
+            with self._lock:
+                self._batches += 1
+                self._deleted += batch
+            if batch < self.batch_size:
+                break
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._runs += 1
+            self._last_run_deleted = deleted
+            self._last_run_seconds = elapsed
+        if deleted:
+            print(f"🧹 已清理 {deleted} 個過期用戶狀態（{elapsed:.2f} 秒）")
+        return deleted
+
+    def run_forever(self):
+        """持續清理直到 stop()"""
+        print(f"🧹 用戶狀態清理程序啟動（每 {self.interval:g} 秒，每批 {self.batch_size} 筆）")
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                with self._lock:
+                    self._errors += 1
+                print(f"❌ 清理過期用戶狀態失敗: {str(e)}")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """在背景執行緒中運行"""
+        self._thread = threading.Thread(target=self.run_forever, name="state-reaper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止背景執行緒"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def get_stats(self) -> dict:
+        """取得清理統計"""
+        with self._lock:
+            return {
+                "interval_seconds": self.interval,
+                "batch_size": self.batch_size,
+                "runs": self._runs,
+                "batches": self._batches,
+                "deleted": self._deleted,
+                "errors": self._errors,
+                "last_run_deleted": self._last_run_deleted,
+                "last_run_seconds": round(self._last_run_seconds, 3),
+                "throttle_seconds": self.bucket.get_stats().get("throttle_seconds"),
+            }
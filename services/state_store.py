@@ -0,0 +1,586 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import timedelta
+from typing import Optional, Dict, Any, Iterator, Tuple, List
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+# 支援 INSERT ... ON CONFLICT DO UPDATE 的資料庫
+UPSERT_DIALECTS = {
+    "postgresql": postgresql_insert,
+    "sqlite": sqlite_insert,
+}
+
+
+class StateStore(ABC):
+    """
+    用戶狀態儲存介面
+
+    set / clear 的 on_write 回呼會在寫入提交前被呼叫（資料庫實作傳入目前的 session，
+    讓失效通知與寫入在同一個交易中）；沒有交易概念的實作傳入 None。
+    """
+
+    name = "base"
+
+    @abstractmethod
+    def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """取得狀態（沒有狀態時返回 None；updated_at 為本機 epoch 秒數，用於 TTL 判斷）"""
+
+    @abstractmethod
+    def set(self, user_id: str, state: Dict[str, Any], on_write=None) -> bool:
+        """
+        寫入狀態
+
+        Returns:
+            bool: True 表示新建立，False 表示更新既有狀態，None 表示後端無法區分
+        """
+
+    @abstractmethod
+    def clear(self, user_id: str, on_write=None) -> Optional[Dict[str, Any]]:
+        """
+        清除狀態
+
+        Returns:
+            dict: 被清除的原狀態（原本沒有狀態時返回 None）
+        """
+
+    @abstractmethod
+    def iter_states(self, feature: str = None, state: str = None, older_than_seconds: float = None,
+                    page_size: int = 500) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """
+        依 user_id 順序以 keyset 分頁串流讀取狀態（記憶體用量與資料表大小無關）
+
+        Args:
+            feature: 只列出此功能的狀態
+            state: 只列出此狀態名稱
+            older_than_seconds: 只列出超過此秒數未更新的狀態
+            page_size: 每次查詢的筆數
+
+        Yields:
+            tuple: (user_id, 狀態)，狀態含 updated_at（本機 epoch 秒數）
+        """
+
+    @abstractmethod
+    def count_states(self, feature: str = None, state: str = None,
+                     older_than_seconds: float = None) -> List[Tuple[str, str, int]]:
+        """
+        依功能與狀態名稱統計筆數（由資料庫彙總，不讀取資料內容）
+
+        Returns:
+            list: [(feature, state, count)]
+        """
+
+    def all_states(self) -> Dict[str, Dict[str, Any]]:
+        """取得所有狀態（會載入整張表，只適用於小量資料；大量資料請使用 iter_states）"""
+        states = {}
+        for user_id, user_state in self.iter_states():
+            user_state.pop("updated_at", None)
+            states[user_id] = user_state
+        return states
+
+    @abstractmethod
+    def delete_expired(self, ttls: Dict[str, float], default_ttl: float, limit: int, on_write=None) -> int:
+        """
+        刪除一批過期狀態（依 updated_at 由舊到新，最多 limit 筆）
+
+        Args:
+            ttls: 各功能的 TTL 秒數（None 表示不過期）
+            default_ttl: 未列在 ttls 中的功能使用的 TTL 秒數（None 表示不過期）
+            limit: 本批最多刪除筆數
+
+        Returns:
+            int: 刪除筆數
+        """
+
+    def cleanup_older_than(self, hours: float, on_write=None, batch_size: int = 1000) -> int:
+        """分批刪除超過指定小時未更新的狀態，返回刪除筆數"""
+        total = 0
+        while True:
+            deleted = self.delete_expired({}, hours * 3600, batch_size, on_write=on_write)
+            total += deleted
+            if deleted < batch_size:
+                return total
+
+    def close(self):
+        """釋放資源"""
+
+
+def _to_state(feature, state, data) -> Dict[str, Any]:
+    return {"feature": feature, "state": state, "data": data}
+
+
+def _expiry_cutoffs(ttls, default_ttl, now, to_delta=lambda seconds: seconds) -> list:
+    """
+    計算各功能的過期界線
+
+    Returns:
+        list: [(feature, cutoff)]，feature 為 None 表示未列在 ttls 中的其他功能
+    """
+    cutoffs = [(feature, now - to_delta(ttl)) for feature, ttl in ttls.items() if ttl is not None]
+    if default_ttl is not None:
+        cutoffs.append((None, now - to_delta(default_ttl)))
+    return cutoffs
+
+
+class MemoryStateStore(StateStore):
+    """
+    程序內記憶體儲存
+
+    最快但只適用於單一程序（例如開發環境或單一 worker），重啟後狀態會消失。
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._states.get(user_id)
+            if not entry:
+                return None
+            state = json.loads(entry[0])
+            state["updated_at"] = entry[1]
+            return state
+
+    def set(self, user_id, state, on_write=None):
+        # 以 JSON 保存，與資料庫實作一樣不會共用呼叫端的 dict
+        value = json.dumps(_to_state(state.get("feature"), state.get("state"), state.get("data")), ensure_ascii=False)
+        with self._lock:
+            created = user_id not in self._states
+            self._states[user_id] = (value, time.time(), state.get("feature"))
+        if on_write is not None:
+            on_write(None)
+        return created
+
+    def clear(self, user_id, on_write=None):
+        with self._lock:
+            entry = self._states.pop(user_id, None)
+        if entry is None:
+            return None
+        if on_write is not None:
+            on_write(None)
+        return json.loads(entry[0])
+
+    def _matches(self, entry, feature, state, cutoff) -> bool:
+        value, updated_at, entry_feature = entry
+        if feature is not None and entry_feature != feature:
+            return False
+        if cutoff is not None and updated_at >= cutoff:
+            return False
+        return state is None or json.loads(value).get("state") == state
+
+    def iter_states(self, feature=None, state=None, older_than_seconds=None, page_size=500):
+        cutoff = time.time() - older_than_seconds if older_than_seconds is not None else None
+        after = None
+        while True:
+            with self._lock:
+                user_ids = sorted(user_id for user_id in self._states if after is None or user_id > after)
+                page = []
+                for user_id in user_ids:
+                    entry = self._states[user_id]
+                    if self._matches(entry, feature, state, cutoff):
+                        page.append((user_id, entry))
+                        if len(page) >= page_size:
+                            break
+            for user_id, (value, updated_at, _) in page:
+                user_state = json.loads(value)
+                user_state["updated_at"] = updated_at
+                yield user_id, user_state
+            if len(page) < page_size:
+                return
+            after = page[-1][0]
+
+    def count_states(self, feature=None, state=None, older_than_seconds=None):
+        cutoff = time.time() - older_than_seconds if older_than_seconds is not None else None
+        counts = {}
+        with self._lock:
+            for entry in self._states.values():
+                if self._matches(entry, feature, state, cutoff):
+                    key = (entry[2], json.loads(entry[0]).get("state"))
+                    counts[key] = counts.get(key, 0) + 1
+        return [(key[0], key[1], count) for key, count in sorted(counts.items())]
+
+    def delete_expired(self, ttls, default_ttl, limit, on_write=None):
+        cutoffs = dict(_expiry_cutoffs(ttls, default_ttl, time.time()))
+        if not cutoffs:
+            return 0
+        with self._lock:
+            expired = sorted(
+                (updated_at, user_id) for user_id, (_, updated_at, feature) in self._states.items()
+                if updated_at < cutoffs.get(feature if feature in ttls else None, float("-inf"))
+            )[:limit]
+            for _, user_id in expired:
+                del self._states[user_id]
+        if expired and on_write is not None:
+            on_write(None)
+        return len(expired)
+
+
+class SqliteStateStore(StateStore):
+    """
+    SQLite（WAL 模式）儲存
+
+    同一台主機上的多個 gunicorn worker 可共用同一個檔案；寫入以單一 UPSERT 完成，
+    不需要經過網路往返。不適用於多台主機部署。
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str = None):
+        self.path = path or os.getenv("STATE_SQLITE_PATH", "user_states.db")
+        self._local = threading.local()
+        self._connect().execute(
+            """
+            CREATE TABLE IF NOT EXISTS user_states (
+                user_id TEXT PRIMARY KEY,
+                feature TEXT NOT NULL,
+                state TEXT NOT NULL,
+                data TEXT,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._connect().execute("CREATE INDEX IF NOT EXISTS idx_user_states_updated_at ON user_states (updated_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        """取得目前執行緒專用的連線"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, user_id):
+        row = self._connect().execute(
+            "SELECT feature, state, data, updated_at FROM user_states WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        state = _to_state(row[0], row[1], json.loads(row[2]) if row[2] else None)
+        state["updated_at"] = row[3]
+        return state
+
+    def set(self, user_id, state, on_write=None):
+        data = state.get("data")
+        # autocommit 下的單一 UPSERT
+        self._connect().execute(
+            """
+            INSERT INTO user_states (user_id, feature, state, data, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                feature = excluded.feature, state = excluded.state,
+                data = excluded.data, updated_at = excluded.updated_at
+            """,
+            (user_id, state.get("feature"), state.get("state"),
+             json.dumps(data, ensure_ascii=False) if data is not None else None, time.time())
+        )
+        if on_write is not None:
+            on_write(None)
+        return None
+
+    def clear(self, user_id, on_write=None):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT feature, state, data FROM user_states WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        if on_write is not None:
+            on_write(None)
+        return _to_state(row[0], row[1], json.loads(row[2]) if row[2] else None)
+
+    @staticmethod
+    def _filters(feature, state, older_than_seconds) -> Tuple[List[str], list]:
+        conditions, params = [], []
+        if feature is not None:
+            conditions.append("feature = ?")
+            params.append(feature)
+        if state is not None:
+            conditions.append("state = ?")
+            params.append(state)
+        if older_than_seconds is not None:
+            conditions.append("updated_at < ?")
+            params.append(time.time() - older_than_seconds)
+        return conditions, params
+
+    def iter_states(self, feature=None, state=None, older_than_seconds=None, page_size=500):
+        conditions, params = self._filters(feature, state, older_than_seconds)
+        after = ""
+        while True:
+            rows = self._connect().execute(
+                f"""
+                SELECT user_id, feature, state, data, updated_at FROM user_states
+                WHERE {" AND ".join(conditions + ["user_id > ?"])}
+                ORDER BY user_id LIMIT ?
+                """,
+                params + [after, page_size]
+            ).fetchall()
+            for row in rows:
+                user_state = _to_state(row[1], row[2], json.loads(row[3]) if row[3] else None)
+                user_state["updated_at"] = row[4]
+                yield row[0], user_state
+            if len(rows) < page_size:
+                return
+            after = rows[-1][0]
+
+    def count_states(self, feature=None, state=None, older_than_seconds=None):
+        conditions, params = self._filters(feature, state, older_than_seconds)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._connect().execute(
+            f"SELECT feature, state, COUNT(*) FROM user_states {where} GROUP BY feature, state ORDER BY feature, state",
+            params
+        ).fetchall()
+        return [tuple(row) for row in rows]
+
+    def delete_expired(self, ttls, default_ttl, limit, on_write=None):
+        cutoffs = _expiry_cutoffs(ttls, default_ttl, time.time())
+        if not cutoffs:
+            return 0
+        conditions = []
+        params = [max(cutoff for _, cutoff in cutoffs)]
+        for feature, cutoff in cutoffs:
+            if feature is None:
+                placeholders = ", ".join("?" for _ in ttls)
+                conditions.append(f"(feature NOT IN ({placeholders}) AND updated_at < ?)")
+                params.extend(ttls)
+            else:
+                conditions.append("(feature = ? AND updated_at < ?)")
+                params.append(feature)
+            params.append(cutoff)
+        params.append(limit)
+        # 以 idx_user_states_updated_at 範圍掃描取出最舊的一批，避免全表掃描與長時間鎖定
+        cursor = self._connect().execute(
+            f"""
+            DELETE FROM user_states WHERE user_id IN (
+                SELECT user_id FROM user_states
+                WHERE updated_at < ? AND ({" OR ".join(conditions)})
+                ORDER BY updated_at LIMIT ?
+            )
+            """,
+            params
+        )
+        if cursor.rowcount and on_write is not None:
+            on_write(None)
+        return cursor.rowcount
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class DatabaseStateStore(StateStore):
+    """
+    SQLAlchemy 資料庫儲存（Postgres，多節點部署）
+
+    使用 models.database 的 session 與 user_states 資料表。
+    """
+
+    name = "database"
+
+    def get(self, user_id):
+        from sqlalchemy import func
+        from models.database import get_session
+        from models.user_state import UserState
+        with get_session() as session:
+            row = session.query(UserState, func.now()).filter(UserState.user_id == user_id).first()
+            if row is None:
+                return None
+            user_state, now = row
+            return self._to_local_state(user_state, now)
+
+    @staticmethod
+    def _to_local_state(user_state, now) -> Dict[str, Any]:
+        """轉換為狀態 dict，以資料庫時鐘計算已經過的秒數再換算成本機時間，避免時區 / 時鐘差異"""
+        state = _to_state(user_state.feature, user_state.state, user_state.get_data())
+        age = (now.replace(tzinfo=None) - user_state.updated_at.replace(tzinfo=None)).total_seconds()
+        state["updated_at"] = time.time() - max(0.0, age)
+        return state
+
+    def set(self, user_id, state, on_write=None):
+        from sqlalchemy import func, literal_column
+        from models.database import get_session
+        from models.user_state import UserState
+        with get_session() as session:
+            dialect = session.get_bind().dialect.name
+            if dialect not in UPSERT_DIALECTS:
+                created = self._select_then_write(session, user_id, state)
+            else:
+                # 單一 INSERT ... ON CONFLICT DO UPDATE，同一用戶的並發寫入不會發生主鍵衝突
+                data = state.get("data")
+                statement = UPSERT_DIALECTS[dialect](UserState).values(
+                    user_id=user_id,
+                    feature=state.get("feature"),
+                    state=state.get("state"),
+                    data=json.dumps(data, ensure_ascii=False) if data is not None else None
+                )
+                statement = statement.on_conflict_do_update(
+                    index_elements=[UserState.user_id],
+                    set_={
+                        "feature": statement.excluded.feature,
+                        "state": statement.excluded.state,
+                        "data": statement.excluded.data,
+                        "updated_at": func.now(),
+                    }
+                )
+                if dialect == "postgresql":
+                    # xmax = 0 表示這一列是新插入的
+                    statement = statement.returning(literal_column("(xmax = 0)"))
+                    created = bool(session.execute(statement).scalar())
+                else:
+                    session.execute(statement)
+                    created = None
+
+            if on_write is not None:
+                on_write(session)
+            session.commit()
+            return created
+
+    @staticmethod
+    def _select_then_write(session, user_id, state) -> bool:
+        """不支援 ON CONFLICT 的資料庫：先查詢再更新或新增"""
+        from models.user_state import UserState
+        existing_state = session.query(UserState).filter_by(user_id=user_id).first()
+        if existing_state:
+            existing_state.feature = state.get("feature")
+            existing_state.state = state.get("state")
+            existing_state.set_data(state.get("data"))
+            return False
+        session.add(UserState.create_state(
+            user_id=user_id,
+            feature=state.get("feature"),
+            state=state.get("state"),
+            data=state.get("data")
+        ))
+        return True
+
+    def clear(self, user_id, on_write=None):
+        from models.database import get_session
+        from models.user_state import UserState
+        with get_session() as session:
+            user_state = session.query(UserState).filter_by(user_id=user_id).first()
+            if not user_state:
+                return None
+            old_state = _to_state(user_state.feature, user_state.state, user_state.get_data())
+            session.delete(user_state)
+            if on_write is not None:
+                on_write(session)
+            session.commit()
+            return old_state
+
+    @staticmethod
+    def _filtered(query, now, feature, state, older_than_seconds):
+        from models.user_state import UserState
+        if feature is not None:
+            query = query.filter(UserState.feature == feature)
+        if state is not None:
+            query = query.filter(UserState.state == state)
+        if older_than_seconds is not None:
+            query = query.filter(UserState.updated_at < now - timedelta(seconds=older_than_seconds))
+        return query
+
+    def iter_states(self, feature=None, state=None, older_than_seconds=None, page_size=500):
+        from sqlalchemy import func
+        from models.database import get_session
+        from models.user_state import UserState
+        after = None
+        while True:
+            # 每頁一個短交易，不會長時間持有連線或快照
+            with get_session() as session:
+                now = session.query(func.now()).scalar().replace(tzinfo=None)
+                query = self._filtered(session.query(UserState), now, feature, state, older_than_seconds)
+                if after is not None:
+                    query = query.filter(UserState.user_id > after)
+                page = [
+                    (user_state.user_id, self._to_local_state(user_state, now))
+                    for user_state in query.order_by(UserState.user_id).limit(page_size)
+                ]
+            yield from page
+            if len(page) < page_size:
+                return
+            after = page[-1][0]
+
+    def count_states(self, feature=None, state=None, older_than_seconds=None):
+        from sqlalchemy import func
+        from models.database import get_session
+        from models.user_state import UserState
+        with get_session() as session:
+            now = session.query(func.now()).scalar().replace(tzinfo=None)
+            query = session.query(UserState.feature, UserState.state, func.count())
+            query = self._filtered(query, now, feature, state, older_than_seconds)
+            rows = query.group_by(UserState.feature, UserState.state)\
+                .order_by(UserState.feature, UserState.state).all()
+            return [tuple(row) for row in rows]
+
+    def delete_expired(self, ttls, default_ttl, limit, on_write=None):
+        from sqlalchemy import and_, delete, func, or_
+        from models.database import get_session
+        from models.user_state import UserState
+        with get_session() as session:
+            now = session.query(func.now()).scalar().replace(tzinfo=None)
+            cutoffs = _expiry_cutoffs(ttls, default_ttl, now, lambda seconds: timedelta(seconds=seconds))
+            if not cutoffs:
+                return 0
+            conditions = [
+                and_(UserState.feature.notin_(list(ttls)) if feature is None else UserState.feature == feature,
+                     UserState.updated_at < cutoff)
+                for feature, cutoff in cutoffs
+            ]
+            # updated_at 的上界讓查詢走 idx_updated_at 範圍掃描
+            expired = and_(UserState.updated_at < max(cutoff for _, cutoff in cutoffs), or_(*conditions))
+            query = session.query(UserState.user_id).filter(expired)\
+                .order_by(UserState.updated_at).limit(limit)
+            if session.get_bind().dialect.name == "postgresql":
+                # 多個程序同時清理時略過彼此鎖定的列
+                query = query.with_for_update(skip_locked=True)
+            user_ids = [user_id for (user_id,) in query]
+            if not user_ids:
+                return 0
+            # 再次檢查過期條件，避免刪掉剛被更新的狀態
+            result = session.execute(
+                delete(UserState).where(UserState.user_id.in_(user_ids), expired)
+                .execution_options(synchronize_session=False)
+            )
+            if on_write is not None:
+                on_write(session)
+            session.commit()
+            return result.rowcount
+
+
+STATE_STORES = {
+    MemoryStateStore.name: MemoryStateStore,
+    SqliteStateStore.name: SqliteStateStore,
+    DatabaseStateStore.name: DatabaseStateStore,
+}
+
+
+def create_state_store(backend: str = None) -> StateStore:
+    """
+    依設定建立狀態儲存
+
+    Args:
+        backend: memory / sqlite / database（預設讀取 STATE_BACKEND，未設定時為 database）
+
+    Returns:
+        StateStore: 狀態儲存實例
+    """
+    backend = (backend or os.getenv("STATE_BACKEND", "database")).lower()
+    if backend not in STATE_STORES:
+        raise ValueError(f"未知的 STATE_BACKEND: {backend}（可用: {', '.join(STATE_STORES)}）")
+    return STATE_STORES[backend]()
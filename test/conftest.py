@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+# 讓測試可以直接 import 專案根目錄的模組
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def sqlite_database(tmp_path):
+    """以暫存 SQLite 檔案初始化 models.database 並建立所有資料表"""
+    import models  # noqa: F401  註冊所有模型
+    from models.database import init_database, create_tables
+    engine = init_database(f"sqlite:///{tmp_path / 'test.db'}")
+    create_tables()
+    yield engine
+    engine.dispose()
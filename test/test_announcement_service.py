@@ -0,0 +1,71 @@
+import json
+import os
+
+from linebot.models import TextSendMessage
+
+from models.database import get_session
+from models.member import Member
+from services.announcement_service import AnnouncementService
+
+
+class FakeApi:
+    def __init__(self, fail_first=0):
+        self.calls = []
+        self.fail_first = fail_first
+
+    def multicast(self, user_ids, messages):
+        if self.fail_first > 0:
+            self.fail_first -= 1
+            raise RuntimeError("multicast failed")
+        self.calls.append(list(user_ids))
+
+
+def _add_members(count):
+    with get_session() as session:
+        for index in range(count):
+            session.add(Member(user_id=f"U{index:03d}", display_name=f"user{index}"))
+
+
+def test_sends_in_chunks_and_removes_checkpoint(sqlite_database, tmp_path):
+    _add_members(7)
+    api = FakeApi()
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+    stats = AnnouncementService(api, concurrency=2, chunk_size=3).send(
+        TextSendMessage(text="hi"), checkpoint_path=checkpoint_path
+    )
+    assert sorted(user_id for chunk in api.calls for user_id in chunk) == [f"U{index:03d}" for index in range(7)]
+    assert stats["recipients"] == 7
+    assert stats["chunks"] == 3
+    assert not os.path.exists(checkpoint_path)
+
+
+def test_failed_chunk_is_resent_on_resume(sqlite_database, tmp_path):
+    """失敗的區塊保留在 checkpoint，以相同內容重新執行時重送"""
+    _add_members(6)
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+    message = TextSendMessage(text="hi")
+
+    first = AnnouncementService(FakeApi(fail_first=1), concurrency=1, chunk_size=3)
+    stats = first.send(message, checkpoint_path=checkpoint_path)
+    assert stats["failed_recipients"] == 3
+    assert stats["pending_failed_chunks"] == 1
+    with open(checkpoint_path, encoding="utf-8") as f:
+        assert json.load(f)["failed_chunks"][0]["user_ids"] == ["U000", "U001", "U002"]
+
+    api = FakeApi()
+    stats = AnnouncementService(api, concurrency=1, chunk_size=3).send(message, checkpoint_path=checkpoint_path)
+    assert api.calls == [["U000", "U001", "U002"]]
+    assert stats["total_sent"] == 6
+    assert not os.path.exists(checkpoint_path)
+
+
+def test_dry_run_sends_nothing_and_writes_no_checkpoint(sqlite_database, tmp_path):
+    _add_members(4)
+    api = FakeApi()
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+    stats = AnnouncementService(api, chunk_size=3).send(
+        TextSendMessage(text="hi"), checkpoint_path=checkpoint_path, dry_run=True
+    )
+    assert api.calls == []
+    assert stats["recipients"] == 4
+    assert not os.path.exists(checkpoint_path)
@@ -0,0 +1,137 @@
+import threading
+import time
+
+import pytest
+
+from services.event_queue import EventQueue
+from services.sharded_executor import ShardedExecutor
+
+
+def _wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def event_queue(tmp_path):
+    queue = EventQueue(path=str(tmp_path / "queue.db"), worker_count=2, max_attempts=2, poll_interval=0.01)
+    yield queue
+    queue.stop()
+
+
+def test_processed_events_are_removed(event_queue):
+    handled = []
+    event_queue.enqueue_many([{"n": 1}, {"n": 2}])
+    event_queue.start(handled.append)
+    _wait_for(lambda: event_queue.get_stats()["processed"] == 2)
+    assert sorted(event["n"] for event in handled) == [1, 2]
+    assert event_queue.depth() == {"pending": 0, "processing": 0, "dead": 0}
+
+
+def test_failing_event_is_retried_then_dead_lettered(event_queue):
+    """處理失敗的事件重試到 max_attempts 後標記為 dead"""
+    attempts = []
+
+    def handler(event):
+        attempts.append(event)
+        raise RuntimeError("boom")
+
+    event_queue.enqueue_many([{"n": 1}])
+    event_queue.start(handler)
+    _wait_for(lambda: event_queue.get_stats()["dead"] == 1)
+    assert len(attempts) == 2
+    assert event_queue.depth()["dead"] == 1
+
+
+def test_sharded_mode_keeps_per_user_order(event_queue):
+    """分片模式下同一用戶的事件依佇列順序處理"""
+    handled = []
+    lock = threading.Lock()
+
+    def handler(event):
+        time.sleep(0.001)
+        with lock:
+            handled.append((event["user"], event["n"]))
+
+    event_queue.key_func = lambda event: event["user"]
+    events = [{"user": f"U{n % 3}", "n": n} for n in range(30)]
+    event_queue.enqueue_many(events)
+    executor = ShardedExecutor(shard_count=3)
+    event_queue.start(handler, executor=executor)
+    _wait_for(lambda: event_queue.get_stats()["processed"] == 30)
+    for user in ("U0", "U1", "U2"):
+        numbers = [n for handled_user, n in handled if handled_user == user]
+        assert numbers == sorted(numbers)
+    executor.shutdown()
+
+
+def test_undecodable_event_is_dead_lettered_and_pump_survives(event_queue):
+    """分片模式下無法解析的事件走 dead-letter 流程，取出執行緒繼續處理後續事件"""
+    handled = []
+
+    def decoder(event):
+        if event.get("bad"):
+            raise ValueError("cannot decode")
+        return event
+
+    event_queue.key_func = lambda event: event.get("user")
+    event_queue.enqueue_many([{"bad": True}, {"user": "U1", "n": 1}])
+    executor = ShardedExecutor(shard_count=2)
+    event_queue.start(handled.append, executor=executor, decoder=decoder)
+    _wait_for(lambda: event_queue.get_stats()["dead"] == 1 and event_queue.get_stats()["processed"] == 1)
+    assert handled == [{"user": "U1", "n": 1}]
+    executor.shutdown()
+
+
+@pytest.mark.parametrize("sharded", [False, True])
+def test_retry_runs_before_later_events_of_the_same_user(tmp_path, sharded):
+    """失敗等待重試的事件會擋住同一用戶之後的事件，其他用戶不受影響"""
+    queue = EventQueue(path=str(tmp_path / "queue.db"), worker_count=4, max_attempts=3, poll_interval=0.01,
+                       key_func=lambda event: event["user"])
+    handled = []
+    lock = threading.Lock()
+    failures = {"U1-0": 1}
+
+    def handler(event):
+        name = f"{event['user']}-{event['n']}"
+        with lock:
+            if failures.get(name):
+                failures[name] -= 1
+                raise RuntimeError("transient")
+            handled.append(name)
+
+    queue.enqueue_many([{"user": "U1", "n": 0}, {"user": "U2", "n": 0},
+                        {"user": "U1", "n": 1}, {"user": "U1", "n": 2}])
+    executor = ShardedExecutor(shard_count=2) if sharded else None
+    queue.start(handler, executor=executor)
+    try:
+        _wait_for(lambda: queue.get_stats()["processed"] == 4)
+    finally:
+        queue.stop()
+        if executor is not None:
+            executor.shutdown()
+    assert [name for name in handled if name.startswith("U1")] == ["U1-0", "U1-1", "U1-2"]
+    assert "U2-0" in handled
+
+
+def test_dead_event_does_not_block_later_events(event_queue):
+    event_queue.key_func = lambda event: event["user"]
+    handled = []
+
+    def handler(event):
+        if event["n"] == 0:
+            raise RuntimeError("always fails")
+        handled.append(event["n"])
+
+    event_queue.enqueue_many([{"user": "U1", "n": 0}, {"user": "U1", "n": 1}])
+    event_queue.start(handler)
+    _wait_for(lambda: event_queue.get_stats()["processed"] == 1)
+    assert handled == [1]
+    assert event_queue.depth()["dead"] == 1
+
+
+def test_sharded_mode_requires_key_func(event_queue):
+    with pytest.raises(ValueError):
+        event_queue.start(lambda event: None, executor=ShardedExecutor(shard_count=1))
@@ -0,0 +1,71 @@
+from features.base_feature import BaseFeature
+from features.feature_registry import FeatureRegistry
+from webhook_event import WebhookEvent
+
+
+class StubStateManager:
+    def __init__(self, states=None):
+        self.states = states or {}
+
+    def get_state(self, user_id):
+        return self.states.get(user_id)
+
+
+class RecordingFeature(BaseFeature):
+    """記錄收到的文字訊息"""
+
+    feature_name = "edit"
+
+    def __init__(self, state_manager, **routes):
+        super().__init__(None, None, state_manager)
+        for attribute, value in routes.items():
+            setattr(self, attribute, value)
+        self.received = []
+
+    @property
+    def name(self):
+        return self.feature_name
+
+    def handle_text(self, event):
+        self.received.append(event.text)
+        return "handled"
+
+
+def _text_event(text, user_id="U1"):
+    return WebhookEvent({"type": "message", "source": {"type": "user", "userId": user_id},
+                         "message": {"type": "text", "text": text}})
+
+
+def test_reserved_commands_do_not_reach_the_current_feature():
+    """會員功能未註冊時，點數相關指令與關鍵字不會被當成編輯描述"""
+    registry = FeatureRegistry()
+    edit = RecordingFeature(StubStateManager({"U1": {"feature": "edit", "state": "waiting_description"}}))
+    registry.register(edit)
+
+    for text in ("點數", "歷史", "我想查詢點數", "查看我的點數"):
+        assert registry.route_text_message(_text_event(text)) is None
+    assert edit.received == []
+
+    # 未保留的訊息（例如「加點」）仍是編輯描述
+    assert registry.route_text_message(_text_event("加點光暈")) == "handled"
+    assert registry.route_text_message(_text_event("加點")) == "handled"
+    assert edit.received == ["加點光暈", "加點"]
+
+
+def test_routing_priority():
+    """全局指令優先於用戶狀態，用戶狀態優先於一般指令"""
+    states = StubStateManager({"U1": {"feature": "edit", "state": "waiting_description"}})
+    registry = FeatureRegistry()
+    edit = RecordingFeature(states, commands=("圖片編輯",))
+    member = RecordingFeature(states, commands=("點數",), global_commands=("點數",),
+                              global_keywords=(r"點數.*(?:查詢|查看)",))
+    member.feature_name = "member"
+    registry.register(edit)
+    registry.register(member)
+
+    registry.route_text_message(_text_event("點數"))
+    registry.route_text_message(_text_event("點數查看一下"))
+    registry.route_text_message(_text_event("海灘背景"))
+    registry.route_text_message(_text_event("圖片編輯", user_id="U2"))
+    assert member.received == ["點數", "點數查看一下"]
+    assert edit.received == ["海灘背景", "圖片編輯"]
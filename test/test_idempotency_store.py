@@ -0,0 +1,34 @@
+from types import SimpleNamespace
+
+from services.idempotency_store import IdempotencyStore
+
+
+def _event(event_id, is_redelivery=False):
+    return SimpleNamespace(webhook_event_id=event_id, is_redelivery=is_redelivery)
+
+
+def test_duplicate_event_is_skipped():
+    store = IdempotencyStore(max_entries=100, ttl_seconds=60, use_database=False)
+    assert store.check_and_mark(_event("E1")) is True
+    assert store.check_and_mark(_event("E1", is_redelivery=True)) is False
+    assert store.check_and_mark(_event(None)) is True
+
+
+def test_unmark_allows_retry_after_failure():
+    """處理失敗後移除記錄，重送的同一事件可以再次處理"""
+    store = IdempotencyStore(max_entries=100, ttl_seconds=60, use_database=False)
+    store.check_and_mark(_event("E1"))
+    store.unmark(_event("E1"))
+    assert store.check_and_mark(_event("E1")) is True
+
+
+def test_database_dedupes_across_instances(sqlite_database):
+    """資料表記錄讓不同程序（實例）之間也能去重"""
+    first = IdempotencyStore(max_entries=100, ttl_seconds=60, use_database=True)
+    second = IdempotencyStore(max_entries=100, ttl_seconds=60, use_database=True)
+    assert first.check_and_mark(_event("E1")) is True
+    assert second.check_and_mark(_event("E1")) is False
+
+    # 處理失敗的程序移除記錄後，佇列重試時可以再次處理
+    first.unmark(_event("E1"))
+    assert first.check_and_mark(_event("E1")) is True
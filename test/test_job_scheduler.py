@@ -0,0 +1,41 @@
+import threading
+import time
+
+from services.job_scheduler import JobScheduler
+
+
+def _wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_rejects_when_queue_is_full():
+    """佇列已滿時拒絕新工作而不是無限排隊"""
+    scheduler = JobScheduler(workers=1, max_queue=2)
+    release = threading.Event()
+    assert scheduler.submit(release.wait, 5) == 0
+    _wait_for(lambda: scheduler.get_stats()["active"] == 1)
+
+    assert scheduler.submit(release.wait, 5) == 1
+    assert scheduler.submit(release.wait, 5) == 2
+    assert scheduler.submit(release.wait, 5) is None
+    assert scheduler.get_stats()["rejected"] == 1
+
+    release.set()
+    _wait_for(lambda: scheduler.get_stats()["completed"] == 3)
+
+
+def test_failed_job_is_counted_and_worker_survives():
+    scheduler = JobScheduler(workers=1, max_queue=5)
+    done = threading.Event()
+
+    def fail():
+        raise RuntimeError("boom")
+
+    scheduler.submit(fail)
+    scheduler.submit(done.set)
+    assert done.wait(5)
+    _wait_for(lambda: scheduler.get_stats()["completed"] == 2)
+    assert scheduler.get_stats()["failed"] == 1
@@ -0,0 +1,88 @@
+import pytest
+
+from services.line_http_client import LineHttpClient, endpoint_name
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+        self.content = b""
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv("LINE_HTTP_BACKOFF_BASE_SECONDS", "0.001")
+    monkeypatch.setenv("LINE_HTTP_MAX_RETRIES", "2")
+    return LineHttpClient()
+
+
+def _respond_with(client, status_codes):
+    calls = []
+    statuses = iter(status_codes)
+
+    def request(method, url, headers=None, **kwargs):
+        calls.append(headers)
+        return FakeResponse(next(statuses))
+
+    client.session.request = request
+    return calls
+
+
+def test_endpoint_name_groups_ids():
+    assert endpoint_name("GET", "https://api.line.me/v2/bot/profile/U" + "a" * 32) == "GET /v2/bot/profile/{id}"
+    assert endpoint_name("GET", "https://api-data.line.me/v2/bot/message/123/content?x=1") == \
+        "GET /v2/bot/message/{id}/content"
+
+
+def test_push_retries_5xx_with_the_same_retry_key(client):
+    calls = _respond_with(client, [500, 503, 200])
+    response = client.post("https://api.line.me/v2/bot/message/push", headers={}, data="{}")
+    assert response.status_code == 200
+    assert len(calls) == 3
+    assert len({headers["X-Line-Retry-Key"] for headers in calls}) == 1
+
+
+def test_reply_is_not_retried_on_5xx(client):
+    """reply 沒有 retry key，5xx 不重送以免重用 reply token"""
+    calls = _respond_with(client, [500, 200])
+    assert client.post("https://api.line.me/v2/bot/message/reply", headers={}, data="{}").status_code == 500
+    assert len(calls) == 1
+
+
+def test_reply_is_retried_on_429(client):
+    calls = _respond_with(client, [429, 200])
+    assert client.post("https://api.line.me/v2/bot/message/reply", headers={}, data="{}").status_code == 200
+    assert len(calls) == 2
+
+
+def test_get_gives_up_after_max_retries(client):
+    calls = _respond_with(client, [502, 502, 502, 200])
+    assert client.get("https://api.line.me/v2/bot/profile/U" + "a" * 32).status_code == 502
+    assert len(calls) == 3
+    assert client.get_stats()["retries"]["gave_up"] == 1
+
+
+def test_endpoints_have_separate_buckets(client):
+    """push / reply / profile / content 各自限流，互不影響"""
+    names = [
+        endpoint_name("POST", "https://api.line.me/v2/bot/message/push"),
+        endpoint_name("POST", "https://api.line.me/v2/bot/message/reply"),
+        endpoint_name("GET", "https://api.line.me/v2/bot/profile/U" + "a" * 32),
+        endpoint_name("GET", "https://api-data.line.me/v2/bot/message/123/content"),
+        endpoint_name("POST", "https://api.line.me/v2/bot/message/multicast"),
+    ]
+    buckets = [client._bucket_for(name) for name in names]
+    assert len({id(bucket) for bucket in buckets}) == len(names)
+    assert client._bucket_for("POST /v2/bot/chat/loading/start") is client._bucket_for("GET /v2/bot/info")
+
+
+def test_profile_burst_does_not_throttle_replies(client):
+    profile_bucket = client._bucket_for("GET /v2/bot/profile/{id}")
+    profile_bucket.pause(5)
+    calls = _respond_with(client, [200])
+    assert client.post("https://api.line.me/v2/bot/message/reply", headers={}, data="{}").status_code == 200
+    assert len(calls) == 1
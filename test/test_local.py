@@ -137,7 +137,8 @@ class LineBotTester:
                     "mode": "active",
                     "timestamp": int(time.time() * 1000),
                     "source": source,
-                    "webhookEventId": "test_event_id",
+                    # 每個測試事件使用不同的 ID，避免被事件去重過濾
+                    "webhookEventId": "test_event_" + "".join(random.choices(string.ascii_letters + string.digits, k=16)),
                     "deliveryContext": {
                         "isRedelivery": False
                     },
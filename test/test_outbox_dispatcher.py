@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+
+from linebot.models import TextSendMessage
+
+from models.database import get_session
+from models.outbox_message import OutboxMessage
+from services.outbox_dispatcher import OutboxDispatcher, outbox_stats
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ""
+
+
+class FakeHttpClient:
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+        self.requests = []
+
+    def post(self, url, headers=None, data=None):
+        self.requests.append(headers["X-Line-Retry-Key"])
+        return FakeResponse(self.status_code)
+
+
+class FakeApi:
+    endpoint = "https://api.line.me"
+    headers = {"Authorization": "Bearer token"}
+
+    def __init__(self, status_code=200):
+        self.http_client = FakeHttpClient(status_code)
+
+
+def _enqueue(count):
+    with get_session() as session:
+        for index in range(count):
+            session.add(OutboxMessage.create(f"U{index}", TextSendMessage(text="result")))
+
+
+def test_pending_messages_are_sent_once(sqlite_database):
+    _enqueue(3)
+    api = FakeApi()
+    dispatcher = OutboxDispatcher(api, batch_size=10)
+    assert dispatcher.run_once() == 3
+    assert dispatcher.run_once() == 0
+    assert len(set(api.http_client.requests)) == 3
+    assert outbox_stats()["depth"] == 0
+
+
+def test_permanent_error_marks_message_dead(sqlite_database):
+    _enqueue(1)
+    dispatcher = OutboxDispatcher(FakeApi(status_code=400), batch_size=10)
+    dispatcher.run_once()
+    assert outbox_stats()["dead"] == 1
+
+
+def test_purge_sent_removes_only_old_sent_rows_in_batches(sqlite_database, monkeypatch):
+    """只刪除超過保留時間的已送出記錄"""
+    monkeypatch.setenv("OUTBOX_PURGE_BATCH_SIZE", "2")
+    _enqueue(6)
+    dispatcher = OutboxDispatcher(FakeApi(), batch_size=10)
+    dispatcher.run_once()
+    with get_session() as session:
+        rows = session.query(OutboxMessage).order_by(OutboxMessage.id).all()
+        for row in rows[:5]:
+            row.sent_at = datetime.utcnow() - timedelta(hours=48)
+        rows[5].sent_at = datetime.utcnow()
+    _enqueue(1)
+
+    assert dispatcher.purge_sent() == 5
+    with get_session() as session:
+        assert session.query(OutboxMessage).count() == 2
+    assert dispatcher.get_stats()["purged"] == 5
@@ -0,0 +1,83 @@
+import threading
+import time
+
+import pytest
+from linebot.exceptions import LineBotApiError
+from linebot.models.error import Error
+
+from services.profile_cache import ProfileCache
+
+
+class FakeApi:
+    def __init__(self, error_status=None, delay=0.0):
+        self.calls = []
+        self.error_status = error_status
+        self.delay = delay
+
+    def get_profile(self, user_id):
+        self.calls.append(user_id)
+        time.sleep(self.delay)
+        if self.error_status is not None:
+            raise LineBotApiError(self.error_status, {}, error=Error(message="error"))
+        return {"userId": user_id}
+
+
+def test_hit_after_first_fetch():
+    api = FakeApi()
+    cache = ProfileCache(api, ttl_seconds=60, max_entries=10)
+    assert cache.get_profile("U1") == {"userId": "U1"}
+    assert cache.get_profile("U1") == {"userId": "U1"}
+    assert api.calls == ["U1"]
+    assert cache.get_stats()["hits"] == 1
+
+
+def test_concurrent_misses_fetch_once():
+    """同一用戶同時未命中只送出一次 get_profile"""
+    api = FakeApi(delay=0.1)
+    cache = ProfileCache(api, ttl_seconds=60, max_entries=10)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_profile("U1"))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert api.calls == ["U1"]
+    assert results == [{"userId": "U1"}] * 5
+    assert cache.get_stats()["coalesced"] == 4
+
+
+def test_not_found_is_negatively_cached():
+    """404 做負面快取，期限內不再查詢"""
+    api = FakeApi(error_status=404)
+    cache = ProfileCache(api, ttl_seconds=60, max_entries=10, negative_ttl_seconds=60)
+    for _ in range(2):
+        with pytest.raises(LineBotApiError):
+            cache.get_profile("U1")
+    assert api.calls == ["U1"]
+    assert cache.get_stats()["negative_hits"] == 1
+
+
+def test_server_error_is_not_cached():
+    api = FakeApi(error_status=500)
+    cache = ProfileCache(api, ttl_seconds=60, max_entries=10)
+    for _ in range(2):
+        with pytest.raises(LineBotApiError):
+            cache.get_profile("U1")
+    assert api.calls == ["U1", "U1"]
+
+
+def test_lru_eviction_and_invalidate():
+    api = FakeApi()
+    cache = ProfileCache(api, ttl_seconds=60, max_entries=2)
+    cache.get_profile("U1")
+    cache.get_profile("U2")
+    cache.get_profile("U1")
+    cache.get_profile("U3")  # 淘汰最久未使用的 U2
+    cache.get_profile("U1")
+    cache.get_profile("U2")
+    assert api.calls == ["U1", "U2", "U3", "U2"]
+
+    cache.invalidate("U1")
+    cache.get_profile("U1")
+    assert api.calls[-1] == "U1"
+    assert cache.get_stats()["invalidations"] == 1
@@ -0,0 +1,67 @@
+import threading
+
+import pytest
+
+from services.push_coalescer import PushCoalescer
+
+
+class Recorder:
+    def __init__(self, fail_targets=()):
+        self.sent = []
+        self.fail_targets = fail_targets
+        self.lock = threading.Lock()
+
+    def __call__(self, target_id, messages):
+        if target_id in self.fail_targets:
+            raise RuntimeError("push failed")
+        with self.lock:
+            self.sent.append((target_id, messages))
+
+
+def test_pushes_within_window_are_merged_in_order():
+    send = Recorder()
+    coalescer = PushCoalescer(send, window_seconds=0.05)
+    first = coalescer.push("U1", "a")
+    second = coalescer.push("U1", ["b", "c"])
+    assert first.result(timeout=5) is None
+    assert second.result(timeout=5) is None
+    assert send.sent == [("U1", ["a", "b", "c"])]
+
+
+def test_batches_are_split_at_five_messages():
+    """單次推送最多 5 則，超過時拆成多次並保持順序"""
+    send = Recorder()
+    coalescer = PushCoalescer(send, window_seconds=0.05)
+    futures = [coalescer.push("U1", [f"{i}a", f"{i}b", f"{i}c"]) for i in range(2)]
+    for future in futures:
+        future.result(timeout=5)
+    assert send.sent == [("U1", ["0a", "0b", "0c", "1a", "1b"]), ("U1", "1c")]
+
+
+def test_failure_is_reported_on_the_future():
+    """送出失敗時由 Future 帶回例外，其他目標不受影響"""
+    send = Recorder(fail_targets=("bad",))
+    coalescer = PushCoalescer(send, window_seconds=0.05)
+    failed = coalescer.push("bad", "x")
+    ok = coalescer.push("U1", "y")
+    with pytest.raises(RuntimeError):
+        failed.result(timeout=5)
+    assert ok.result(timeout=5) is None
+    assert send.sent == [("U1", "y")]
+
+
+def test_send_now_is_not_merged_but_keeps_order():
+    """send_now 單獨送出，但排在同一目標已緩衝的訊息之後"""
+    send = Recorder()
+    coalescer = PushCoalescer(send, window_seconds=5)
+    notice = coalescer.push("U1", "notice")
+    result = coalescer.send_now("U1", "result")
+    assert result.result(timeout=5) is None
+    assert notice.result(timeout=5) is None
+    assert send.sent == [("U1", "notice"), ("U1", "result")]
+
+
+def test_send_now_failure_is_reported():
+    coalescer = PushCoalescer(Recorder(fail_targets=("bad",)), window_seconds=0.05)
+    with pytest.raises(RuntimeError):
+        coalescer.send_now("bad", "result").result(timeout=5)
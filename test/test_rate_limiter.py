@@ -0,0 +1,32 @@
+import time
+
+from services.rate_limiter import TokenBucket
+
+
+def test_burst_up_to_capacity_without_waiting():
+    """容量內的突發請求不需要等待"""
+    bucket = TokenBucket(rate=10, capacity=5)
+    assert all(bucket.acquire() == 0.0 for _ in range(5))
+    assert bucket.get_stats()["throttled"] == 0
+
+
+def test_acquire_waits_for_refill_when_empty():
+    """token 用完後依補充速率等待"""
+    bucket = TokenBucket(rate=50, capacity=1)
+    bucket.acquire()
+    started = time.monotonic()
+    waited = bucket.acquire()
+    assert waited > 0
+    assert time.monotonic() - started >= 0.015
+    stats = bucket.get_stats()
+    assert stats["acquired"] == 2
+    assert stats["throttled"] == 1
+
+
+def test_pause_blocks_until_deadline():
+    """pause 期間即使有容量也不發放 token"""
+    bucket = TokenBucket(rate=1000, capacity=100)
+    bucket.pause(0.05)
+    started = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - started >= 0.045
@@ -0,0 +1,45 @@
+from features.base_feature import BaseFeature
+
+
+class BrokenCache:
+    """所有操作都失敗的結果快取"""
+
+    def __init__(self):
+        self.puts = 0
+
+    def get(self, image_sha256, model, params=None):
+        raise RuntimeError("database unavailable")
+
+    def put(self, image_sha256, model, params, output_url):
+        self.puts += 1
+        raise RuntimeError("disk full")
+
+    def charge_for_hit(self, points):
+        return 0
+
+
+class DummyFeature(BaseFeature):
+    required_points = 10
+
+    @property
+    def name(self):
+        return "dummy"
+
+    def handle_text(self, event):
+        return None
+
+
+def test_cache_errors_fall_back_to_computing():
+    """快取查詢與寫入失敗時仍執行模型並返回已付費的輸出"""
+    feature = DummyFeature(None, None, None)
+    feature.result_cache = BrokenCache()
+    assert feature.run_model("model", "sha", {}, lambda: "https://output") == ("https://output", 10)
+    assert feature.result_cache.puts == 1
+
+
+def test_cache_errors_under_single_flight_fall_back_to_computing():
+    from services.single_flight import SingleFlight
+    feature = DummyFeature(None, None, None)
+    feature.result_cache = BrokenCache()
+    feature.single_flight = SingleFlight()
+    assert feature.run_model("model", "sha", {}, lambda: "https://output") == ("https://output", 10)
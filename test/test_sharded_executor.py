@@ -0,0 +1,71 @@
+import threading
+import time
+
+from services.event_dispatcher import BatchDispatcher, event_source_key
+from services.sharded_executor import ShardedExecutor
+from webhook_event import WebhookEvent
+
+
+def test_same_key_runs_in_submission_order():
+    """同一鍵值的工作依提交順序執行"""
+    executor = ShardedExecutor(shard_count=4)
+    order = []
+    futures = [executor.submit("U1", lambda i=i: (time.sleep(0.001), order.append(i))) for i in range(50)]
+    for future in futures:
+        future.result(timeout=5)
+    executor.shutdown()
+    assert order == list(range(50))
+
+
+def test_different_shards_run_concurrently():
+    """不同分片互不阻塞"""
+    executor = ShardedExecutor(shard_count=2)
+    key_a, key_b = "a", next(key for key in "bcdefgh" if executor.shard_for(key) != executor.shard_for("a"))
+    release = threading.Event()
+    blocked = executor.submit(key_a, release.wait, 5)
+    assert executor.submit(key_b, lambda: "done").result(timeout=2) == "done"
+    release.set()
+    assert blocked.result(timeout=5) is True
+    executor.shutdown()
+
+
+def test_exception_is_set_on_future_and_shard_keeps_running():
+    """工作拋出例外時由 Future 帶回，分片執行緒繼續處理後續工作"""
+    executor = ShardedExecutor(shard_count=1)
+
+    def fail():
+        raise ValueError("boom")
+
+    failed = executor.submit("U1", fail)
+    assert isinstance(failed.exception(timeout=5), ValueError)
+    assert executor.submit("U1", lambda: 42).result(timeout=5) == 42
+    executor.shutdown()
+    assert executor.get_stats()["processed"] == 2
+
+
+def test_shard_for_is_stable():
+    """分片計算跨實例一致"""
+    assert ShardedExecutor(shard_count=8).shard_for("U123") == ShardedExecutor(shard_count=8).shard_for("U123")
+
+
+def test_group_and_personal_events_of_one_user_share_a_key():
+    """同一用戶的群組事件與個人聊天事件落在同一分片（狀態以 userId 為鍵）"""
+    personal = WebhookEvent({"source": {"type": "user", "userId": "U1"}})
+    group = WebhookEvent({"source": {"type": "group", "groupId": "G1", "userId": "U1"}})
+    anonymous = WebhookEvent({"source": {"type": "group", "groupId": "G1"}})
+    assert event_source_key(personal) == event_source_key(group) == "U1"
+    assert event_source_key(anonymous) == "G1"
+
+
+def test_batch_dispatcher_orders_one_users_events_across_chats():
+    handled = []
+    dispatcher = BatchDispatcher(lambda event: (time.sleep(0.001), handled.append(event.text)),
+                                 ShardedExecutor(shard_count=4))
+    events = [
+        WebhookEvent({"source": {"type": "group" if n % 2 else "user", "groupId": "G1", "userId": "U1"},
+                      "message": {"type": "text", "text": str(n)}})
+        for n in range(20)
+    ]
+    dispatcher.dispatch(events)
+    dispatcher.shutdown()
+    assert handled == [str(n) for n in range(20)]
@@ -0,0 +1,95 @@
+import threading
+
+import pytest
+
+from services.single_flight import SingleFlight
+
+
+def _run_concurrently(flight, key, fn, count):
+    results = [None] * count
+    errors = [None] * count
+
+    def call(index):
+        try:
+            results[index] = flight.do(key, fn)
+        except Exception as e:
+            errors[index] = e
+
+    threads = [threading.Thread(target=call, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+def test_concurrent_calls_share_one_execution():
+    """相同鍵值的並行呼叫只執行一次，其他呼叫取得相同結果"""
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "result"
+
+    threads, results, errors = _run_concurrently(flight, "key", work, 1)
+    assert started.wait(5)
+    more_threads, more_results, _ = _run_concurrently(flight, "key", work, 4)
+    # 等待後來的呼叫都進入等待 leader 的狀態
+    while flight.get_stats()["coalesced"] < 4:
+        threading.Event().wait(0.01)
+    release.set()
+    for thread in threads + more_threads:
+        thread.join(5)
+
+    assert calls == [1]
+    assert results == [("result", False)]
+    assert more_results == [("result", True)] * 4
+    assert flight.get_stats()["inflight"] == 0
+
+
+def test_leader_error_propagates_to_waiters_and_is_not_cached():
+    """leader 失敗時等待者收到相同錯誤，之後的呼叫重新執行"""
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("boom")
+
+    threads, _, errors = _run_concurrently(flight, "key", fail, 1)
+    assert started.wait(5)
+    waiter_threads, _, waiter_errors = _run_concurrently(flight, "key", fail, 2)
+    while flight.get_stats()["coalesced"] < 2:
+        threading.Event().wait(0.01)
+    release.set()
+    for thread in threads + waiter_threads:
+        thread.join(5)
+
+    assert all(isinstance(error, RuntimeError) for error in errors + waiter_errors)
+    assert flight.do("key", lambda: "retry") == ("retry", False)
+
+
+def test_non_postgres_engine_is_ignored(sqlite_database):
+    """非 Postgres 的 engine 只做程序內合併"""
+    assert SingleFlight(engine=sqlite_database).engine is None
+
+
+def test_advisory_key_is_signed_64_bit():
+    key = SingleFlight.advisory_key("abc")
+    assert -(2 ** 63) <= key < 2 ** 63
+    assert key == SingleFlight.advisory_key("abc")
+
+
+@pytest.mark.parametrize("count", [1, 3])
+def test_sequential_calls_each_execute(count):
+    """非並行的呼叫不會共用結果"""
+    flight = SingleFlight()
+    calls = []
+    for _ in range(count):
+        flight.do("key", lambda: calls.append(1))
+    assert len(calls) == count
@@ -0,0 +1,60 @@
+from services.state_cache import StateCache, LocalInvalidationChannel, INVALIDATE_ALL
+from services.state_store import MemoryStateStore
+from user_state_manager import UserStateManager
+
+
+def test_cached_value_is_a_copy():
+    cache = StateCache(max_entries=10, ttl_seconds=60)
+    state = {"feature": "colorize", "state": "waiting", "data": {"n": 1}}
+    cache.put("U1", state)
+    state["data"]["n"] = 2
+    hit, cached = cache.get("U1")
+    assert hit
+    cached["data"]["n"] = 3
+    assert cache.get("U1")[1]["data"]["n"] == 1
+
+
+def test_stale_load_is_discarded_after_concurrent_write():
+    """查詢期間有寫入時不放回查詢結果"""
+    cache = StateCache(max_entries=10, ttl_seconds=60)
+    version = cache.begin_load()
+    cache.put("U1", {"state": "new"})
+    cache.finish_load("U1", {"state": "old"}, version)
+    assert cache.get("U1") == (True, {"state": "new"})
+
+
+def test_stale_load_is_discarded_after_invalidation():
+    cache = StateCache(max_entries=10, ttl_seconds=60)
+    version = cache.begin_load()
+    cache.invalidate("U2")
+    cache.finish_load("U1", {"state": "old"}, version)
+    assert cache.get("U1") == (False, None)
+
+
+def test_none_is_cached_and_invalidate_all_clears():
+    cache = StateCache(max_entries=10, ttl_seconds=60)
+    cache.finish_load("U1", None, cache.begin_load())
+    assert cache.get("U1") == (True, None)
+    cache.invalidate(INVALIDATE_ALL)
+    assert cache.get("U1") == (False, None)
+
+
+def test_expired_entry_is_a_miss():
+    cache = StateCache(max_entries=10, ttl_seconds=0.0)
+    cache.put("U1", {"state": "waiting"})
+    assert cache.get("U1") == (False, None)
+
+
+def test_write_on_one_manager_invalidates_the_other():
+    """共用儲存的兩個 manager 透過失效通知保持一致"""
+    store = MemoryStateStore()
+    channel = LocalInvalidationChannel()
+    first = UserStateManager(store=store, cache=StateCache(10, 60), invalidation_channel=channel)
+    second = UserStateManager(store=store, cache=StateCache(10, 60), invalidation_channel=channel)
+
+    first.set_state("U1", {"feature": "colorize", "state": "waiting", "data": None})
+    assert second.get_state("U1")["state"] == "waiting"
+    first.set_state("U1", {"feature": "colorize", "state": "processing", "data": None})
+    assert second.get_state("U1")["state"] == "processing"
+    first.clear_state("U1")
+    assert second.get_state("U1") is None
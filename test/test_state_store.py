@@ -0,0 +1,85 @@
+import time
+
+import pytest
+
+from services.state_store import MemoryStateStore, SqliteStateStore, DatabaseStateStore, create_state_store
+
+
+@pytest.fixture(params=["memory", "sqlite", "database"])
+def store(request, tmp_path):
+    """三種儲存後端（database 使用 SQLite 檔案）"""
+    if request.param == "memory":
+        backend = MemoryStateStore()
+    elif request.param == "sqlite":
+        backend = SqliteStateStore(str(tmp_path / "states.db"))
+    else:
+        request.getfixturevalue("sqlite_database")
+        backend = DatabaseStateStore()
+    yield backend
+    backend.close()
+
+
+def _state(feature, state, data=None):
+    return {"feature": feature, "state": state, "data": data}
+
+
+def test_set_get_clear(store):
+    assert store.get("U1") is None
+    store.set("U1", _state("colorize", "waiting", {"n": 1}))
+    state = store.get("U1")
+    assert (state["feature"], state["state"], state["data"]) == ("colorize", "waiting", {"n": 1})
+    assert abs(state["updated_at"] - time.time()) < 5
+
+    store.set("U1", _state("colorize", "processing"))
+    assert store.get("U1")["state"] == "processing"
+
+    cleared = store.clear("U1")
+    assert cleared["state"] == "processing"
+    assert store.get("U1") is None
+    assert store.clear("U1") is None
+
+
+def test_on_write_is_called(store):
+    calls = []
+    store.set("U1", _state("edit", "waiting"), on_write=calls.append)
+    store.clear("U1", on_write=calls.append)
+    assert len(calls) == 2
+
+
+def test_iter_states_pages_in_user_id_order(store):
+    for index in range(7):
+        store.set(f"U{index}", _state("edit" if index % 2 else "colorize", "waiting"))
+    user_ids = [user_id for user_id, _ in store.iter_states(page_size=3)]
+    assert user_ids == [f"U{index}" for index in range(7)]
+    assert [user_id for user_id, _ in store.iter_states(feature="edit", page_size=2)] == ["U1", "U3", "U5"]
+
+
+def test_count_states(store):
+    store.set("U1", _state("colorize", "waiting"))
+    store.set("U2", _state("colorize", "waiting"))
+    store.set("U3", _state("edit", "processing"))
+    assert sorted(store.count_states()) == [("colorize", "waiting", 2), ("edit", "processing", 1)]
+
+
+def test_delete_expired_respects_feature_ttls(store):
+    store.set("U1", _state("colorize", "waiting"))
+    store.set("U2", _state("edit", "waiting"))
+    time.sleep(1.1)
+    # colorize 的 TTL 很長，其他功能使用預設 TTL（已過期）
+    assert store.delete_expired({"colorize": 3600}, 1, limit=10) == 1
+    assert store.get("U1") is not None
+    assert store.get("U2") is None
+
+
+def test_delete_expired_honours_limit(store):
+    for index in range(3):
+        store.set(f"U{index}", _state("edit", "waiting"))
+    time.sleep(1.1)
+    assert store.delete_expired({}, 1, limit=2) == 2
+    assert store.delete_expired({}, 1, limit=2) == 1
+
+
+def test_create_state_store_rejects_unknown_backend():
+    assert isinstance(create_state_store("memory"), MemoryStateStore)
+    with pytest.raises(ValueError):
+        create_state_store("redis")
@@ -1,82 +1,151 @@
-from models.database import get_session
-from models.user_state import UserState
-from sqlalchemy.orm import Session
-from typing import Optional, Dict, Any
+import os
+import threading
+import time
+from typing import Optional, Dict, Any, Iterator, Tuple, List
+from services.state_cache import INVALIDATE_ALL
+from services.state_store import create_state_store
 
 
 class UserStateManager:
-    """用戶狀態管理器，使用資料庫儲存狀態"""
+    """
+    用戶狀態管理器（儲存後端可替換，可選 write-through 程序內快取）
+
+    每個狀態依所屬功能有 TTL：讀取時超過 TTL 的狀態視為不存在，
+    實際刪除由 StateReaper 在背景分批進行。
+    """
+    
+    def __init__(self, store=None, cache=None, invalidation_channel=None, default_ttl_seconds: float = None):
+        """
+        初始化狀態管理器
+        
+        Args:
+            store: StateStore（None 時依 STATE_BACKEND 建立：memory / sqlite / database）
+            cache: StateCache（None 表示每次都讀取儲存後端）
+            invalidation_channel: 跨程序失效通知頻道（LocalInvalidationChannel / PostgresInvalidationChannel）
+            default_ttl_seconds: 未設定 TTL 的功能使用的狀態存活秒數（0 表示不過期）
+        """
+        self.store = store or create_state_store()
+        self.cache = cache
+        self.invalidation_channel = invalidation_channel
+        self.default_ttl_seconds = default_ttl_seconds if default_ttl_seconds is not None else \
+            float(os.getenv("USER_STATE_TTL_SECONDS", "86400"))
+        self.feature_ttls = {}
+        self._lock = threading.Lock()
+        self._expired_reads = 0
+        self._subscriber_id = None
+        if cache is not None and invalidation_channel is not None:
+            self._subscriber_id = invalidation_channel.subscribe(
+                lambda user_id: cache.invalidate(user_id, remote=True)
+            )
+    
+    def _notifier(self, user_id: str):
+        """產生寫入時的失效通知回呼（資料庫後端會在同一交易中通知）"""
+        if self.invalidation_channel is None:
+            return None
+        return lambda session: self.invalidation_channel.publish(user_id, self._subscriber_id, session=session)
+    
+    def set_feature_ttl(self, feature: str, seconds: float):
+        """
+        設定功能的狀態 TTL（可用 USER_STATE_TTL_<功能名稱>_SECONDS 環境變數覆寫）
+        
+        Args:
+            feature: 功能名稱
+            seconds: 狀態存活秒數（0 表示不過期）
+        """
+        self.feature_ttls[feature] = float(os.getenv(f"USER_STATE_TTL_{feature.upper()}_SECONDS", seconds))
+    
+    def ttl_for(self, feature: str) -> float:
+        """取得功能的狀態 TTL 秒數"""
+        return self.feature_ttls.get(feature, self.default_ttl_seconds)
+    
+    def _is_expired(self, state: Dict[str, Any]) -> bool:
+        ttl = self.ttl_for(state.get("feature"))
+        updated_at = state.get("updated_at")
+        return bool(ttl) and ttl > 0 and updated_at is not None and updated_at + ttl < time.time()
+    
+    def get_ttl_stats(self) -> Dict[str, Any]:
+        """取得 TTL 設定與讀取時判定過期的次數"""
+        with self._lock:
+            expired_reads = self._expired_reads
+        return {
+            "default_ttl_seconds": self.default_ttl_seconds,
+            "feature_ttls": dict(self.feature_ttls),
+            "expired_reads": expired_reads,
+        }
     
-    def __init__(self):
-        """初始化狀態管理器"""
-        pass
+    def get_cache_stats(self) -> Optional[Dict[str, Any]]:
+        """取得快取統計（未啟用快取時返回 None）"""
+        return self.cache.get_stats() if self.cache is not None else None
     
     def set_state(self, user_id: str, state: Dict[str, Any]):
         """設定用戶狀態"""
         try:
-            with get_session() as session:
-                # 檢查是否已存在狀態
-                existing_state = session.query(UserState).filter_by(user_id=user_id).first()
-                
-                if existing_state:
-                    # 更新現有狀態
-                    existing_state.feature = state.get("feature")
-                    existing_state.state = state.get("state")
-                    existing_state.set_data(state.get("data"))
-                    print(f"用戶 {user_id} 狀態已更新: {state}")
-                else:
-                    # 建立新狀態
-                    new_state = UserState.create_state(
-                        user_id=user_id,
-                        feature=state.get("feature"),
-                        state=state.get("state"),
-                        data=state.get("data")
-                    )
-                    session.add(new_state)
-                    print(f"用戶 {user_id} 狀態已建立: {state}")
-                
-                session.commit()
+            created = self.store.set(user_id, state, on_write=self._notifier(user_id))
+            if created is None:
+                print(f"用戶 {user_id} 狀態已寫入: {state}")
+            elif created:
+                print(f"用戶 {user_id} 狀態已建立: {state}")
+            else:
+                print(f"用戶 {user_id} 狀態已更新: {state}")
         except Exception as e:
+            if self.cache is not None:
+                self.cache.invalidate(user_id)
             print(f"設定用戶狀態失敗: {str(e)}")
             raise e
+        
+        if self.cache is not None:
+            self.cache.put(user_id, {
+                "feature": state.get("feature"),
+                "state": state.get("state"),
+                "data": state.get("data"),
+                "updated_at": time.time()
+            })
     
     def get_state(self, user_id: str) -> Optional[Dict[str, Any]]:
-        """獲取用戶狀態"""
-        try:
-            with get_session() as session:
-                user_state = session.query(UserState).filter_by(user_id=user_id).first()
-                
-                if user_state:
-                    return {
-                        "feature": user_state.feature,
-                        "state": user_state.state,
-                        "data": user_state.get_data()
-                    }
+        """獲取用戶狀態（有快取時優先讀取快取）"""
+        version = None
+        hit = False
+        if self.cache is not None:
+            hit, state = self.cache.get(user_id)
+            if not hit:
+                version = self.cache.begin_load()
+        
+        if not hit:
+            try:
+                state = self.store.get(user_id)
+            except Exception as e:
+                print(f"獲取用戶狀態失敗: {str(e)}")
                 return None
-        except Exception as e:
-            print(f"獲取用戶狀態失敗: {str(e)}")
+            
+            if self.cache is not None:
+                self.cache.finish_load(user_id, state, version)
+        
+        if state is None:
+            return None
+        if self._is_expired(state):
+            # 已過期但尚未被清理的狀態視為不存在
+            with self._lock:
+                self._expired_reads += 1
             return None
+        state.pop("updated_at", None)
+        return state
     
     def clear_state(self, user_id: str):
         """清除用戶狀態"""
         try:
-            with get_session() as session:
-                user_state = session.query(UserState).filter_by(user_id=user_id).first()
-                
-                if user_state:
-                    old_state = {
-                        "feature": user_state.feature,
-                        "state": user_state.state,
-                        "data": user_state.get_data()
-                    }
-                    session.delete(user_state)
-                    session.commit()
-                    print(f"用戶 {user_id} 狀態已清除 (原狀態: {old_state})")
-                else:
-                    print(f"用戶 {user_id} 沒有狀態需要清除")
+            old_state = self.store.clear(user_id, on_write=self._notifier(user_id))
+            if old_state is not None:
+                print(f"用戶 {user_id} 狀態已清除 (原狀態: {old_state})")
+            else:
+                print(f"用戶 {user_id} 沒有狀態需要清除")
         except Exception as e:
+            if self.cache is not None:
+                self.cache.invalidate(user_id)
             print(f"清除用戶狀態失敗: {str(e)}")
             raise e
+        
+        if self.cache is not None:
+            self.cache.put(user_id, None)
     
     def is_waiting_for_colorize(self, user_id: str) -> bool:
         """檢查用戶是否在等待彩色化確認（向後相容）"""
@@ -94,39 +163,69 @@ class UserStateManager:
                     state.get("state") == "processing")
         return False
     
+    def iter_states(self, feature: str = None, state: str = None, older_than_hours: float = None,
+                    page_size: int = 500) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """
+        串流列出用戶狀態（keyset 分頁，記憶體用量固定；用於管理工具）
+        
+        Args:
+            feature: 只列出此功能的狀態
+            state: 只列出此狀態名稱
+            older_than_hours: 只列出超過此小時數未更新的狀態
+            page_size: 每頁筆數
+            
+        Yields:
+            tuple: (user_id, 狀態)，狀態含 updated_at（epoch 秒數）
+        """
+        older_than_seconds = older_than_hours * 3600 if older_than_hours is not None else None
+        return self.store.iter_states(feature, state, older_than_seconds, page_size)
+    
+    def count_states(self, feature: str = None, state: str = None,
+                     older_than_hours: float = None) -> List[Dict[str, Any]]:
+        """
+        依功能與狀態名稱統計狀態數量（由資料庫彙總）
+        
+        Returns:
+            list: [{"feature", "state", "count"}]
+        """
+        older_than_seconds = older_than_hours * 3600 if older_than_hours is not None else None
+        return [
+            {"feature": row_feature, "state": row_state, "count": count}
+            for row_feature, row_state, count in self.store.count_states(feature, state, older_than_seconds)
+        ]
+    
     def get_all_states(self) -> Dict[str, Dict[str, Any]]:
-        """獲取所有用戶狀態（用於管理或除錯）"""
+        """獲取所有用戶狀態（會載入整張表；大量資料請使用 iter_states / count_states）"""
         try:
-            with get_session() as session:
-                states = session.query(UserState).all()
-                return {
-                    state.user_id: {
-                        "feature": state.feature,
-                        "state": state.state,
-                        "data": state.get_data()
-                    }
-                    for state in states
-                }
+            return self.store.all_states()
         except Exception as e:
             print(f"獲取所有狀態失敗: {str(e)}")
             return {}
     
+    def delete_expired_states(self, limit: int) -> int:
+        """
+        刪除一批超過 TTL 的狀態（供 StateReaper 呼叫）
+        
+        讀取時已會略過過期狀態，因此不需要讓快取失效。
+        
+        Returns:
+            int: 刪除筆數
+        """
+        # TTL 為 0 表示不過期
+        ttls = {feature: ttl if ttl > 0 else None for feature, ttl in self.feature_ttls.items()}
+        default_ttl = self.default_ttl_seconds if self.default_ttl_seconds > 0 else None
+        return self.store.delete_expired(ttls, default_ttl, limit)
+    
     def cleanup_old_states(self, hours: int = 24):
-        """清理超過指定小時的舊狀態"""
+        """分批清理超過指定小時的舊狀態"""
         try:
-            from datetime import datetime, timedelta
-            from sqlalchemy import delete
+            count = self.store.cleanup_older_than(hours, on_write=self._notifier(INVALIDATE_ALL))
             
-            cutoff_time = datetime.now() - timedelta(hours=hours)
+            if self.cache is not None:
+                self.cache.invalidate(INVALIDATE_ALL)
             
-            with get_session() as session:
-                result = session.execute(
-                    delete(UserState).where(UserState.updated_at < cutoff_time)
-                )
-                session.commit()
-                
-                print(f"已清理 {result.rowcount} 個超過 {hours} 小時的舊狀態")
-                return result.rowcount
+            print(f"已清理 {count} 個超過 {hours} 小時的舊狀態")
+            return count
         except Exception as e:
             print(f"清理舊狀態失敗: {str(e)}")
             return 0
@@ -0,0 +1,103 @@
+import base64
+import hashlib
+import hmac
+import json
+from linebot.exceptions import InvalidSignatureError
+
+try:
+    # 可選的高速 JSON 解析器
+    import orjson as _fast_json
+except ImportError:
+    _fast_json = None
+
+
+def decode_json(body: bytes):
+    """解析 JSON（有安裝 orjson 時使用 orjson）"""
+    if _fast_json is not None:
+        return _fast_json.loads(body)
+    return json.loads(body)
+
+
+class WebhookEvent:
+    """
+    webhook 事件（只解析一次，常用欄位預先取出）
+
+    取代在各功能中反覆使用 event.get('source', {}).get(...) 走訪原始 dict。
+    原始 dict 保留在 raw，供佇列持久化等需要原始格式的地方使用。
+    """
+
+    __slots__ = (
+        'type', 'message_type', 'source_type',
+        'user_id', 'group_id', 'room_id', 'target_id',
+        'reply_token', 'message_id', 'text',
+        'webhook_event_id', 'is_redelivery', 'timestamp', 'raw', 'context',
+    )
+
+    def __init__(self, raw: dict):
+        source = raw.get('source') or {}
+        message = raw.get('message') or {}
+
+        self.raw = raw
+        self.type = raw.get('type', '')
+        self.message_type = message.get('type', '')
+        self.source_type = source.get('type', 'user')
+        self.user_id = source.get('userId', '')
+        self.group_id = source.get('groupId', '')
+        self.room_id = source.get('roomId', '')
+        self.reply_token = raw.get('replyToken', '')
+        self.message_id = message.get('id', '')
+        self.text = message.get('text', '')
+        self.webhook_event_id = raw.get('webhookEventId', '')
+        self.is_redelivery = (raw.get('deliveryContext') or {}).get('isRedelivery', False)
+        self.timestamp = raw.get('timestamp')
+        # 請求範圍的 EventContext，由 dispatch_event 建立
+        self.context = None
+
+        # 推送訊息的目標：群組聊天為群組/房間 ID，個人聊天為用戶 ID
+        if self.source_type == 'group':
+            self.target_id = self.group_id
+        elif self.source_type == 'room':
+            self.target_id = self.room_id
+        else:
+            self.target_id = self.user_id
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> 'WebhookEvent':
+        """從原始 event dict 建立"""
+        return cls(raw)
+
+    @property
+    def is_group_chat(self) -> bool:
+        """是否為群組聊天"""
+        return self.source_type in ('group', 'room')
+
+    def __repr__(self):
+        return f"<WebhookEvent(type='{self.type}', message_type='{self.message_type}', target_id='{self.target_id}')>"
+
+
+class WebhookParser:
+    """webhook 入口：驗證簽名、解析 JSON、建立 WebhookEvent，每個請求只做一次"""
+
+    def __init__(self, channel_secret: str):
+        self._secret = channel_secret.encode('utf-8')
+
+    def verify(self, body: bytes, signature: str):
+        """
+        以原始 bytes 驗證 X-Line-Signature
+
+        Raises:
+            InvalidSignatureError: 簽名不符
+        """
+        digest = hmac.new(self._secret, body, hashlib.sha256).digest()
+        expected = base64.b64encode(digest)
+        if not signature or not hmac.compare_digest(expected, signature.encode('utf-8')):
+            raise InvalidSignatureError(f"Invalid signature. signature={signature}")
+
+    def parse_raw(self, body: bytes, signature: str) -> list:
+        """驗證簽名並回傳原始 event dict 列表（供佇列模式直接寫入）"""
+        self.verify(body, signature)
+        return decode_json(body).get('events', [])
+
+    def parse(self, body: bytes, signature: str) -> list:
+        """驗證簽名並回傳 WebhookEvent 列表"""
+        return [WebhookEvent(raw) for raw in self.parse_raw(body, signature)]